@@ -10,6 +10,16 @@ from typing import Any, Text, Dict, List
 from rasa_sdk import Action, Tracker
 from rasa_sdk.executor import CollectingDispatcher
 from rasa_sdk.events import ActionExecuted, SlotSet
+from dotenv import load_dotenv
+
+# The only load_dotenv() call. The API modules read os.environ when they're
+# imported, so it has to come before any of them (the rest are imported
+# lazily, see actions/api/lazy.py)
+load_dotenv()
+
+from actions.api.lazy import lazy_import, warm_up
+from actions.api.metrics import timed_action
+from actions.api.budget import budgeted, time_left
 
 class ActionSessionStart(Action):
     """
@@ -21,6 +31,8 @@ class ActionSessionStart(Action):
     def name(self) -> Text:
         return "action_session_start"
 
+    @timed_action
+    @budgeted
     async def run(self, 
                   dispatcher: CollectingDispatcher,
                   tracker: Tracker,
@@ -34,42 +46,42 @@ class ActionSessionStart(Action):
         # If left out, it will skip the next user input.
         return [ActionExecuted("action_listen")]
 
-from jokeapi import Jokes
-from jokeapi.main import CategoryError
 import asyncio
 
+jokes = lazy_import("actions.api.jokes")
+
 class ActionTellJoke(Action):
 
     def name(self) -> Text:
         return "action_tell_joke"
 
+    @timed_action
+    @budgeted
     async def run(self, 
                   dispatcher: CollectingDispatcher,
                   tracker: Tracker,
                   domain: Dict[Text, Any]
                 ) -> List[Dict[Text, Any]]:
 
-        category = next(tracker.get_latest_entity_values("joke_category"), 'Any')
-        j = await Jokes()
+        requested = next(tracker.get_latest_entity_values("joke_category"), 'Any')
+        category = jokes.resolve_category(requested)
 
         logging.debug(category)
 
-        try:
-            joke = await j.get_joke(category=[category], safe_mode=True)
-        except CategoryError:
+        if category is None:
             error = (
-                        f"Sorry, but '{category}' isn't a category I recognize. "
+                        f"Sorry, but '{requested}' isn't a category I recognize. "
                         "The available categories are Any, Misc, Programming, "
                         "Pun, Spooky, and Christmas."
                     )
             
             dispatcher.utter_message(text=error)
             return []
-        
 
-        has_error = joke.get('error')
+        # From the pool, see actions/api/jokes.py
+        joke = await jokes.joke_pool.get(category, tracker.sender_id)
 
-        if has_error:
+        if joke is None:
             dispatcher.utter_message(text="Apologies, but I can't fulfill that request.")
             return []
         
@@ -83,12 +95,12 @@ class ActionTellJoke(Action):
         return []
 
 import os
-import requests
 import math
-from dotenv import load_dotenv
-from actions.api.open_weather import OpenWeatherMap
+import time
 
-load_dotenv()
+aiohttp = lazy_import("aiohttp")
+arrow = lazy_import("arrow")
+open_weather = lazy_import("actions.api.open_weather")
 
 class ActionSayWeather(Action):
 
@@ -102,7 +114,9 @@ class ActionSayWeather(Action):
         
         return math.ceil(x)
 
-    def run(self, 
+    @timed_action
+    @budgeted
+    async def run(self, 
                   dispatcher: CollectingDispatcher,
                   tracker: Tracker,
                   domain: Dict[Text, Any]
@@ -112,15 +126,15 @@ class ActionSayWeather(Action):
                         os.environ["DEFAULT_LOCATION"])
 
         api_key = os.environ["OPENWEATHER_API_KEY"]
-        weather_api = OpenWeatherMap(api_key)
+        weather_api = open_weather.OpenWeatherMap(api_key)
 
         try:
-            current = weather_api.get_current_weather(location)
+            current, stale = await weather_api.get_current_weather(location)
         except IndexError:
             bad_location = f"Are your sure '{location}' exists? It's not fetching any results."
             dispatcher.utter_message(text=bad_location)
             return []
-        except requests.RequestException:
+        except (aiohttp.ClientError, asyncio.TimeoutError):
             unable_to_fetch = "Sorry, I can't get the weather at the moment."
             dispatcher.utter_message(text=unable_to_fetch)
             return []
@@ -148,62 +162,107 @@ class ActionSayWeather(Action):
             f"Current visibility is {visibility}m."
         )
 
+        # OpenWeather couldn't answer in time, this is an older answer from the cache
+        if stale:
+            dispatcher.utter_message(
+                text=f"I can't get the latest weather, so this is from {arrow.get(current['dt']).humanize()}."
+            )
+
         dispatcher.utter_message(image=icon_url, text=weather_report)
 
         return []
 
-from actions.api.time import TimeAPI
+timezones = lazy_import("actions.api.timezones")
 
 class ActionGetTime(Action):
-
+    """
+    Time is computed locally from the coordinates' timezone (see
+    actions/api/timezones.py). Besides geocoding, timeapi.io is only asked
+    which timezone a place is in, for countries that have several.
+    Asking about several places ("time in Tokyo and London") looks them up
+    concurrently and answers with one clock reading for all of them.
+    """
     def name(self) -> Text:
         return "action_get_time"
 
+    @timed_action
+    @budgeted
     async def run(self, 
                   dispatcher: CollectingDispatcher,
                   tracker: Tracker,
                   domain: Dict[Text, Any]
                 ) -> List[Dict[Text, Any]]:
         
-        location = next(tracker.get_latest_entity_values("GPE"), 
-                        os.environ["DEFAULT_LOCATION"])
+        # dict.fromkeys() drops repeated mentions while keeping their order
+        locations = list(dict.fromkeys(tracker.get_latest_entity_values("GPE"))) or \
+                    [os.environ["DEFAULT_LOCATION"]]
 
         api_key = os.environ["OPENWEATHER_API_KEY"]
-        weather_api = OpenWeatherMap(api_key)
+        weather_api = open_weather.OpenWeatherMap(api_key)
+
+        results = await asyncio.gather(
+            *[weather_api.get_coordinates(location) for location in locations],
+            return_exceptions=True
+        )
+
+        found = []
+        places = []
+
+        for location, location_coords in zip(locations, results):
+            if isinstance(location_coords, (aiohttp.ClientError, asyncio.TimeoutError)):
+                unable_to_fetch = "Sorry, I can't get the geographic coordinates at the moment."
+                dispatcher.utter_message(text=unable_to_fetch)
+                return []
+            elif isinstance(location_coords, BaseException):
+                raise location_coords
+
+            if not location_coords:
+                bad_location = f"Are your sure '{location}' exists? It's not fetching any results."
+                dispatcher.utter_message(text=bad_location)
+                continue
+
+            found.append(location)
+            places.append((
+                location_coords[0]["lat"],
+                location_coords[0]["lon"],
+                location_coords[0].get("country")
+            ))
 
         try:
-            location_coords = weather_api.get_coordinates(location)
-            lat, lon = (location_coords[0]["lat"], location_coords[0]["lon"])
-            coords = (lat, lon)
-        except IndexError:
-            bad_location = f"Are your sure '{location}' exists? It's not fetching any results."
-            dispatcher.utter_message(text=bad_location)
-            return []
-        except requests.RequestException:
-            unable_to_fetch = "Sorry, I can't get the geographic coordinates at the moment."
+            local_times = await timezones.world_clock(places)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            unable_to_fetch = "Sorry, I can't get the time at the moment."
             dispatcher.utter_message(text=unable_to_fetch)
             return []
-        
-        time_api = TimeAPI()
-        time = time_api.get_time(coords)
 
-        date = time["date"]
-        day_of_week = time["dayOfWeek"]
-        twelve_hour_format = time_api.get_twelve_hour_clock(coords)
+        for location, local_time in zip(found, local_times):
+            date = local_time.strftime("%m/%d/%Y")
+            day_of_week = local_time.strftime("%A")
+            twelve_hour_format = local_time.strftime("%I:%M %p")
 
-        message = (
-            f"Right now in {location}, it's {day_of_week} ({date}), {twelve_hour_format}."
-        )
+            message = (
+                f"Right now in {location}, it's {day_of_week} ({date}), {twelve_hour_format}."
+            )
+
+            dispatcher.utter_message(text=message)
 
-        dispatcher.utter_message(text=message)
         return []
     
-class ActionTellDayState(Action):
+from datetime import datetime, timezone
 
+solar = lazy_import("actions.api.solar")
+
+class ActionTellDayState(Action):
+    """
+    Sun elevation is computed locally (see actions/api/solar.py), so the
+    only network call is geocoding, which is usually cached.
+    """
     def name(self) -> Text:
         return "action_tell_day_state"
 
-    def run(self, 
+    @timed_action
+    @budgeted
+    async def run(self, 
                   dispatcher: CollectingDispatcher,
                   tracker: Tracker,
                   domain: Dict[Text, Any]
@@ -218,35 +277,26 @@ class ActionTellDayState(Action):
             return []
         
         api_key = os.environ["OPENWEATHER_API_KEY"]
-        weather_api = OpenWeatherMap(api_key)
+        weather_api = open_weather.OpenWeatherMap(api_key)
         
         try:
-            # Current weather gives us access to sunrise and sunset
-            current = weather_api.get_current_weather(location)
+            location_coords = await weather_api.get_coordinates(location)
+            lat, lon = (location_coords[0]["lat"], location_coords[0]["lon"])
         except IndexError:
             bad_location = f"Are your sure '{location}' exists? It's not fetching any results."
             dispatcher.utter_message(text=bad_location)
             return []
-        except requests.RequestException:
-            unable_to_fetch = "Sorry, I can't get the weather at the moment."
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            unable_to_fetch = "Sorry, I can't get the geographic coordinates at the moment."
             dispatcher.utter_message(text=unable_to_fetch)
             return []
-        
-        timezone_offset = current["timezone"]
-        coords = (current["coord"]["lat"], current["coord"]["lon"])
 
-        sunset = current["sys"]["sunset"] + timezone_offset
-        sunrise = current["sys"]["sunrise"] + timezone_offset
+        # Above this the sun's upper edge is over the horizon, i.e. between sunrise and sunset
+        elevation = float(solar.solar_elevation(lat, lon, time.time()))
 
-        location_time = TimeAPI().get_unix_time(coords)
-
-        logging.debug(
-                f"Sunset: {sunset}\n"
-                f"Sunrise: {sunrise}\n"
-                f"location: {location_time}\n"
-            )
+        logging.debug(f"Sun elevation in {location}: {elevation:.2f}°")
         
-        if location_time >= sunrise and location_time <= sunset:
+        if elevation > 90 - solar.SUNRISE:
             if user_ask == 'day':
                 dispatcher.utter_message(text=f"Correct, it's daytime in the {location} area.")
             else:
@@ -258,50 +308,119 @@ class ActionTellDayState(Action):
                 dispatcher.utter_message(text=f"No, it's nighttime as of the moment in {location}.")
 
         return []
+
+class ActionTellSunTimes(Action):
+
+    def name(self) -> Text:
+        return "action_tell_sun_times"
+
+    @timed_action
+    @budgeted
+    async def run(self, 
+                  dispatcher: CollectingDispatcher,
+                  tracker: Tracker,
+                  domain: Dict[Text, Any]
+                ) -> List[Dict[Text, Any]]:
+
+        location = next(tracker.get_latest_entity_values("GPE"), 
+                        os.environ["DEFAULT_LOCATION"])
+
+        api_key = os.environ["OPENWEATHER_API_KEY"]
+        weather_api = open_weather.OpenWeatherMap(api_key)
+
+        try:
+            location_coords = await weather_api.get_coordinates(location)
+            lat, lon = (location_coords[0]["lat"], location_coords[0]["lon"])
+            country = location_coords[0].get("country")
+        except IndexError:
+            bad_location = f"Are your sure '{location}' exists? It's not fetching any results."
+            dispatcher.utter_message(text=bad_location)
+            return []
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            unable_to_fetch = "Sorry, I can't get the geographic coordinates at the moment."
+            dispatcher.utter_message(text=unable_to_fetch)
+            return []
+
+        try:
+            now = await timezones.local_time(lat, lon, country)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            unable_to_fetch = "Sorry, I can't get the local time at the moment."
+            dispatcher.utter_message(text=unable_to_fetch)
+            return []
+
+        # Midnight UTC of the local date picks that day's sunrise and sunset
+        local_date = datetime(now.year, now.month, now.day, tzinfo=timezone.utc).timestamp()
+        sunrise, sunset = (float(t) for t in solar.sun_times(lat, lon, local_date))
+
+        if math.isnan(sunrise):
+            if solar.solar_elevation(lat, lon, now.timestamp()) > 0:
+                dispatcher.utter_message(text=f"The sun doesn't set in {location} today.")
+            else:
+                dispatcher.utter_message(text=f"The sun doesn't rise in {location} today.")
+            return []
+
+        sunrise = datetime.fromtimestamp(sunrise, now.tzinfo).strftime("%I:%M %p")
+        sunset = datetime.fromtimestamp(sunset, now.tzinfo).strftime("%I:%M %p")
+
+        dispatcher.utter_message(
+            text=f"In {location}, the sun rises at {sunrise} and sets at {sunset} today."
+        )
+
+        return []
     
-from actions.api.mistral import conversate_with_user
+mistral = lazy_import("actions.api.mistral")
+stream_webhook = lazy_import("actions.api.stream_webhook")
+llm_context = lazy_import("actions.api.llm_context")
 
 class ActionMakeConversation(Action):
 
     def name(self) -> Text:
         return "action_make_conversation"
 
-    def run(self, 
+    @timed_action
+    @budgeted
+    async def run(self, 
                   dispatcher: CollectingDispatcher,
                   tracker: Tracker,
                   domain: Dict[Text, Any]
                 ) -> List[Dict[Text, Any]]:
 
-        messages = []
-       
-        for event in tracker.events:
-            if event.get("event") == "user":
-                data = {
-                    "role": "user",
-                    "content": f"{event.get('text')}"
-                }
-                messages.append(data)
-            elif event.get("event") == "bot":
-                data = {
-                    "role": "assistant",
-                    "content": f"{event.get('text')}"
-                }
-                messages.append(data)
-
-        llm_response = conversate_with_user(messages)
+        # Only events since the last turn are processed, and old messages
+        # are summarized to stay within the token budget
+        messages, summary = llm_context.conversation_context.update(tracker.sender_id, tracker.events)
+
+        webhook_url = os.environ.get("MISTRAL_STREAM_WEBHOOK")
+        stream = os.environ.get("MISTRAL_STREAM", "false").lower() == "true"
+
+        if stream and webhook_url:
+            # Preview each finished sentence while the rest is generated, see
+            # actions/api/stream_webhook.py. The whole reply still goes out below
+            pusher = stream_webhook.MessagePusher(
+                webhook_url,
+                tracker.sender_id,
+                os.environ.get("MISTRAL_STREAM_WEBHOOK_TOKEN")
+            )
+
+            llm_response = await mistral.conversate_with_user(messages, on_text=pusher.feed, summary=summary)
+            await pusher.flush()
+        else:
+            llm_response = await mistral.conversate_with_user(messages, summary=summary)
+
         dispatcher.utter_message(text=llm_response)
 
         return []
 
-from actions.api.mangadex import MangaDex
-import arrow
+mangadex = lazy_import("actions.api.mangadex")
+manga_store = lazy_import("actions.api.manga_store")
 
 class ActionCheckMangaUpdates(Action):
 
     def name(self) -> Text:
         return "action_check_manga_updates"
 
-    def run(self, 
+    @timed_action
+    @budgeted
+    async def run(self, 
                   dispatcher: CollectingDispatcher,
                   tracker: Tracker,
                   domain: Dict[Text, Any]
@@ -314,11 +433,11 @@ class ActionCheckMangaUpdates(Action):
 
         dispatcher.utter_message(text="Okay, let me check right now.")
 
-        user = MangaDex(username, password, client_id, client_secret)
+        user = mangadex.MangaDex(username, password, client_id, client_secret)
 
         chapter_count = next(tracker.get_latest_entity_values("number"), 5)
 
-        followed_manga = user.get_chapter_feed(
+        followed_manga = await user.get_chapter_feed(
             content_rating=["safe", "suggestive", "erotica"],
             limit=chapter_count
         )
@@ -371,14 +490,22 @@ class ActionCheckMangaUpdates(Action):
             dispatcher.utter_message(text=chapter)
             dispatcher.utter_message(text="\n\n")
         
-        return [SlotSet("manga_history", followed_manga['data'])]
+        # Only IDs go in the tracker, details are looked up again in ActionTellMangaDetails
+        manga_history = [
+            {"chapter_id": chapter["id"], "manga_id": manga_store.manga_id_of(chapter)}
+            for chapter in followed_manga["data"]
+        ]
+
+        return [SlotSet("manga_history", manga_history)]
 
 class ActionTellMangaDetails(Action):
 
     def name(self) -> Text:
         return "action_tell_manga_details"
 
-    def run(self, 
+    @timed_action
+    @budgeted
+    async def run(self, 
                   dispatcher: CollectingDispatcher,
                   tracker: Tracker,
                   domain: Dict[Text, Any]
@@ -407,14 +534,18 @@ class ActionTellMangaDetails(Action):
             )
             return []
         
-        relationships = list(
-                filter(
-                    lambda relation: relation['type'] == 'manga', 
-                    manga_history[index - 1]["relationships"]
-                )
-            )
-        
-        manga_info = relationships[0]['attributes']
+        entry = manga_history[index - 1]
+
+        # Trackers saved before the slot was compacted still hold the raw chapter
+        series_id = entry.get("manga_id") or manga_store.manga_id_of(entry)
+
+        try:
+            manga = await mangadex.get_manga(series_id)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            dispatcher.utter_message(text="Sorry, I can't get the manga details at the moment.")
+            return []
+
+        manga_info = manga['attributes']
 
         ro_title = manga_info['title']['en']
         description = manga_info['description']['en'] or "No description provided"
@@ -425,7 +556,6 @@ class ActionTellMangaDetails(Action):
         status = manga_info['status'].capitalize() or UNKNOWN
         content_rating = manga_info['contentRating'].capitalize() or UNKNOWN
 
-        series_id = relationships[0]['id']
         link = f"https://mangadex.org/title/{series_id}"
 
         dispatcher.utter_message(text=ro_title)
@@ -438,7 +568,10 @@ class ActionTellMangaDetails(Action):
 
         return []
 
-import json
+http = lazy_import("actions.api.http")
+shelly_rpc = lazy_import("actions.api.shelly.rpc")
+shelly_state = lazy_import("actions.api.shelly.state")
+shelly_readings = lazy_import("actions.api.shelly.readings")
 
 class ActionSetLightState(Action):
     """
@@ -448,40 +581,115 @@ class ActionSetLightState(Action):
     def name(self) -> Text:
         return "action_set_light_state"
 
-    def run(self, 
+    @timed_action
+    @budgeted
+    async def run(self, 
                   dispatcher: CollectingDispatcher,
                   tracker: Tracker,
                   domain: Dict[Text, Any]
                 ) -> List[Dict[Text, Any]]:
 
         is_on = next(tracker.get_latest_entity_values("is_on"), "false")
-        shelly_ip = os.environ['SHELLY_PLUG_IP']
-
-        params = {
-            "id": 0,
-            "on": is_on
-        }
 
-        try:
-            url = f"http://{shelly_ip}/rpc/Switch.Set"
-            response = requests.get(url, params=params)
-            response.raise_for_status()
+        # "turn off the desk lights" -> just the desk plug, no device named -> every plug
+        devices, unknown_names = shelly_rpc.shelly_devices.resolve(list(tracker.get_latest_entity_values("device")))
 
-            logging.debug(f"Time elapsed: {response.elapsed}")
-            logging.debug(json.dumps(response.json(), indent=2))
+        if unknown_names:
+            dispatcher.utter_message(f"I don't know a device called {', '.join(unknown_names)}.")
+            return []
 
-        except requests.exceptions.HTTPError as error:
-            logging.error(error.strerror)
-            dispatcher.utter_message("Sorry, but I can't connect to the Shelly Device.") 
+        if not devices:
+            dispatcher.utter_message("There aren't any Shelly devices set up.")
+            return []
 
         # This looks silly but you can't set boolean slots in intents
-        light_state = "on" if is_on == "true" else "off"
-        dispatcher.utter_message(f"Turning lights {light_state}.") 
+        on = is_on == "true"
+        light_state = "on" if on else "off"
+
+        # Plugs already in that state don't need a command
+        to_switch = [device for device in devices if shelly_state.switch_mirror.get(device) != on]
+
+        if not to_switch:
+            dispatcher.utter_message(f"The lights are already {light_state}.")
+            return []
+
+        results = await shelly_rpc.shelly_devices.set_switch(to_switch, on)
+
+        logging.debug(results)
+
+        failed = [name for name, result in results.items() if isinstance(result, BaseException)]
+
+        for name in failed:
+            logging.error(f"{name}: {results[name]}")
+
+        if len(failed) == len(to_switch):
+            dispatcher.utter_message("Sorry, but I can't connect to the Shelly Device.")
+            return []
+
+        # The plugs send a notification once the relay actually switched
+        switched = [device for device in to_switch if device.name not in failed]
+        confirmed = await asyncio.gather(*[shelly_state.switch_mirror.wait_for(device, on) for device in switched])
+
+        if all(confirmed):
+            dispatcher.utter_message(f"The lights are {light_state}.")
+        else:
+            dispatcher.utter_message(f"Turning lights {light_state}.")
+
+        if failed:
+            dispatcher.utter_message(f"Couldn't reach {', '.join(failed)} though.")
 
         return []
 
-import aiohttp
-import asyncio
+
+class ActionTellLightState(Action):
+    """
+    Answers from the plugs' last reported state (see actions/api/shelly/state.py)
+    """
+    def name(self) -> Text:
+        return "action_tell_light_state"
+
+    @timed_action
+    @budgeted
+    async def run(self,
+                  dispatcher: CollectingDispatcher,
+                  tracker: Tracker,
+                  domain: Dict[Text, Any]
+                ) -> List[Dict[Text, Any]]:
+
+        devices, unknown_names = shelly_rpc.shelly_devices.resolve(list(tracker.get_latest_entity_values("device")))
+
+        if unknown_names:
+            dispatcher.utter_message(f"I don't know a device called {', '.join(unknown_names)}.")
+            return []
+
+        if not devices:
+            dispatcher.utter_message("There aren't any Shelly devices set up.")
+            return []
+
+        states = await shelly_state.switch_mirror.read(devices)
+        known = {name: state for name, state in states.items() if state is not None}
+
+        if not known:
+            dispatcher.utter_message("Sorry, but I can't connect to the Shelly Device.")
+            return []
+
+        if len(devices) == 1 or (len(set(known.values())) == 1 and len(known) == len(states)):
+            light_state = "on" if next(iter(known.values())) else "off"
+            dispatcher.utter_message(f"The lights are {light_state}.")
+            return []
+
+        on = [name for name, state in known.items() if state]
+        off = [name for name, state in known.items() if not state]
+        unknown = [name for name, state in states.items() if state is None]
+
+        if on:
+            dispatcher.utter_message(f"On: {', '.join(on)}.")
+        if off:
+            dispatcher.utter_message(f"Off: {', '.join(off)}.")
+        if unknown:
+            dispatcher.utter_message(f"Couldn't reach {', '.join(unknown)}.")
+
+        return []
 
 class ActionCheckTempAndStuff(Action):
     """
@@ -492,65 +700,91 @@ class ActionCheckTempAndStuff(Action):
     actually use it since it's in sleep mode for energy conservation reasons. REST
     API only works for like 3 minutes after you press the reset button until it hibernates.
 
+    So the REST API is only tried when the MQTT subscriber saw the device awake
+    recently (or doesn't know), and only for REST_DEADLINE seconds (or what's
+    left of the budget). Otherwise it's the last readings the subscriber got.
+
     https://shelly-api-docs.shelly.cloud/gen2/General/SleepManagementForBatteryDevices
     """
+    REST_DEADLINE = 1.5
+
     def name(self) -> Text:
         return "action_check_temp_and_stuff"
 
-    async def fetch_data(self, session, url):
-        response = await session.request(method="GET", url=url)
-        response.raise_for_status()
-        data = await response.json()
+    async def fetch_data(self, url):
+        data = await http.request_json("GET", url, upstream="shelly")
         return data
 
-    async def report_results(self):
+    async def report_results(self) -> Dict[Text, Any]:
         shelly_ip = os.environ['SHELLY_HT_IP']
 
-        urls = [
-            f"http://{shelly_ip}/rpc/Temperature.GetStatus?id=0",
-            f"http://{shelly_ip}/rpc/Humidity.GetStatus?id=0",
-            f"http://{shelly_ip}/rpc/DevicePower.GetStatus?id=0",
-        ]
-        
-        async with aiohttp.ClientSession() as session:
-            try:
-                tasks = [self.fetch_data(session, url) for url in urls]
-                results = await asyncio.gather(*tasks)
-            except Exception:
-                return []
+        # Same names as the MQTT topics, so apply_reading() works for both
+        urls = {
+            "temperature": f"http://{shelly_ip}/rpc/Temperature.GetStatus?id=0",
+            "humidity": f"http://{shelly_ip}/rpc/Humidity.GetStatus?id=0",
+            "devicepower": f"http://{shelly_ip}/rpc/DevicePower.GetStatus?id=0",
+        }
+
+        try:
+            tasks = [self.fetch_data(url) for url in urls.values()]
+            results = await asyncio.wait_for(asyncio.gather(*tasks), time_left(self.REST_DEADLINE))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            # ValueError: the device answered with something that isn't JSON
+            logging.debug(f"H&T REST API unavailable: {error!r}")
+            return {}
 
-        return results
+        readings = {}
+        for topic, result in zip(urls, results):
+            shelly_readings.apply_reading(readings, topic, result)
 
+        return readings
+
+    @timed_action
+    @budgeted
     async def run(self, 
                   dispatcher: CollectingDispatcher,
                   tracker: Tracker,
                   domain: Dict[Text, Any]
             ) -> List[Dict[Text, Any]]:
-        
-        results = await self.report_results()
 
-        logging.debug(results)
+        last_known = await shelly_readings.read_last_known(
+            os.environ.get("SHELLY_HT_SOCKET", shelly_readings.DEFAULT_SOCKET_PATH),
+            os.environ.get("SHELLY_HT_DATA_PATH", shelly_readings.DEFAULT_READINGS_PATH)
+        )
+        awake = shelly_readings.is_awake(last_known.get("availability"))
 
-        if not results:
-            # Read previous reading data if API not available 
-            json_file = os.path.join(os.getcwd(), "actions", "api", "shelly", "gen3_ht_data.json")
+        readings = await self.report_results() if awake is not False else {}
 
-            with open(json_file) as file:
-                json_data = json.load(file)
-            
-            dispatcher.utter_message(
-                "Unable to fetch REST API. Using previous readings instead "
-                f"(last updated {arrow.get(json_data['updatedAt']).humanize()})."
-            )
+        logging.debug(readings)
 
-            temp = f"The current indoor temp is {json_data.get('tF')}°F."
+        if not readings:
+            readings = last_known.get("readings", {})
+
+            if not readings:
+                dispatcher.utter_message("Sorry, I don't have any readings from the H&T yet.")
+                return []
+
+            updated = arrow.get(readings['updatedAt']).humanize()
+
+            if awake is False:
+                dispatcher.utter_message(f"The H&T is asleep, so here are its last readings (updated {updated}).")
+            else:
+                dispatcher.utter_message(
+                    "Unable to fetch REST API. Using previous readings instead "
+                    f"(last updated {updated})."
+                )
+
+        if readings.get('tF') is not None:
+            temp = f"The current indoor temp is {readings.get('tF')}°F."
             dispatcher.utter_message(text=temp)
 
-            humidity = f"Indoor humidity is at {json_data.get('rh')}%."
+        if readings.get('rh') is not None:
+            humidity = f"Indoor humidity is at {readings.get('rh')}%."
             dispatcher.utter_message(text=humidity)
 
-            battery_percent = json_data['battery']
-            is_charging = json_data['isCharging']
+        if readings.get('battery') is not None:
+            battery_percent = readings['battery']
+            is_charging = readings.get('isCharging')
 
             if battery_percent <= 25 and not is_charging:
                 dispatcher.utter_message(
@@ -562,28 +796,128 @@ class ActionCheckTempAndStuff(Action):
             else:
                 dispatcher.utter_message(text=f"Device battery is at {battery_percent}%.")
 
+        return []
+
+
+from datetime import timedelta
+
+shelly_history = lazy_import("actions.api.shelly.history")
+
+# Field in the history (see actions/api/shelly/history.py), how to show it, and unit
+SENSOR_METRICS = {
+    "temperature": ("tC", "indoor temp", "°F"),
+    "humidity": ("rh", "indoor humidity", "%"),
+    "battery": ("battery", "H&T battery", "%"),
+}
+
+
+def period_bounds(period: Text, now: datetime) -> tuple:
+    """ (start, end) Unix times for "overnight", "today", "yesterday", "last hour" or "this week" """
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if period == "overnight":
+        # 10 PM to 7 AM, last night's if it's over already
+        end = midnight + timedelta(hours=7)
+        start = end - timedelta(hours=9)
+        return start.timestamp(), min(end, now).timestamp()
+
+    if period == "today":
+        return midnight.timestamp(), now.timestamp()
+
+    if period == "yesterday":
+        return (midnight - timedelta(days=1)).timestamp(), midnight.timestamp()
+
+    if period == "last hour":
+        return (now - timedelta(hours=1)).timestamp(), now.timestamp()
+
+    if period == "this week":
+        return (now - timedelta(days=7)).timestamp(), now.timestamp()
+
+    return (now - timedelta(days=1)).timestamp(), now.timestamp()
+
+
+def to_fahrenheit(celsius: float) -> float:
+    return celsius * 9 / 5 + 32
+
+
+class ActionTellSensorHistory(Action):
+    """
+    "What was the average humidity overnight?" from the H&T's reading history
+    """
+    def name(self) -> Text:
+        return "action_tell_sensor_history"
+
+    @timed_action
+    @budgeted
+    async def run(self,
+                  dispatcher: CollectingDispatcher,
+                  tracker: Tracker,
+                  domain: Dict[Text, Any]
+                ) -> List[Dict[Text, Any]]:
+
+        metric = next(tracker.get_latest_entity_values("sensor_metric"), "temperature")
+        period = next(tracker.get_latest_entity_values("period"), None)
+        period_label = {None: "in the last 24 hours", "last hour": "in the last hour"}.get(period, period)
+
+        field, label, unit = SENSOR_METRICS.get(metric, SENSOR_METRICS["temperature"])
+        start, end = period_bounds(period or "", datetime.now().astimezone())
+
+        stats = shelly_history.history.stats(field, start, end)
+
+        if stats is None:
+            dispatcher.utter_message(f"I don't have any {label} readings {period_label}.")
+            return []
+
+        if field == "tC":
+            stats = {key: to_fahrenheit(stats[key]) for key in ("min", "max", "mean")}
+
+        dispatcher.utter_message(
+            f"The average {label} {period_label} was {stats['mean']:.1f}{unit} "
+            f"(low of {stats['min']:.1f}{unit}, high of {stats['max']:.1f}{unit})."
+        )
+
+        return []
+
+
+class ActionTellTempTrend(Action):
+    """
+    "Is it getting warmer?" from the slope of the last few hours of readings
+    """
+    # Hours to look back, and °F per hour that counts as a change
+    TREND_HOURS = 3
+    THRESHOLD = 0.3
+
+    def name(self) -> Text:
+        return "action_tell_temp_trend"
+
+    @timed_action
+    @budgeted
+    async def run(self,
+                  dispatcher: CollectingDispatcher,
+                  tracker: Tracker,
+                  domain: Dict[Text, Any]
+                ) -> List[Dict[Text, Any]]:
+
+        now = time.time()
+        slope = shelly_history.history.trend("tC", now - self.TREND_HOURS * 3600, now)
+
+        if slope is None:
+            dispatcher.utter_message("I don't have enough recent temperature readings to tell.")
+            return []
+
+        # Slope in °C per hour, a difference converts with just the 9/5
+        slope *= 9 / 5
+
+        if slope > self.THRESHOLD:
+            dispatcher.utter_message(f"Yes, it's getting warmer inside (about {slope:.1f}°F per hour).")
+        elif slope < -self.THRESHOLD:
+            dispatcher.utter_message(f"No, it's cooling down inside (about {-slope:.1f}°F per hour).")
         else:
-            for result in results:
-                if result.get('tF', None):
-                    temp = f"The current indoor temp is {result.get('tF')}°F."
-                    dispatcher.utter_message(text=temp)
-
-                elif result.get('rh', None):
-                    humidity = f"Indoor humidity is at {result.get('rh')}%."
-                    dispatcher.utter_message(text=humidity)
-
-                elif result.get('battery', None):
-                    battery_percent = result['battery']['percent']
-                    is_charging = result['external']['present']
-
-                    if battery_percent <= 25 and not is_charging:
-                        dispatcher.utter_message(
-                            text=(
-                                f"Keep in mind your battery is low ({battery_percent}%). "
-                                "Replace them soon!"
-                            )
-                        )
-                    else:
-                        dispatcher.utter_message(text=f"Device battery is at {battery_percent}%.")
-
-        return []
\ No newline at end of file
+            dispatcher.utter_message("The indoor temp is holding steady.")
+
+        return []
+
+
+# Import everything above in the background instead of on the first dispatch
+if os.environ.get("ACTIONS_WARMUP", "false").lower() == "true":
+    warm_up()
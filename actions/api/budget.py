@@ -0,0 +1,170 @@
+from typing import Any, Callable, Dict, Iterator, Optional
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import asyncio
+import logging
+import time
+import os
+
+from actions.api.metrics import metrics
+
+"""
+Deadline budgets, so every reply has a bounded worst-case latency.
+
+Each action run gets a budget (ACTION_BUDGET seconds, see budget_for()),
+started by @budgeted. It's kept in a context variable, so every upstream call
+made on the action's behalf (request_json(), Shelly RPC, Mistral's queue) can
+see how much time is left without it being passed through every wrapper.
+Tasks started from the action (asyncio.gather(), create_task()) inherit it.
+
+Chained calls split what's left with share(), e.g. geocoding gets half of the
+budget so there's still time to ask for the weather:
+
+    with share(0.5):
+        coords = await self.get_coordinates(location)
+
+Outside of an action (scripts, background refreshes) requests get
+UPSTREAM_TIMEOUT seconds each, so nothing waits on a hung upstream forever.
+
+If the action is still running HARD_STOP_GRACE seconds past its budget, it's
+cancelled and the user gets whatever it already said plus OUT_OF_TIME.
+
+See: https://research.google/pubs/the-tail-at-scale/
+"""
+
+# Seconds per action run, overridable per action with e.g.
+# ACTION_BUDGETS="action_say_weather=3,action_check_manga_updates=10"
+DEFAULT_BUDGET = float(os.environ.get("ACTION_BUDGET", 5))
+
+# Mistral's queue and retries already allow for MISTRAL_DEADLINE (20s), and a
+# feed backlog can take a few spaced out pages
+BUDGETS = {
+    "action_make_conversation": 20.0,
+    "action_check_manga_updates": 8.0,
+}
+
+# Seconds per request when there's no budget
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", 10))
+
+# aiohttp rounds timeouts over 5s up to the next whole second, the requests'
+# own timeouts (and the fallbacks after them) should get to go first
+HARD_STOP_GRACE = 1.5
+
+OUT_OF_TIME = "Sorry, that's taking longer than it should. Try again in a bit."
+
+
+class Budget(object):
+    """ Time left until a monotonic deadline, never past the enclosing budget's """
+    def __init__(self, seconds: float, parent: Optional["Budget"] = None):
+        self.deadline = time.monotonic() + max(seconds, 0.0)
+
+        if parent is not None:
+            self.deadline = min(self.deadline, parent.deadline)
+
+    def remaining(self) -> float:
+        return max(self.deadline - time.monotonic(), 0.0)
+
+
+_current: ContextVar[Optional[Budget]] = ContextVar("budget", default=None)
+
+
+def _parse_budgets(value: str) -> Dict[str, float]:
+    """ "action_a=3,action_b=10" -> {"action_a": 3.0, "action_b": 10.0} """
+    budgets = {}
+
+    for entry in value.split(","):
+        name, _, seconds = entry.partition("=")
+
+        try:
+            budgets[name.strip()] = float(seconds)
+        except ValueError:
+            if entry.strip():
+                logging.warning(f"Ignoring ACTION_BUDGETS entry '{entry.strip()}'")
+
+    return budgets
+
+
+BUDGETS.update(_parse_budgets(os.environ.get("ACTION_BUDGETS", "")))
+
+
+def budget_for(action: str) -> float:
+    return BUDGETS.get(action, DEFAULT_BUDGET)
+
+
+def time_left(cap: Optional[float] = None) -> float:
+    """
+    Seconds left of the current budget, at most `cap`. Without a budget
+    it's `cap`, or UPSTREAM_TIMEOUT if that's not given either.
+    """
+    budget = _current.get()
+
+    if budget is None:
+        return cap if cap is not None else UPSTREAM_TIMEOUT
+
+    return budget.remaining() if cap is None else min(budget.remaining(), cap)
+
+
+@contextmanager
+def within(seconds: float) -> Iterator[Budget]:
+    """ A budget of `seconds` for the block, cut short by the enclosing one """
+    budget = Budget(seconds, _current.get())
+    token = _current.set(budget)
+
+    try:
+        yield budget
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def share(fraction: float) -> Iterator[Optional[Budget]]:
+    """ `fraction` of what's left for the block, so later calls still get the rest """
+    budget = _current.get()
+
+    if budget is None:
+        yield None
+        return
+
+    with within(budget.remaining() * fraction) as shared:
+        yield shared
+
+
+@contextmanager
+def unbounded() -> Iterator[None]:
+    """
+    Tasks created in the block don't inherit the current budget. For work
+    that outlives the action, like cache refreshes and token renewal.
+    """
+    token = _current.set(None)
+
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def budgeted(run: Callable) -> Callable:
+    """
+    Decorator for Action.run, runs it within budget_for(its name). Goes under
+    @timed_action so the time taken to give up is measured too.
+    """
+    @functools.wraps(run)
+    async def budgeted_run(self, dispatcher, tracker, domain) -> Any:
+        name = self.name()
+
+        with within(budget_for(name)) as budget:
+            try:
+                # wait_for runs it as a task, which copies the context with the budget in it
+                return await asyncio.wait_for(
+                    run(self, dispatcher, tracker, domain), budget.remaining() + HARD_STOP_GRACE
+                )
+            except asyncio.TimeoutError:
+                logging.warning(f"{name} timed out within its {budget_for(name):g}s budget")
+                metrics.inc("action_budget_exceeded_total", action=name)
+
+                # Anything it already said (e.g. half of a list) still goes out
+                dispatcher.utter_message(text=OUT_OF_TIME)
+                return []
+
+    return budgeted_run
@@ -0,0 +1,356 @@
+from typing import List, Dict, Any, Optional, Tuple
+import unicodedata
+import difflib
+import logging
+import zlib
+import mmap
+import sys
+import os
+
+import numpy as np
+
+"""
+Offline geocoder built from a GeoNames dump, consulted before OpenWeather's
+geocoding API so well known places never touch the network.
+
+Download one of the city dumps (cities500.zip is a good size/coverage
+trade-off, allCountries.zip works too) from
+https://download.geonames.org/export/dump/
+and compile it once with
+
+`python -m actions.api.gazetteer build cities500.txt`
+
+The compiled index is a directory of flat files that are memory-mapped on the
+first lookup, so nothing is read at startup and the OS only pages in the parts
+that binary searches touch:
+
+keys.bin          sorted, normalized names (UTF-8, concatenated)
+key_offsets.npy   key i is keys.bin[key_offsets[i]:key_offsets[i + 1]]
+key_places.npy    place id for every key (a place has one key per alt name)
+coords.npy        (lat, lon) float32 per place
+population.npy    uint32 per place, used to rank ambiguous names
+countries.npy     ISO 3166 country code per place
+names.bin         display name per place, same layout as keys.bin
+name_offsets.npy
+gram_hashes.npy   sorted crc32 of every trigram in the places' own names
+gram_offsets.npy  keys (by position in keys.bin) with trigram i are
+gram_keys.npy       gram_keys[gram_offsets[i]:gram_offsets[i + 1]]
+
+The trigram index is what fuzzy() finds misspellings with. It only covers
+the names places are listed under (not every alternate name), which keeps it
+to a few times the size of the names themselves.
+"""
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(__file__), "data", "gazetteer")
+
+# GeoNames dump columns, see "geoname" table at https://download.geonames.org/export/dump/
+NAME, ASCII_NAME, ALTERNATE_NAMES, LATITUDE, LONGITUDE = 1, 2, 3, 4, 5
+FEATURE_CLASS, COUNTRY, POPULATION = 6, 8, 14
+
+# A typo changes at most 3 of a name's trigrams, so a misspelling with up to
+# this many typos still shares some with the name (more typos for longer names)
+FUZZY_EDITS = ((6, 1), (12, 2))
+FUZZY_MAX_EDITS = 3
+
+# Candidates (most shared trigrams first) compared with difflib per lookup
+FUZZY_CANDIDATES = 50
+
+
+def normalize(name: str) -> str:
+    """ "São  Paulo" -> "sao paulo" """
+    decomposed = unicodedata.normalize("NFKD", name.casefold())
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.split())
+
+
+def trigrams(key: str) -> List[int]:
+    """ "tokyo" -> crc32 of "^to", "tok", "oky", "kyo", "yo$" """
+    padded = f"^{key}$"
+    return sorted({zlib.crc32(padded[i:i + 3].encode("utf-8")) for i in range(len(padded) - 2)})
+
+
+def _max_edits(key: str) -> int:
+    for length, edits in FUZZY_EDITS:
+        if len(key) <= length:
+            return edits
+
+    return FUZZY_MAX_EDITS
+
+
+class Gazetteer(object):
+
+    def __init__(self, index_path: str = DEFAULT_INDEX_PATH):
+        self._index_path = index_path
+        self._loaded = False
+        self._available = False
+
+    @property
+    def available(self) -> bool:
+        self._load()
+        return self._available
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+
+        self._loaded = True
+
+        if not os.path.exists(os.path.join(self._index_path, "keys.bin")):
+            return
+
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(self._index_path, name), mmap_mode="r")
+
+        def map_bytes(name: str) -> mmap.mmap:
+            with open(os.path.join(self._index_path, name), "rb") as file:
+                return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # A half built (or emptied) index can't be mapped, OpenWeather answers instead
+        try:
+            self._keys = map_bytes("keys.bin")
+            self._key_offsets = load("key_offsets.npy")
+            self._key_places = load("key_places.npy")
+            self._coords = load("coords.npy")
+            self._population = load("population.npy")
+            self._countries = load("countries.npy")
+            self._names = map_bytes("names.bin")
+            self._name_offsets = load("name_offsets.npy")
+
+            # Indexes built before fuzzy() had one only support exact lookups
+            self._grams = os.path.exists(os.path.join(self._index_path, "gram_hashes.npy"))
+
+            if self._grams:
+                self._gram_hashes = load("gram_hashes.npy")
+                self._gram_offsets = load("gram_offsets.npy")
+                self._gram_keys = load("gram_keys.npy")
+
+        except (OSError, ValueError) as error:
+            logging.warning(f"Gazetteer at {self._index_path} is unusable, rebuild it: {error}")
+            return
+
+        self._available = True
+
+        logging.debug(f"Loaded gazetteer with {len(self._key_places)} names from {self._index_path}")
+
+    def _key(self, i: int) -> bytes:
+        return self._keys[self._key_offsets[i]:self._key_offsets[i + 1]]
+
+    def _lower_bound(self, target: bytes) -> int:
+        lo, hi = 0, len(self._key_places)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def _place(self, place_id: int) -> Dict[str, Any]:
+        name = self._names[self._name_offsets[place_id]:self._name_offsets[place_id + 1]]
+        latitude, longitude = self._coords[place_id]
+
+        return {
+            "name": name.decode("utf-8"),
+            # float32 keeps ~1m precision, don't show the noise past that
+            "lat": round(float(latitude), 5),
+            "lon": round(float(longitude), 5),
+            "country": self._countries[place_id].decode("ascii"),
+            "population": int(self._population[place_id]),
+        }
+
+    def _rank(self, place_ids: List[int], country: Optional[str], limit: int) -> List[Dict[str, Any]]:
+        place_ids = list(dict.fromkeys(place_ids))
+
+        if country:
+            wanted = country.upper().encode("ascii")
+            place_ids = [p for p in place_ids if self._countries[p] == wanted]
+
+        place_ids.sort(key=lambda p: -int(self._population[p]))
+
+        return [self._place(p) for p in place_ids[:limit]]
+
+    @staticmethod
+    def _split_country(query: str) -> Tuple[str, Optional[str]]:
+        """ "Paris, FR" -> ("Paris", "FR") """
+        name, _, suffix = query.rpartition(",")
+        suffix = suffix.strip()
+
+        if name and len(suffix) == 2 and suffix.isalpha():
+            return name, suffix
+
+        return query, None
+
+    def lookup(self, query: str, limit: int = 1) -> List[Dict[str, Any]]:
+        """
+        Exact (normalized) name matches, most populous first. Same shape as
+        OpenWeather's geocoding response.
+        """
+        self._load()
+        if not self._available:
+            return []
+
+        name, country = self._split_country(query)
+        key = normalize(name).encode("utf-8")
+
+        place_ids = []
+        i = self._lower_bound(key)
+
+        while i < len(self._key_places) and self._key(i) == key:
+            place_ids.append(int(self._key_places[i]))
+            i += 1
+
+        return self._rank(place_ids, country, limit)
+
+    def _candidates(self, key: str) -> np.ndarray:
+        """ Keys sharing enough trigrams with `key` to be a few typos away, best first """
+        grams = np.array(trigrams(key), dtype=np.uint32)
+
+        positions = np.searchsorted(self._gram_hashes, grams)
+
+        # Trigrams no listed name has
+        found = positions < len(self._gram_hashes)
+        found[found] = self._gram_hashes[positions[found]] == grams[found]
+        positions = positions[found]
+
+        if not len(positions):
+            return positions
+
+        postings = np.concatenate([
+            self._gram_keys[self._gram_offsets[p]:self._gram_offsets[p + 1]] for p in positions
+        ])
+        keys, shared = np.unique(postings, return_counts=True)
+
+        # Each typo changes at most 3 trigrams
+        needed = max(1, len(grams) - 3 * _max_edits(key))
+        keys, shared = keys[shared >= needed], shared[shared >= needed]
+
+        # Ties go to names about as long as the query (lengths in bytes, close enough)
+        lengths = self._key_offsets[keys + 1].astype(np.int64) - self._key_offsets[keys].astype(np.int64)
+        length_gap = np.abs(lengths - len(key.encode("utf-8")))
+
+        return keys[np.lexsort((length_gap, -shared))[:FUZZY_CANDIDATES]]
+
+    def fuzzy(self, query: str, limit: int = 5, cutoff: float = 0.8) -> List[Dict[str, Any]]:
+        """
+        Close matches for misspellings ("Tokio", "Barcelonna"). Only names that
+        share enough trigrams to be a few typos away are compared, see the
+        trigram index above.
+        """
+        self._load()
+        if not self._available or not self._grams:
+            return []
+
+        name, country = self._split_country(query)
+        key = normalize(name)
+        if not key:
+            return []
+
+        matcher = difflib.SequenceMatcher(b=key)
+        scored: Dict[int, float] = {}
+
+        for i in self._candidates(key):
+            matcher.set_seq1(self._key(int(i)).decode("utf-8"))
+
+            if matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff:
+                score = matcher.ratio()
+                if score >= cutoff:
+                    place_id = int(self._key_places[i])
+                    scored[place_id] = max(score, scored.get(place_id, 0))
+
+        ranked = sorted(scored, key=lambda p: (-scored[p], -int(self._population[p])))
+
+        return self._rank(ranked[:limit * 10], country, limit)
+
+
+gazetteer = Gazetteer(os.environ.get("GAZETTEER_PATH", DEFAULT_INDEX_PATH))
+
+
+def build_index(dump_path: str, index_path: str = DEFAULT_INDEX_PATH,
+                alternate_names: bool = True) -> None:
+    """
+    Compiles a GeoNames dump into the memory-mapped index described above.
+    Only populated places and administrative areas (feature class P and A)
+    are kept.
+    """
+    # (key, place id, whether it's a name the place is listed under)
+    keys: List[Tuple[bytes, int, bool]] = []
+    names: List[bytes] = []
+    coords: List[Tuple[float, float]] = []
+    population: List[int] = []
+    countries: List[bytes] = []
+
+    with open(dump_path, encoding="utf-8") as file:
+        for line in file:
+            row = line.rstrip("\n").split("\t")
+
+            if len(row) <= POPULATION or row[FEATURE_CLASS] not in ("P", "A"):
+                continue
+
+            place_id = len(names)
+
+            names.append(row[NAME].encode("utf-8"))
+            coords.append((float(row[LATITUDE]), float(row[LONGITUDE])))
+            population.append(int(row[POPULATION] or 0))
+            countries.append(row[COUNTRY].encode("ascii"))
+
+            listed = {normalize(row[NAME]), normalize(row[ASCII_NAME])}
+            aliases = set(listed)
+            if alternate_names and row[ALTERNATE_NAMES]:
+                aliases.update(normalize(alias) for alias in row[ALTERNATE_NAMES].split(","))
+
+            for key in aliases:
+                if key:
+                    keys.append((key.encode("utf-8"), place_id, key in listed))
+
+    keys.sort()
+
+    os.makedirs(index_path, exist_ok=True)
+
+    def write_strings(strings: List[bytes], blob_name: str, offsets_name: str) -> None:
+        with open(os.path.join(index_path, blob_name), "wb") as file:
+            file.write(b"".join(strings))
+
+        offsets = np.zeros(len(strings) + 1, dtype=np.uint64)
+        np.cumsum([len(s) for s in strings], out=offsets[1:])
+        np.save(os.path.join(index_path, offsets_name), offsets)
+
+    write_strings([key for key, _, _ in keys], "keys.bin", "key_offsets.npy")
+    write_strings(names, "names.bin", "name_offsets.npy")
+
+    np.save(os.path.join(index_path, "key_places.npy"),
+            np.array([place_id for _, place_id, _ in keys], dtype=np.uint32))
+
+    # Trigram -> keys, as (trigram, key position) pairs sorted by trigram
+    gram_hashes, gram_keys = [], []
+
+    for i, (key, _, listed) in enumerate(keys):
+        if listed:
+            grams = trigrams(key.decode("utf-8"))
+            gram_hashes.extend(grams)
+            gram_keys.extend([i] * len(grams))
+
+    gram_hashes = np.array(gram_hashes, dtype=np.uint32)
+    gram_keys = np.array(gram_keys, dtype=np.uint32)
+
+    order = np.argsort(gram_hashes, kind="stable")
+    gram_hashes, gram_keys = gram_hashes[order], gram_keys[order]
+
+    unique, starts = np.unique(gram_hashes, return_index=True)
+    offsets = np.append(starts, len(gram_hashes)).astype(np.uint64)
+
+    np.save(os.path.join(index_path, "gram_hashes.npy"), unique)
+    np.save(os.path.join(index_path, "gram_offsets.npy"), offsets)
+    np.save(os.path.join(index_path, "gram_keys.npy"), gram_keys)
+    np.save(os.path.join(index_path, "coords.npy"), np.array(coords, dtype=np.float32))
+    np.save(os.path.join(index_path, "population.npy"), np.array(population, dtype=np.uint32))
+    np.save(os.path.join(index_path, "countries.npy"), np.array(countries, dtype="S2"))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "build":
+        print("Usage: python -m actions.api.gazetteer build <geonames dump> [index dir]")
+        sys.exit(1)
+
+    build_index(*sys.argv[2:4])
@@ -0,0 +1,201 @@
+from typing import Any, Dict, Optional
+from collections import deque
+from urllib.parse import urlsplit
+import asyncio
+import math
+import time
+
+import aiohttp
+
+from actions.api.budget import time_left
+from actions.api.metrics import metrics
+from actions.api.rate_limit import is_retryable
+
+"""
+Every API wrapper goes through one process-wide aiohttp session instead of
+opening a new connection per request. The connector keeps connections alive
+between conversations and caches DNS lookups, so repeated calls to the same
+upstream (OpenWeather, MangaDex, Mistral, Shelly) skip the TCP/TLS handshake.
+
+Every request times out with the current action's budget (see budget.py).
+Idempotent requests to public APIs can be hedged: if there's no answer by
+the time most answers from that upstream have arrived (its recent p95), the
+same request is sent again and whichever answers first wins. A request that
+fails fast (connection refused, 503) is retried instead, as long as there's
+time left for it.
+
+See:
+https://docs.aiohttp.org/en/stable/client_advanced.html#connectors
+https://docs.aiohttp.org/en/stable/client_advanced.html#client-session
+https://research.google/pubs/the-tail-at-scale/
+"""
+
+# Total connections across all hosts and connections to a single host
+POOL_LIMIT = 100
+POOL_LIMIT_PER_HOST = 20
+
+# Seconds to remember resolved hostnames and keep idle connections open
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 60
+
+# Hedge after this percentile of an upstream's last HEDGE_WINDOW answers, or
+# after HEDGE_DELAY until there are HEDGE_MIN_SAMPLES of them
+HEDGE_PERCENTILE = 95
+HEDGE_WINDOW = 100
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DELAY = 0.5
+HEDGE_MIN_DELAY = 0.05
+
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    Returns the shared session, creating it on first use.
+
+    A session is bound to the event loop it was created in, so a new one is
+    made if the loop changed (e.g. scripts calling asyncio.run() repeatedly).
+    """
+    global _session, _session_loop
+
+    loop = asyncio.get_running_loop()
+
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=POOL_LIMIT,
+            limit_per_host=POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+        _session_loop = loop
+
+    return _session
+
+
+async def close_session() -> None:
+    global _session, _session_loop
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+    _session = None
+    _session_loop = None
+
+
+class HedgeDelays(object):
+    """ When to hedge a request, from each upstream's recent latencies """
+
+    def __init__(self, window: int = HEDGE_WINDOW):
+        self._window = window
+        self._latencies: Dict[str, deque] = {}
+
+    def observe(self, upstream: str, seconds: float) -> None:
+        latencies = self._latencies.get(upstream)
+
+        if latencies is None:
+            latencies = self._latencies[upstream] = deque(maxlen=self._window)
+
+        latencies.append(seconds)
+
+    def delay(self, upstream: str) -> float:
+        latencies = sorted(self._latencies.get(upstream, ()))
+
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DELAY
+
+        # Nearest rank
+        rank = max(math.ceil(HEDGE_PERCENTILE / 100 * len(latencies)) - 1, 0)
+        return max(latencies[rank], HEDGE_MIN_DELAY)
+
+
+hedge_delays = HedgeDelays()
+
+
+async def _request(method: str, url: str, upstream: str, **kwargs: Any) -> Any:
+    timeout = time_left()
+
+    if timeout <= 0:
+        raise asyncio.TimeoutError(f"No time left to ask {upstream}")
+
+    session = get_session()
+    start = time.perf_counter()
+
+    with metrics.measure("upstream", upstream):
+        async with session.request(method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as response:
+            response.raise_for_status()
+            # Some upstreams (e.g. Shelly) don't send application/json
+            body = await response.json(content_type=None)
+
+    hedge_delays.observe(upstream, time.perf_counter() - start)
+
+    return body
+
+
+async def _hedged(method: str, url: str, upstream: str, **kwargs: Any) -> Any:
+    delay = hedge_delays.delay(upstream)
+    attempts = [asyncio.ensure_future(_request(method, url, upstream, **kwargs))]
+
+    try:
+        done, pending = await asyncio.wait(attempts, timeout=delay)
+
+        # Slower than usual, ask again if a second answer could still make it in time
+        if not done and time_left() > delay:
+            metrics.inc("upstream_hedges_total", upstream=upstream)
+            attempts.append(asyncio.ensure_future(_request(method, url, upstream, **kwargs)))
+
+        pending = {attempt for attempt in attempts if not attempt.done()}
+        done = [attempt for attempt in attempts if attempt.done()]
+
+        while True:
+            for attempt in done:
+                error = attempt.exception()
+
+                if error is None:
+                    return attempt.result()
+
+                if not is_retryable(error):
+                    raise error
+
+            if not pending:
+                # Failed fast, one retry if there's time for it
+                if len(attempts) > 1 or time_left() <= delay:
+                    raise error
+
+                metrics.inc("upstream_retries_total", upstream=upstream)
+                attempts.append(asyncio.ensure_future(_request(method, url, upstream, **kwargs)))
+                pending = {attempts[-1]}
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+    finally:
+        # The slower copy isn't needed anymore, and its error (if any) was seen
+        for attempt in attempts:
+            if attempt.done() and not attempt.cancelled():
+                attempt.exception()
+            attempt.cancel()
+
+
+async def request_json(method: str, url: str, upstream: Optional[str] = None, hedge: bool = False,
+                       **kwargs: Any) -> Any:
+    """
+    Sends a request through the shared session and returns the decoded JSON body.
+
+    Raises aiohttp.ClientResponseError on 4xx/5xx, aiohttp.ClientError on
+    connection problems and asyncio.TimeoutError once the current budget
+    (see budget.py) runs out.
+
+    `hedge` sends the request again if it's slower than usual, or retries it
+    if it fails fast. Only for idempotent requests to upstreams that don't
+    mind the extra load.
+
+    The request is timed under `upstream` (the host by default) in
+    actions/api/metrics.py.
+    """
+    upstream = upstream or urlsplit(url).hostname
+
+    if hedge:
+        return await _hedged(method, url, upstream, **kwargs)
+
+    return await _request(method, url, upstream, **kwargs)
@@ -0,0 +1,175 @@
+from typing import List, Dict, Any, Optional
+from collections import OrderedDict, deque
+import asyncio
+import logging
+import os
+
+import aiohttp
+
+from actions.api.budget import time_left, unbounded
+from actions.api.http import request_json
+from actions.api.metrics import metrics
+
+"""
+Jokes are fetched from JokeAPI ten at a time and kept in a pool per category,
+so telling one is a lookup in memory instead of two round trips (the jokeapi
+package initializes its client over the network before every joke).
+
+Once a category's pool runs low it's refilled in the background. Every
+conversation remembers the jokes it was told so it doesn't hear the same one
+twice in a row.
+
+See: https://v2.jokeapi.dev/#joke-endpoint
+"""
+
+JOKE_URL = os.environ.get("JOKEAPI_URL", "https://v2.jokeapi.dev") + "/joke/{category}"
+
+CATEGORIES = ("Any", "Misc", "Programming", "Pun", "Spooky", "Christmas")
+
+# Jokes per request (JokeAPI allows up to 10), and how few are left before refilling
+BATCH_SIZE = 10
+LOW_WATER = 3
+
+# Jokes remembered per conversation, and how many conversations are remembered
+RECENT_PER_SENDER = 50
+MAX_SENDERS = 1000
+
+
+def resolve_category(name: str) -> Optional[str]:
+    """ "programming" -> "Programming", None if JokeAPI doesn't have it """
+    for category in CATEGORIES:
+        if category.lower() == name.strip().lower():
+            return category
+
+    return None
+
+
+class JokePool(object):
+
+    def __init__(self, batch_size: int = BATCH_SIZE, low_water: int = LOW_WATER):
+        self._batch_size = batch_size
+        self._low_water = low_water
+
+        self._pools: Dict[str, deque] = {category: deque() for category in CATEGORIES}
+        self._refills: Dict[str, asyncio.Task] = {}
+        self._recent: "OrderedDict[str, deque]" = OrderedDict()
+
+        # Jokes told straight from the pool, and ones that had to wait for JokeAPI
+        self.hits = 0
+        self.misses = 0
+
+    async def _fetch(self, category: str) -> List[Dict[str, Any]]:
+        params = {"safe-mode": "", "amount": self._batch_size}
+        response = await request_json(
+            "GET", JOKE_URL.format(category=category), upstream="jokeapi", params=params, hedge=True
+        )
+
+        if response.get("error"):
+            logging.error(f"JokeAPI error: {response.get('message')} ({response.get('additionalInfo')})")
+            return []
+
+        # A single joke comes back on its own instead of in a list
+        return response.get("jokes", [response])
+
+    async def _refill_now(self, category: str) -> None:
+        try:
+            jokes = await self._fetch(category)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            logging.error(f"Unable to refill {category} jokes: {error}")
+            return
+
+        pool = self._pools[category]
+        pooled = {joke["id"] for joke in pool}
+
+        pool.extend(joke for joke in jokes if joke["id"] not in pooled)
+
+        logging.debug(f"{category} joke pool refilled to {len(pool)}")
+
+    def _refill(self, category: str) -> asyncio.Task:
+        """ Starts a refill unless one is already running, which is returned instead """
+        task = self._refills.get(category)
+
+        if task is None or task.done():
+            task = asyncio.get_running_loop().create_task(self._refill_now(category))
+            self._refills[category] = task
+
+        return task
+
+    def _told(self, sender_id: str) -> deque:
+        told = self._recent.get(sender_id)
+
+        if told is None:
+            told = deque(maxlen=RECENT_PER_SENDER)
+
+        self._recent[sender_id] = told
+        self._recent.move_to_end(sender_id)
+
+        while len(self._recent) > MAX_SENDERS:
+            self._recent.popitem(last=False)
+
+        return told
+
+    def _take(self, category: str, told: deque) -> Optional[Dict[str, Any]]:
+        pool = self._pools[category]
+
+        for i, joke in enumerate(pool):
+            if joke["id"] not in told:
+                del pool[i]
+                return joke
+
+        return None
+
+    async def get(self, category: str, sender_id: str) -> Optional[Dict[str, Any]]:
+        """
+        A joke from `category` (see resolve_category) this sender hasn't heard
+        recently, or None if JokeAPI can't be reached.
+        """
+        told = self._told(sender_id)
+        joke = self._take(category, told)
+
+        if joke is None:
+            # Empty, or everything left was told already
+            self.misses += 1
+
+            # Shared with whoever else is waiting, one of them giving up mustn't cancel it for the rest
+            try:
+                await asyncio.wait_for(asyncio.shield(self._refill(category)), time_left())
+            except asyncio.TimeoutError:
+                logging.warning(f"No {category} jokes in time")
+
+            joke = self._take(category, told)
+        else:
+            self.hits += 1
+
+        if joke is None and self._pools[category]:
+            # They've heard everything JokeAPI had to offer
+            joke = self._pools[category].popleft()
+
+        if len(self._pools[category]) < self._low_water:
+            # For the next ask, so not held to this action's budget
+            with unbounded():
+                self._refill(category)
+
+        if joke is not None:
+            told.append(joke["id"])
+
+        return joke
+
+    async def warm(self, categories: Optional[List[str]] = None) -> None:
+        """ Fills the pools ahead of the first joke """
+        await asyncio.gather(*[self._refill(category) for category in categories or CATEGORIES])
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "pooled": {category: len(pool) for category, pool in self._pools.items()},
+        }
+
+
+joke_pool = JokePool()
+
+metrics.register_cache("jokes", joke_pool.stats)
@@ -0,0 +1,77 @@
+from typing import Any, Iterable, Optional
+import importlib
+import threading
+import logging
+import time
+
+"""
+Defers imports until a module is actually used, so `rasa run actions` starts
+serving without paying for NumPy, aiohttp, arrow and every API wrapper up
+front. Modules are imported on the first attribute access, i.e. when an
+action that needs them runs for the first time:
+
+    mistral = lazy_import("actions.api.mistral")
+    ...
+    await mistral.conversate_with_user(messages)   # imported here
+
+warm_up() imports them on a background thread instead, so the first
+dispatch doesn't pay for it either (ACTIONS_WARMUP=true). Modules with a
+preload() function (e.g. timezones' boundary index) get it called there too.
+
+Measure the effect with `python benchmarks/startup.py`.
+"""
+
+
+class LazyModule(object):
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module: Optional[Any] = None
+
+    def load(self) -> Any:
+        if self._module is None:
+            # import_module holds the module's import lock, so the warm-up
+            # thread and a dispatch importing at the same time is fine
+            self._module = importlib.import_module(self._name)
+
+        return self._module
+
+    def __getattr__(self, attribute: str) -> Any:
+        return getattr(self.load(), attribute)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+_lazy_modules = []
+
+
+def lazy_import(name: str) -> LazyModule:
+    module = LazyModule(name)
+    _lazy_modules.append(module)
+    return module
+
+
+def warm_up(modules: Optional[Iterable[LazyModule]] = None) -> threading.Thread:
+    """ Imports lazy modules on a daemon thread, off the serving path """
+    modules = list(modules or _lazy_modules)
+
+    def load_all() -> None:
+        start = time.perf_counter()
+
+        for module in modules:
+            try:
+                preload = getattr(module.load(), "preload", None)
+
+                if preload is not None:
+                    preload()
+            except Exception:
+                logging.exception(f"Warm-up failed to import {module._name}")
+
+        logging.info(f"Warmed up {len(modules)} modules in {time.perf_counter() - start:.2f}s")
+
+    thread = threading.Thread(target=load_all, name="actions-warm-up", daemon=True)
+    thread.start()
+
+    return thread
@@ -0,0 +1,138 @@
+from typing import List, Dict, Any, Optional, Tuple
+from collections import OrderedDict, deque
+import math
+import re
+import os
+
+"""
+Keeps the chat history sent to Mistral within a token budget, no matter how
+long a conversation goes on.
+
+Each sender gets a message log that's only extended with tracker events it
+hasn't seen yet, instead of rescanning tracker.events every turn. Once the log
+goes over budget, the oldest messages slide out of the window and a short
+line about each is kept in a rolling summary (which itself is capped), so the
+model still knows roughly what was talked about earlier.
+"""
+
+# Words, numbers and single punctuation marks
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# Where to cut a message down to its first sentence for the summary
+SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+def count_tokens(text: str) -> int:
+    """
+    Approximate token count. Mistral's SentencePiece tokenizer averages about
+    4 characters per token for English, so long words count as several.
+    """
+    return sum(math.ceil(len(token) / 4) for token in TOKEN_PATTERN.findall(text))
+
+
+def _summary_line(message: Dict[str, Any], max_chars: int = 120) -> str:
+    first_sentence = SENTENCE_END.split(message["content"].strip(), maxsplit=1)[0]
+
+    if len(first_sentence) > max_chars:
+        first_sentence = first_sentence[:max_chars].rstrip() + "..."
+
+    speaker = "User" if message["role"] == "user" else "You"
+    return f"{speaker}: {first_sentence}"
+
+
+class ConversationLog(object):
+
+    def __init__(self):
+        self.messages: deque = deque()
+        self.message_tokens: deque = deque()
+        self.tokens = 0
+
+        self.summary: deque = deque()
+        self.summary_tokens = 0
+
+        # How many tracker events were processed, and the last one's timestamp
+        # to notice when the tracker was reset (e.g. a new session)
+        self.seen_events = 0
+        self.last_timestamp: Optional[float] = None
+
+
+class ContextManager(object):
+
+    def __init__(self, token_budget: int = 2000, summary_budget: int = 300, max_senders: int = 1000):
+        self.token_budget = token_budget
+        self.summary_budget = summary_budget
+        self._max_senders = max_senders
+        self._logs: "OrderedDict[str, ConversationLog]" = OrderedDict()
+
+    def _get_log(self, sender_id: str, events: List[Dict[str, Any]]) -> ConversationLog:
+        log = self._logs.get(sender_id)
+
+        is_stale = log is not None and (
+            len(events) < log.seen_events or
+            (log.seen_events and events[log.seen_events - 1].get("timestamp") != log.last_timestamp)
+        )
+
+        if log is None or is_stale:
+            log = ConversationLog()
+
+        self._logs[sender_id] = log
+        self._logs.move_to_end(sender_id)
+
+        while len(self._logs) > self._max_senders:
+            self._logs.popitem(last=False)
+
+        return log
+
+    def _summarize(self, log: ConversationLog, message: Dict[str, Any]) -> None:
+        line = _summary_line(message)
+        tokens = count_tokens(line)
+
+        log.summary.append((line, tokens))
+        log.summary_tokens += tokens
+
+        # Rolling summary: the oldest lines go first
+        while log.summary_tokens > self.summary_budget and log.summary:
+            _, dropped = log.summary.popleft()
+            log.summary_tokens -= dropped
+
+    def update(self, sender_id: str, events: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Adds events newer than the last call and returns (messages, summary)
+        to send, where summary is None until something slid out of the window.
+        """
+        log = self._get_log(sender_id, events)
+
+        for event in events[log.seen_events:]:
+            if event.get("event") == "user":
+                role = "user"
+            elif event.get("event") == "bot":
+                role = "assistant"
+            else:
+                continue
+
+            message = {"role": role, "content": f"{event.get('text')}"}
+            tokens = count_tokens(message["content"])
+
+            log.messages.append(message)
+            log.message_tokens.append(tokens)
+            log.tokens += tokens
+
+        if events:
+            log.seen_events = len(events)
+            log.last_timestamp = events[-1].get("timestamp")
+
+        # Always keep the latest message, even if it alone is over budget
+        while log.tokens + log.summary_tokens > self.token_budget and len(log.messages) > 1:
+            message = log.messages.popleft()
+            log.tokens -= log.message_tokens.popleft()
+            self._summarize(log, message)
+
+        summary = "\n".join(line for line, _ in log.summary) or None
+
+        return list(log.messages), summary
+
+
+conversation_context = ContextManager(
+    token_budget=int(os.environ.get("MISTRAL_CONTEXT_TOKENS", 2000)),
+    summary_budget=int(os.environ.get("MISTRAL_SUMMARY_TOKENS", 300)),
+)
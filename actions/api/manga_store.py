@@ -0,0 +1,226 @@
+from typing import List, Dict, Any, Optional, Iterable, Set
+import os
+import json
+import time
+import sqlite3
+
+"""
+Local copy of the followed manga feed so chapter lists are served from SQLite
+and only new chapters are fetched from MangaDex (see MangaDex.sync_chapter_feed).
+
+chapters   one row per chapter with the attributes MangaDex returned
+manga      manga attributes, fetched once per series instead of per chapter
+follows    the followed manga as of the last check, chapters of anything
+           else are deleted
+sync_state per feed (languages + content ratings) bookkeeping:
+           newest readableAt seen and how many of the newest chapters
+           are stored without gaps ("depth")
+"""
+
+DEFAULT_STORE_PATH = os.path.join(os.path.dirname(__file__), "cache", "mangadex.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chapters (
+    id TEXT PRIMARY KEY,
+    manga_id TEXT NOT NULL,
+    language TEXT,
+    readable_at TEXT NOT NULL,
+    attributes TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chapters_readable_at ON chapters (readable_at);
+CREATE INDEX IF NOT EXISTS chapters_manga_id ON chapters (manga_id);
+
+CREATE TABLE IF NOT EXISTS manga (
+    id TEXT PRIMARY KEY,
+    content_rating TEXT,
+    attributes TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    feed TEXT PRIMARY KEY,
+    last_readable_at TEXT,
+    depth INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    synced_at REAL NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS follows (
+    manga_id TEXT PRIMARY KEY,
+    checked_at REAL NOT NULL
+);
+"""
+
+
+def feed_key(translated_languages: Iterable[str], content_rating: Iterable[str]) -> str:
+    return f"{','.join(sorted(translated_languages))}|{','.join(sorted(content_rating))}"
+
+
+def manga_id_of(chapter: Dict[str, Any]) -> Optional[str]:
+    for relation in chapter.get("relationships", []):
+        if relation["type"] == "manga":
+            return relation["id"]
+    return None
+
+
+class MangaStore(object):
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH):
+        self._path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+
+            self._conn = sqlite3.connect(self._path, check_same_thread=False)
+            self._conn.executescript(SCHEMA)
+
+        return self._conn
+
+    def get_sync_state(self, feed: str) -> Dict[str, Any]:
+        row = self._connect().execute(
+            "SELECT last_readable_at, depth, total, synced_at FROM sync_state WHERE feed = ?",
+            (feed,)
+        ).fetchone()
+
+        if row is None:
+            return {"last_readable_at": None, "depth": 0, "total": 0, "synced_at": 0.0}
+
+        return {"last_readable_at": row[0], "depth": row[1], "total": row[2], "synced_at": row[3]}
+
+    def set_sync_state(self, feed: str, last_readable_at: Optional[str], depth: int, total: int) -> None:
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO sync_state (feed, last_readable_at, depth, total, synced_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (feed, last_readable_at, depth, total, time.time())
+        )
+        conn.commit()
+
+    def add_chapters(self, chapters: List[Dict[str, Any]]) -> None:
+        conn = self._connect()
+        conn.executemany(
+            "INSERT OR REPLACE INTO chapters (id, manga_id, language, readable_at, attributes) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    chapter["id"],
+                    manga_id_of(chapter),
+                    chapter["attributes"].get("translatedLanguage"),
+                    chapter["attributes"]["readableAt"],
+                    json.dumps(chapter["attributes"], separators=(",", ":")),
+                )
+                for chapter in chapters
+            ]
+        )
+        conn.commit()
+
+    def known_chapters_at(self, readable_at: Optional[str]) -> Set[str]:
+        """ IDs of the stored chapters that became readable at exactly `readable_at` """
+        if readable_at is None:
+            return set()
+
+        return {
+            row[0] for row in self._connect().execute(
+                "SELECT id FROM chapters WHERE readable_at = ?", (readable_at,)
+            )
+        }
+
+    def follows_checked_at(self) -> float:
+        row = self._connect().execute("SELECT MAX(checked_at) FROM follows").fetchone()
+        return row[0] or 0.0
+
+    def set_follows(self, manga_ids: Iterable[str]) -> int:
+        """
+        Replaces the followed manga and deletes the chapters of everything
+        else. Returns how many chapters were deleted.
+        """
+        now = time.time()
+
+        conn = self._connect()
+        conn.execute("DELETE FROM follows")
+        conn.executemany(
+            "INSERT OR REPLACE INTO follows (manga_id, checked_at) VALUES (?, ?)",
+            [(manga_id, now) for manga_id in manga_ids]
+        )
+        deleted = conn.execute(
+            "DELETE FROM chapters WHERE manga_id NOT IN (SELECT manga_id FROM follows)"
+        ).rowcount
+        conn.commit()
+
+        return deleted
+
+    def add_manga(self, manga: List[Dict[str, Any]]) -> None:
+        now = time.time()
+
+        conn = self._connect()
+        conn.executemany(
+            "INSERT OR REPLACE INTO manga (id, content_rating, attributes, fetched_at) "
+            "VALUES (?, ?, ?, ?)",
+            [
+                (
+                    series["id"],
+                    series["attributes"].get("contentRating"),
+                    json.dumps(series["attributes"], separators=(",", ":")),
+                    now,
+                )
+                for series in manga
+            ]
+        )
+        conn.commit()
+
+    def missing_manga(self, manga_ids: Iterable[str], max_age: float) -> List[str]:
+        """ IDs that aren't stored yet or were fetched more than `max_age` seconds ago """
+        manga_ids = list(dict.fromkeys(manga_ids))
+        if not manga_ids:
+            return []
+
+        placeholders = ",".join("?" * len(manga_ids))
+        fresh = {
+            row[0] for row in self._connect().execute(
+                f"SELECT id FROM manga WHERE id IN ({placeholders}) AND fetched_at > ?",
+                (*manga_ids, time.time() - max_age)
+            )
+        }
+
+        return [manga_id for manga_id in manga_ids if manga_id not in fresh]
+
+    def get_manga(self, manga_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(
+            "SELECT attributes FROM manga WHERE id = ?", (manga_id,)
+        ).fetchone()
+
+        return {"id": manga_id, "type": "manga", "attributes": json.loads(row[0])} if row else None
+
+    def latest_chapters(self, limit: int, translated_languages: List[str],
+                        content_rating: List[str]) -> List[Dict[str, Any]]:
+        """
+        Newest chapters first, shaped like the feed endpoint's response with
+        `includes[]=manga` so callers don't care where it came from.
+        """
+        languages = ",".join("?" * len(translated_languages))
+        ratings = ",".join("?" * len(content_rating))
+
+        rows = self._connect().execute(
+            "SELECT c.id, c.attributes, m.id, m.attributes "
+            "FROM chapters c JOIN manga m ON m.id = c.manga_id "
+            f"WHERE c.language IN ({languages}) AND m.content_rating IN ({ratings}) "
+            "ORDER BY c.readable_at DESC LIMIT ?",
+            (*translated_languages, *content_rating, limit)
+        ).fetchall()
+
+        return [
+            {
+                "id": chapter_id,
+                "type": "chapter",
+                "attributes": json.loads(chapter_attributes),
+                "relationships": [
+                    {"id": manga_id, "type": "manga", "attributes": json.loads(manga_attributes)}
+                ],
+            }
+            for chapter_id, chapter_attributes, manga_id, manga_attributes in rows
+        ]
+
+
+manga_store = MangaStore(os.environ.get("MANGADEX_STORE_PATH", DEFAULT_STORE_PATH))
@@ -1,86 +1,551 @@
-from typing import List, Dict
-import requests
+from typing import List, Dict, Any, Optional, Tuple
+import os
+import time
+import asyncio
+import aiohttp
 import logging
 import json
 
-class MangaDex(object):
+from actions.api.budget import time_left, unbounded
+from actions.api.http import request_json
+from actions.api.manga_store import manga_store, feed_key, manga_id_of
+
+# Overridable to point at a local stand-in, see benchmarks/stubs.py
+API_URL = os.environ.get("MANGADEX_API_URL", "https://api.mangadex.org")
+AUTH_URL = os.environ.get(
+    "MANGADEX_AUTH_URL", "https://auth.mangadex.org/realms/mangadex/protocol/openid-connect/token"
+)
+
+DEFAULT_TOKEN_PATH = os.path.join(os.path.dirname(__file__), "cache", "mangadex_tokens.json")
+
+# Feed pages are at most 100 chapters and offset + limit can't go past 10000
+PAGE_SIZE = 100
+MAX_OFFSET = 10000
+
+# MangaDex allows ~5 requests per second per IP, stay under it when paginating
+# https://api.mangadex.org/docs/2-limitations/#general-rate-limit
+FEED_CONCURRENCY = 3
+REQUEST_INTERVAL = 0.25
+
+# Manga details (titles, description, status) rarely change
+MANGA_MAX_AGE = 7 * 24 * 60 * 60
+
+# The follow list is checked when the feed shrinks and at least this often,
+# chapters of unfollowed manga are dropped from the store
+FOLLOWS_MAX_AGE = 24 * 60 * 60
+
+# Seconds a feed sync is trusted as is, and how long past that the store is
+# still answered from while a sync runs in the background
+FEED_TTL = float(os.environ.get("MANGADEX_FEED_TTL", 60))
+FEED_GRACE = float(os.environ.get("MANGADEX_FEED_GRACE", 15 * 60))
+
+
+class RequestSpacer(object):
+    """ Spaces out request start times by at least `interval` seconds """
+    def __init__(self, interval: float):
+        self._interval = interval
+        self._next = 0.0
+
+    async def wait(self) -> None:
+        now = time.monotonic()
+        start = max(now, self._next)
+
+        # Don't take a slot that only comes up after the action gave up
+        if start - now >= time_left():
+            raise asyncio.TimeoutError("No MangaDex request slot before the deadline")
+
+        self._next = start + self._interval
+
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+_spacer = RequestSpacer(REQUEST_INTERVAL)
+
+# feed -> (chapters asked for, sync in flight), shared by everyone asking meanwhile
+_syncs: Dict[str, Tuple[int, asyncio.Task]] = {}
+
+
+def _finish_sync(feed: str, task: asyncio.Task) -> None:
+    _syncs.pop(feed, None)
+
+    # Mark background failures as retrieved, the stored chapters were already served
+    if not task.cancelled() and task.exception():
+        logging.warning(f"MangaDex feed sync for {feed} failed: {task.exception()!r}")
+
+
+class TokenManager(object):
     """
-    API Link:
-    https://api.mangadex.org/docs/
+    Keeps MangaDex OAuth tokens between requests (and restarts) instead of
+    logging in with the password grant every time.
+
+    Access tokens are valid for 15 minutes and refresh tokens for much longer,
+    so an expired access token is renewed with the refresh token, and the
+    password grant is only used when that fails. While the token is in use,
+    it's renewed in the background `margin` seconds before it expires so
+    feed requests don't wait on the auth server.
+
+    Tokens are saved with owner-only permissions (0600). The password itself
+    is never written to disk.
+
+    https://api.mangadex.org/docs/02-authentication/personal-clients/
     """
-    def __init__(self, username: str, password: str, client_id: str, client_secret: str):
-        self.creds = {
-            "grant_type": "password",
-            "username": f"{username}",
-            "password": f"{password}",
-            "client_id": f"{client_id}",
-            "client_secret": f"{client_secret}"
+    def __init__(self, creds: Dict[str, str], path: str = DEFAULT_TOKEN_PATH, margin: float = 60):
+        self._creds = creds
+        self._path = path
+        self._margin = margin
+
+        self._access_token: Optional[str] = None
+        self._access_expires = 0.0
+        self._refresh_token: Optional[str] = None
+        self._refresh_expires = 0.0
+
+        self._lock: Optional[asyncio.Lock] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._used_since_renewal = False
+
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self._path) as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        # Tokens from another account or client are useless
+        if saved.get("username") != self._creds["username"] or \
+           saved.get("client_id") != self._creds["client_id"]:
+            return
+
+        self._access_token = saved.get("access_token")
+        self._access_expires = saved.get("access_expires", 0.0)
+        self._refresh_token = saved.get("refresh_token")
+        self._refresh_expires = saved.get("refresh_expires", 0.0)
+
+    def _save(self) -> None:
+        saved = {
+            "username": self._creds["username"],
+            "client_id": self._creds["client_id"],
+            "access_token": self._access_token,
+            "access_expires": self._access_expires,
+            "refresh_token": self._refresh_token,
+            "refresh_expires": self._refresh_expires,
         }
 
-    def _get_access_tokens(self) -> Dict[str, str]:
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        temp_path = f"{self._path}.tmp"
+
+        # Create with 0600 from the start so the tokens are never world readable
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as file:
+            json.dump(saved, file)
+
+        os.replace(temp_path, self._path)
+
+    def _store(self, tokens: Dict[str, Any]) -> None:
+        now = time.time()
+
+        self._access_token = tokens["access_token"]
+        self._access_expires = now + tokens.get("expires_in", 900)
+
+        if tokens.get("refresh_token"):
+            self._refresh_token = tokens["refresh_token"]
+            self._refresh_expires = now + tokens.get("refresh_expires_in", 0)
+
+        try:
+            self._save()
+        except OSError as error:
+            logging.warning(f"Unable to save MangaDex tokens: {error}")
+
+    async def _request_tokens(self) -> Dict[str, Any]:
+        if self._refresh_token and time.time() < self._refresh_expires - self._margin:
+            refresh = {
+                "grant_type": "refresh_token",
+                "refresh_token": self._refresh_token,
+                "client_id": self._creds["client_id"],
+                "client_secret": self._creds["client_secret"],
+            }
+
+            try:
+                return await request_json("POST", AUTH_URL, upstream="mangadex", data=refresh)
+            except aiohttp.ClientResponseError as error:
+                # Revoked or expired early, fall back to logging in again
+                logging.info(f"MangaDex token refresh rejected ({error.status}), logging in again")
+
         """
         Note: If you see something like "ssl.SSLError: [SSL: WRONG_VERSION_NUMBER]",
         check your antivirus or router security to see if it's flagging MangaDex as dangerous.
 
-        Either whitelist the site or disable router security to get it working. 
-        
+        Either whitelist the site or disable router security to get it working.
+
         Verify if it works by entering the command in your terminal
         (should show a bunch of info).
 
         `openssl s_client auth.mangadex.org:443`
         """
-        response = requests.post(
-            "https://auth.mangadex.org/realms/mangadex/protocol/openid-connect/token",
-            data=self.creds
+        return await request_json("POST", AUTH_URL, upstream="mangadex", data=self._creds)
+
+    async def _renew(self) -> None:
+        self._store(await self._request_tokens())
+        self._used_since_renewal = False
+        self._schedule_refresh()
+
+    def _schedule_refresh(self) -> None:
+        # Don't cancel ourselves when called from the background refresh
+        if self._refresh_task and not self._refresh_task.done() and \
+           self._refresh_task is not asyncio.current_task():
+            self._refresh_task.cancel()
+
+        delay = max(self._access_expires - self._margin - time.time(), 0)
+
+        # Runs long after the action that scheduled it
+        with unbounded():
+            self._refresh_task = asyncio.create_task(self._refresh_later(delay))
+
+    async def _refresh_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+
+        # Nobody asked for manga since the last renewal, renew on demand instead
+        if not self._used_since_renewal:
+            return
+
+        try:
+            async with self._get_lock():
+                await self._renew()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            logging.warning(f"Background MangaDex token refresh failed: {error}")
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _is_valid(self) -> bool:
+        return bool(self._access_token) and time.time() < self._access_expires - self._margin
+
+    def invalidate(self) -> None:
+        """ Forget the access token, e.g. after the API answered 401 """
+        self._access_expires = 0.0
+
+    async def get_access_token(self) -> str:
+        self._used_since_renewal = True
+
+        if not self._is_valid():
+            async with self._get_lock():
+                # Another request may have renewed it while we waited
+                if not self._is_valid():
+                    await self._renew()
+
+        elif self._refresh_task is None:
+            # Token loaded from disk, keep it fresh from here on
+            self._schedule_refresh()
+
+        return self._access_token
+
+
+_token_managers: Dict[Tuple[str, str], TokenManager] = {}
+
+def get_token_manager(creds: Dict[str, str]) -> TokenManager:
+    """ One token manager per account so every MangaDex object shares its tokens """
+    key = (creds["username"], creds["client_id"])
+
+    if key not in _token_managers:
+        _token_managers[key] = TokenManager(
+            creds, os.environ.get("MANGADEX_TOKEN_PATH", DEFAULT_TOKEN_PATH)
         )
-        tokens = response.json()
-        return tokens
 
-    def get_chapter_feed(self, 
-                            limit: int = 5, 
+    return _token_managers[key]
+
+
+async def get_manga(manga_id: str) -> Dict[str, Any]:
+    """
+    Manga details from the local store, fetched (and stored) if it's not there.
+    https://api.mangadex.org/docs/swagger.html#/Manga/get-manga-id
+    """
+    manga = manga_store.get_manga(manga_id)
+
+    if manga is None:
+        await _spacer.wait()
+        response = await request_json("GET", f"{API_URL}/manga/{manga_id}", upstream="mangadex")
+
+        manga = response["data"]
+        manga_store.add_manga([manga])
+
+    return manga
+
+
+class MangaDex(object):
+    """
+    API Link:
+    https://api.mangadex.org/docs/
+    """
+    def __init__(self, username: str, password: str, client_id: str, client_secret: str):
+        self.creds = {
+            "grant_type": "password",
+            "username": f"{username}",
+            "password": f"{password}",
+            "client_id": f"{client_id}",
+            "client_secret": f"{client_secret}"
+        }
+        self._tokens = get_token_manager(self.creds)
+
+    async def get_chapter_feed(self,
+                            limit: int = 5,
                             translated_languages: List[str] = ["en"],
                             content_rating: List[str] = ["safe", "suggestive"]
                         ):
         """
-        Get followed chapter updates from user feed
+        Get followed chapter updates from user feed, served from the local
+        store after syncing whatever is new (see sync_chapter_feed()). A feed
+        synced within FEED_TTL isn't synced again, within FEED_GRACE after
+        that the store answers right away and the sync runs in the background.
         https://api.mangadex.org/docs/swagger.html#/Feed/get-user-follows-manga-feed
         """
         try:
-            tokens = self._get_access_tokens()
-        except requests.exceptions.HTTPError as error:
-            logging.error(error.strerror)
+            await self.ensure_synced(int(limit), translated_languages, content_rating)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            # Still answer with what was synced before, if anything
+            logging.error(error)
+
+        chapters = manga_store.latest_chapters(int(limit), translated_languages, content_rating)
+
+        if not chapters:
             return []
 
+        return {"data": chapters}
 
-        headers = {
-            "Accept": "application/json",
-            "Authorization": f"Bearer {tokens['access_token']}",
-        }
+    async def ensure_synced(self,
+                            limit: int = 5,
+                            translated_languages: List[str] = ["en"],
+                            content_rating: List[str] = ["safe", "suggestive"]
+                           ) -> None:
+        """ sync_chapter_feed(), unless the store is recent and deep enough """
+        feed = feed_key(translated_languages, content_rating)
+        state = manga_store.get_sync_state(feed)
+
+        age = time.time() - state["synced_at"]
+        deep_enough = state["synced_at"] and state["depth"] >= min(limit, state["total"])
 
-        base_url = "https://api.mangadex.org/user/follows/manga/feed"
+        if deep_enough and age < FEED_TTL:
+            return
+
+        if deep_enough and age < FEED_TTL + FEED_GRACE:
+            # The answer's already stored, the sync shouldn't be held to this action's budget
+            with unbounded():
+                self._start_sync(feed, limit, translated_languages, content_rating)
+            return
+
+        while True:
+            synced_limit, task = self._start_sync(feed, limit, translated_languages, content_rating)
+
+            # Shield so one cancelled caller doesn't cancel the sync for everyone waiting
+            await asyncio.shield(task)
+
+            # Joined a sync for fewer chapters, there may be more to fetch
+            if synced_limit >= limit:
+                return
+
+    def _start_sync(self,
+                    feed: str,
+                    limit: int,
+                    translated_languages: List[str],
+                    content_rating: List[str]
+                   ) -> Tuple[int, asyncio.Task]:
+        if feed not in _syncs:
+            task = asyncio.create_task(
+                self.sync_chapter_feed(limit, translated_languages, content_rating)
+            )
+            _syncs[feed] = (limit, task)
+            task.add_done_callback(lambda done: _finish_sync(feed, done))
+
+        return _syncs[feed]
+
+    async def _get_feed_page(self,
+                             offset: int,
+                             translated_languages: List[str],
+                             content_rating: List[str],
+                             page_size: int = PAGE_SIZE
+                            ) -> Dict[str, Any]:
+        base_url = f"{API_URL}/user/follows/manga/feed"
         ratings = "".join([f"&contentRating[]={rating}" for rating in content_rating])
         languages = "".join([f"&translatedLanguage[]={lang}" for lang in translated_languages])
 
+        # No includes[]=manga, manga details are fetched once per series instead
         manga_feed= (
             f"{base_url}"
-            f"?limit={limit}"
-            "&offset=0"
-            "&includes[]=manga"
+            f"?limit={page_size}"
+            f"&offset={offset}"
             f"{ratings}"
             f"{languages}"
             "&order[readableAt]=desc"
         )
 
-        try:
-            response = requests.get(manga_feed, headers=headers)
-            response.raise_for_status()
-            chapters = response.json()
+        await _spacer.wait()
+        return await self._authorized_get(manga_feed)
 
-            logging.debug(f"Time elapsed: {response.elapsed}")
-            logging.debug(json.dumps(chapters, indent=2))
+    async def _get_feed_pages(self,
+                              offsets: List[int],
+                              translated_languages: List[str],
+                              content_rating: List[str]
+                             ) -> List[Dict[str, Any]]:
+        semaphore = asyncio.Semaphore(FEED_CONCURRENCY)
 
-        except requests.exceptions.HTTPError as error:
-            logging.error(error.strerror)
-            return []
+        async def get_page(offset: int) -> Dict[str, Any]:
+            async with semaphore:
+                return await self._get_feed_page(offset, translated_languages, content_rating)
+
+        return await asyncio.gather(*[get_page(offset) for offset in offsets])
+
+    async def _sync_manga(self, manga_ids: List[str], content_rating: List[str]) -> None:
+        missing = manga_store.missing_manga(manga_ids, MANGA_MAX_AGE)
+        ratings = "".join([f"&contentRating[]={rating}" for rating in content_rating])
+
+        for i in range(0, len(missing), PAGE_SIZE):
+            ids = "".join([f"&ids[]={manga_id}" for manga_id in missing[i:i + PAGE_SIZE]])
+
+            await _spacer.wait()
+            manga = await request_json(
+                "GET", f"{API_URL}/manga?limit={PAGE_SIZE}{ids}{ratings}", upstream="mangadex"
+            )
+            manga_store.add_manga(manga["data"])
+
+    async def sync_chapter_feed(self,
+                                limit: int = 5,
+                                translated_languages: List[str] = ["en"],
+                                content_rating: List[str] = ["safe", "suggestive"]
+                               ) -> None:
+        """
+        Brings the local store up to date with the followed feed.
+
+        Usually that's a single small request: the newest `limit` chapters
+        are compared to the newest readableAt seen last time. If they're all
+        new there's a backlog, so older pages are fetched a few at a time
+        until known chapters show up. If more chapters are asked for than are
+        stored, the missing older pages are fetched concurrently too.
+        """
+        feed = feed_key(translated_languages, content_rating)
+        state = manga_store.get_sync_state(feed)
+        last_seen = state["last_readable_at"]
+
+        # Chapters uploaded in one batch share a readableAt, the ones of those
+        # we didn't get last time are still new
+        known = manga_store.known_chapters_at(last_seen)
+
+        def is_new(chapter: Dict[str, Any]) -> bool:
+            readable_at = chapter["attributes"]["readableAt"]
+            return (
+                last_seen is None
+                or readable_at > last_seen
+                or (readable_at == last_seen and chapter["id"] not in known)
+            )
+
+        # The feed shifts when chapters come out between requests, so the
+        # same chapter can be on two pages
+        seen = set()
+
+        def unseen(page_chapters: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            fresh = [chapter for chapter in page_chapters if chapter["id"] not in seen]
+            seen.update(chapter["id"] for chapter in fresh)
+            return fresh
+
+        probe_size = min(max(limit, 1), PAGE_SIZE)
+
+        first_page = await self._get_feed_page(0, translated_languages, content_rating, probe_size)
+        total = min(first_page["total"], MAX_OFFSET)
+        chapters = unseen(first_page["data"])
+
+        new_count = sum(map(is_new, chapters))
+        offset = probe_size
+
+        # Backlog: keep going until a page has chapters we've already seen
+        if last_seen is not None and new_count == len(chapters):
+            while offset < total:
+                offsets = list(range(offset, min(offset + FEED_CONCURRENCY * PAGE_SIZE, total), PAGE_SIZE))
+                pages = await self._get_feed_pages(offsets, translated_languages, content_rating)
+                offset = offsets[-1] + PAGE_SIZE
+
+                page_chapters = unseen([chapter for page in pages for chapter in page["data"]])
+                page_new = [chapter for chapter in page_chapters if is_new(chapter)]
+
+                chapters.extend(page_new)
+                new_count += len(page_new)
+
+                if len(page_new) < len(page_chapters):
+                    break
+
+        # Newest chapters stored without gaps
+        depth = max(state["depth"] + new_count, len(chapters)) if last_seen else len(chapters)
+        depth = min(depth, total)
+
+        # The feed grew by less than the new chapters, so something left it,
+        # most likely an unfollowed manga. Check the follow list then, and once
+        # a day anyway
+        shrank = (
+            last_seen is not None
+            and total < MAX_OFFSET
+            and total < state["total"] + new_count
+        )
+        if shrank or time.time() - manga_store.follows_checked_at() > FOLLOWS_MAX_AGE:
+            if await self._sync_follows():
+                # What's left in the store has gaps, fetch the wanted chapters again
+                depth = 0
+
+        # Asked for more than we have, fill in older chapters
+        wanted = min(limit, total)
+        if depth < wanted:
+            offsets = list(range(depth, wanted, PAGE_SIZE))
+            pages = await self._get_feed_pages(offsets, translated_languages, content_rating)
+            chapters.extend(unseen([chapter for page in pages for chapter in page["data"]]))
+            depth = wanted
+
+        await self._sync_manga([manga_id_of(chapter) for chapter in chapters], content_rating)
+        manga_store.add_chapters(chapters)
+
+        newest = max((chapter["attributes"]["readableAt"] for chapter in chapters), default=None)
+        if last_seen and (newest is None or last_seen > newest):
+            newest = last_seen
+
+        manga_store.set_sync_state(feed, newest, depth, total)
+
+        logging.debug(f"Synced {new_count} new chapters ({depth}/{total} stored) for feed {feed}")
+
+    async def _sync_follows(self) -> int:
+        """
+        Stores the followed manga and drops the chapters of the rest.
+        Returns how many chapters were dropped.
+        """
+        followed = []
+        offset = 0
+
+        while True:
+            await _spacer.wait()
+            page = await self._authorized_get(
+                f"{API_URL}/user/follows/manga?limit={PAGE_SIZE}&offset={offset}"
+            )
+            followed.extend(manga["id"] for manga in page["data"])
+
+            offset += PAGE_SIZE
+            if offset >= min(page["total"], MAX_OFFSET):
+                break
+
+        deleted = manga_store.set_follows(followed)
+        if deleted:
+            logging.info(f"Dropped {deleted} chapters of unfollowed manga")
+
+        return deleted
+
+    async def _authorized_get(self, url: str) -> Any:
+        for attempt in range(2):
+            headers = {
+                "Accept": "application/json",
+                "Authorization": f"Bearer {await self._tokens.get_access_token()}",
+            }
 
-        return chapters
+            try:
+                return await request_json("GET", url, upstream="mangadex", headers=headers)
+            except aiohttp.ClientResponseError as error:
+                # Token was revoked or expired early, get a new one and try once more
+                if error.status != 401 or attempt:
+                    raise
+                self._tokens.invalidate()
@@ -0,0 +1,353 @@
+from typing import List, Dict, Any, Tuple, Callable, Iterator, Optional
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import functools
+import threading
+import asyncio
+import logging
+import bisect
+import time
+import os
+
+"""
+Latency histograms and error counters for the action server, served in
+Prometheus' text format next to it on http://127.0.0.1:5056/metrics
+(METRICS_HOST/METRICS_PORT, METRICS_PORT=0 turns the endpoint off) from
+the first action run on.
+
+touko_action_duration_seconds{action}       every Action.run, see timed_action()
+touko_action_errors_total{action,error}
+touko_action_budget_exceeded_total{action}  runs cut short by their budget, see budget.py
+touko_upstream_duration_seconds{upstream}   every request to OpenWeather, MangaDex,
+touko_upstream_errors_total{upstream,error}   Mistral, Shelly, JokeAPI, ...
+touko_upstream_timeouts_total{upstream}
+touko_upstream_hedges_total{upstream}       hedged and retried requests, see http.py
+touko_upstream_retries_total{upstream}
+touko_cache_lookups_total{cache,result}     from the caches' stats(), see register_cache()
+touko_cache_hit_ratio{cache}
+touko_cache_stale_fallbacks_total{cache}    expired answers served because the upstream failed
+touko_admission_queued{limiter}             requests waiting for a slot right now, and the most
+touko_admission_max_queued{limiter}           ever, from the admission controllers' stats(),
+touko_admission_in_flight{limiter}            see register_limiter() and rate_limit.py
+touko_admission_admitted_total{limiter}
+touko_admission_timed_out_total{limiter}
+touko_admission_retries_total{limiter}
+touko_admission_throttled_total{limiter}
+touko_event_loop_lag_seconds                how late the event loop wakes up, see watch_event_loop()
+touko_event_loop_blocked_seconds_total
+
+Which dependency dominates p99:
+
+    histogram_quantile(0.99, sum by (upstream, le) (rate(touko_upstream_duration_seconds_bucket[5m])))
+
+See: https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+PREFIX = "touko_"
+
+# Seconds. Mistral replies can take a while, so the usual buckets go up to 30s
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+DEFAULT_PORT = 5056
+
+# How often the event loop is checked, and how late a wake-up has to be to count as blocked
+LOOP_CHECK_INTERVAL = 0.05
+LOOP_BLOCK_THRESHOLD = 0.01
+
+# Which of an admission controller's stats() are levels and which only go up
+LIMITER_GAUGES = ("queued", "max_queued", "in_flight")
+LIMITER_COUNTERS = ("admitted", "timed_out", "retries", "throttled")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram(object):
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        # The last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        # Buckets are upper bounds including the bound itself
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Labels, **extra: str) -> str:
+    pairs = list(labels) + list(extra.items())
+
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class Metrics(object):
+    """
+    Histograms and counters keyed by name and labels. Updated from the event
+    loop, rendered from the endpoint's threads, hence the lock.
+    """
+    def __init__(self, prefix: str = PREFIX):
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._caches: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self._limiters: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+
+            histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def register_cache(self, name: str, stats: Callable[[], Dict[str, Any]]) -> None:
+        """
+        `stats` is read on every scrape. Its "hits", "*_hits" and "misses"
+        counts become touko_cache_lookups_total, "hit_rate" touko_cache_hit_ratio.
+        """
+        self._caches[name] = stats
+
+    def register_limiter(self, name: str, stats: Callable[[], Dict[str, Any]]) -> None:
+        """
+        `stats` is read on every scrape, see AdmissionController.stats(). Its
+        LIMITER_GAUGES become touko_admission_* gauges, LIMITER_COUNTERS
+        touko_admission_*_total counters.
+        """
+        self._limiters[name] = stats
+
+    @contextmanager
+    def measure(self, kind: str, name: str) -> Iterator[None]:
+        """
+        Times the block as touko_{kind}_duration_seconds{kind=name} and counts
+        the exceptions it raises, e.g.
+
+            with metrics.measure("upstream", "openweather"):
+                ...
+        """
+        start = time.perf_counter()
+
+        try:
+            yield
+        except asyncio.TimeoutError:
+            self.inc(f"{kind}_timeouts_total", **{kind: name})
+            raise
+        except Exception as error:
+            self.inc(f"{kind}_errors_total", **{kind: name, "error": type(error).__name__})
+            raise
+        finally:
+            self.observe(f"{kind}_duration_seconds", time.perf_counter() - start, **{kind: name})
+
+    def _cache_samples(self) -> Tuple[List[str], List[str]]:
+        lookups, ratios = [], []
+
+        for cache, stats in list(self._caches.items()):
+            try:
+                numbers = stats()
+            except Exception:
+                logging.exception(f"Unable to read {cache} cache stats")
+                continue
+
+            for result, count in numbers.items():
+                if result.endswith("hits") or result == "misses":
+                    lookups.append(f"{self._prefix}cache_lookups_total{_labels((), cache=cache, result=result)} {count}")
+
+            if "hit_rate" in numbers:
+                ratios.append(f"{self._prefix}cache_hit_ratio{_labels((), cache=cache)} {numbers['hit_rate']}")
+
+        return lookups, ratios
+
+    def _limiter_samples(self) -> List[str]:
+        samples: Dict[str, List[str]] = {}
+
+        for limiter, stats in list(self._limiters.items()):
+            try:
+                numbers = stats()
+            except Exception:
+                logging.exception(f"Unable to read {limiter} limiter stats")
+                continue
+
+            for key in LIMITER_GAUGES + LIMITER_COUNTERS:
+                if key in numbers:
+                    name = f"admission_{key}" if key in LIMITER_GAUGES else f"admission_{key}_total"
+                    samples.setdefault(name, []).append(
+                        f"{self._prefix}{name}{_labels((), limiter=limiter)} {numbers[key]}"
+                    )
+
+        lines = []
+
+        for name, values in samples.items():
+            kind = "counter" if name.endswith("_total") else "gauge"
+            lines.append(f"# TYPE {self._prefix}{name} {kind}")
+            lines.extend(values)
+
+        return lines
+
+    def render(self) -> str:
+        """ Everything in Prometheus' text exposition format """
+        lines = []
+
+        with self._lock:
+            # Copies, the buckets keep changing while the lines are built
+            histograms = [(key, h.buckets, list(h.counts), h.sum, h.count)
+                          for key, h in sorted(self._histograms.items(), key=lambda item: item[0])]
+            counters = sorted(self._counters.items())
+
+        typed = set()
+
+        for (name, labels), buckets, counts, total, count in histograms:
+            name = self._prefix + name
+
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels, le=str(bound))} {cumulative}")
+
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+
+        for (name, labels), value in counters:
+            name = self._prefix + name
+
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        lookups, ratios = self._cache_samples()
+
+        if lookups:
+            lines.append(f"# TYPE {self._prefix}cache_lookups_total counter")
+            lines.extend(lookups)
+
+        if ratios:
+            lines.append(f"# TYPE {self._prefix}cache_hit_ratio gauge")
+            lines.extend(ratios)
+
+        lines.extend(self._limiter_samples())
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+_watched_loop: Optional[asyncio.AbstractEventLoop] = None
+_serving = False
+
+
+async def _watch(loop: asyncio.AbstractEventLoop, interval: float) -> None:
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+
+        # Anything past the interval is time some callback held the loop
+        lag = max(loop.time() - start - interval, 0.0)
+        metrics.observe("event_loop_lag_seconds", lag)
+
+        if lag > LOOP_BLOCK_THRESHOLD:
+            metrics.inc("event_loop_blocked_seconds_total", lag)
+
+
+def watch_event_loop(interval: float = LOOP_CHECK_INTERVAL) -> None:
+    """ Starts measuring the running loop's wake-up lag, once per loop """
+    global _watched_loop
+
+    loop = asyncio.get_running_loop()
+
+    if _watched_loop is not loop:
+        _watched_loop = loop
+        loop.create_task(_watch(loop, interval))
+
+
+def timed_action(run: Callable) -> Callable:
+    """ Decorator for Action.run, measures every run under the action's name """
+    @functools.wraps(run)
+    async def timed_run(self, dispatcher, tracker, domain):
+        # Sanic imports the actions in its main process too, only the worker
+        # running them has anything to serve. Its loop also only exists by now
+        serve_metrics()
+        watch_event_loop()
+
+        with metrics.measure("action", self.name()):
+            return await run(self, dispatcher, tracker, domain)
+
+    return timed_run
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # Every scrape would end up in the action server's log otherwise
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, metrics: Metrics, host: str = "127.0.0.1", port: int = DEFAULT_PORT):
+        self.metrics = metrics
+        super().__init__((host, port), _MetricsHandler)
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self.serve_forever, name="metrics-server", daemon=True)
+        thread.start()
+
+        logging.info(f"Serving metrics on http://{self.server_address[0]}:{self.server_address[1]}/metrics")
+
+
+def serve_metrics() -> None:
+    """
+    Starts the endpoint once per process unless METRICS_PORT=0, a busy port
+    is logged and skipped
+    """
+    global _serving
+
+    port = int(os.environ.get("METRICS_PORT", DEFAULT_PORT))
+
+    if _serving or not port:
+        return
+
+    _serving = True
+
+    try:
+        MetricsServer(metrics, os.environ.get("METRICS_HOST", "127.0.0.1"), port).start()
+    except OSError as error:
+        logging.warning(f"Unable to serve metrics on port {port}: {error}")
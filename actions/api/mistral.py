@@ -1,22 +1,70 @@
 import os
-import requests
+import re
+import time
+import sqlite3
+import asyncio
+import aiohttp
 import logging
+import hashlib
 import json
+from collections import OrderedDict
 
-from dotenv import load_dotenv
-from typing import List, Dict, Any
+import numpy as np
 
-load_dotenv()
+from typing import List, Dict, Any, Optional, Tuple, Callable, Awaitable, AsyncIterator
 
-def conversate_with_user(messages: List[Dict[str, Any]]) -> str:
-    """
-    Docs: https://docs.mistral.ai/
-    """
+from actions.api.budget import time_left
+from actions.api.http import get_session, request_json
+from actions.api.rate_limit import AdmissionController
+from actions.api.metrics import metrics
+
+# Overridable to point at a local stand-in, see benchmarks/stubs.py
+MISTRAL_API_URL = os.environ.get("MISTRAL_API_URL", "https://api.mistral.ai/v1")
+
+# See https://docs.mistral.ai/api/#operation/createChatCompletion
+MISTRAL_URL = f"{MISTRAL_API_URL}/chat/completions"
+MODEL = "mistral-tiny"
+
+# See https://docs.mistral.ai/api/#operation/createEmbedding
+EMBEDDINGS_URL = f"{MISTRAL_API_URL}/embeddings"
+EMBEDDING_MODEL = "mistral-embed"
+
+ERROR_MESSAGE = "Someone tell Vedal there is a problem with my AI"
+
+SYSTEM_PROMPT = ("You are a virtual assistant named Touko. "
+                 "Keep responses succinct and concise as possible.")
+
+# Every Mistral call (chat and embeddings) queues here, see rate_limit.py.
+# The free tier allows 1 request per second
+mistral_limiter = AdmissionController(
+    "Mistral",
+    max_in_flight=int(os.environ.get("MISTRAL_MAX_CONCURRENCY", 4)),
+    rate=float(os.environ.get("MISTRAL_RATE_LIMIT", 1)),
+    burst=float(os.environ.get("MISTRAL_RATE_BURST", 1)),
+    deadline=float(os.environ.get("MISTRAL_DEADLINE", 20)),
+)
+
+metrics.register_limiter("mistral", mistral_limiter.stats)
+
+def _timeout() -> aiohttp.ClientTimeout:
+    # A whole reply (streamed or not) has to fit in what's left of the action's budget
+    return aiohttp.ClientTimeout(total=time_left(mistral_limiter.deadline))
+
+
+def _system_prompt(summary: Optional[str] = None) -> str:
+    # Older messages that no longer fit in the context (see llm_context.py)
+    if summary:
+        return f"{SYSTEM_PROMPT}\n\nEarlier in this conversation:\n{summary}"
+
+    return SYSTEM_PROMPT
+
+def _build_request(messages: List[Dict[str, Any]], stream: bool = False,
+                   summary: Optional[str] = None):
     api_key = os.environ["MISTRAL_API_KEY"]
 
     headers = {
         "Content-Type": "application/json",
-        "Accept": "application/json",
+        "Accept": "text/event-stream" if stream else "application/json",
         "Authorization": f"Bearer {api_key}",
     }
 
@@ -24,40 +72,523 @@ def conversate_with_user(messages: List[Dict[str, Any]]) -> str:
     Mistral has 32k context (token limit)
     https://docs.mistral.ai/platform/endpoints/#generative-endpoints
 
-    One can append multiple messages so the model can be more 
+    One can append multiple messages so the model can be more
     aware of what's going on in a conversation.
 
     This explains it well:
     https://help.openai.com/en/articles/7042661-chatgpt-api-transition-guide
     """
     data = {
-        "model": "mistral-tiny",
+        "model": MODEL,
         "messages": [
             {
                 "role": "system",
-                "content": ("You are a virtual assistant named Touko. "
-                             "Keep responses succinct and concise as possible.")
+                "content": _system_prompt(summary)
             },
             *messages
         ],
-        "max_tokens": 150
+        "max_tokens": 150,
+        "stream": stream
+    }
+
+    return headers, data
+
+
+class ChatStream(object):
+    """
+    Streams a chat completion as it's generated:
+
+        stream = ChatStream(messages)
+        async for text in stream:
+            ...
+
+    Mistral sends server-sent events ("data: {...}" lines, ending with
+    "data: [DONE]") where each chunk holds the next piece of the reply in
+    choices[0].delta.content.
+
+    After iterating, `time_to_first_token` and `total_latency` (seconds) tell
+    how long the user waited for the first piece and for the whole reply.
+    """
+    def __init__(self, messages: List[Dict[str, Any]], summary: Optional[str] = None):
+        self._messages = messages
+        self._summary = summary
+
+        self.time_to_first_token: Optional[float] = None
+        self.total_latency: Optional[float] = None
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self._stream()
+
+    async def _stream(self) -> AsyncIterator[str]:
+        headers, data = _build_request(self._messages, stream=True, summary=self._summary)
+        start = time.perf_counter()
+
+        deadline = mistral_limiter.new_deadline()
+        attempt = 0
+
+        while True:
+            try:
+                async with mistral_limiter.admit(deadline):
+                    with metrics.measure("upstream", "mistral"):
+                        async with get_session().post(MISTRAL_URL, json=data, headers=headers, timeout=_timeout()) as response:
+                            mistral_limiter.observe(response.headers)
+                            response.raise_for_status()
+
+                            async for line in response.content:
+                                line = line.strip()
+
+                                if not line.startswith(b"data:"):
+                                    continue
+
+                                payload = line[len(b"data:"):].strip()
+                                if payload == b"[DONE]":
+                                    break
+
+                                chunk = json.loads(payload)
+                                text = chunk["choices"][0]["delta"].get("content")
+
+                                if text:
+                                    if self.time_to_first_token is None:
+                                        self.time_to_first_token = time.perf_counter() - start
+                                    yield text
+                break
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                attempt += 1
+
+                # Part of the reply was already passed on, starting over would repeat it
+                if self.time_to_first_token is not None or not await mistral_limiter.backoff(attempt, deadline, error):
+                    raise
+
+        self.total_latency = time.perf_counter() - start
+
+        stream_metrics.record(self)
+
+
+class StreamMetrics(object):
+    """ Running time-to-first-token/total latency numbers for streamed replies """
+    def __init__(self):
+        self.count = 0
+        self.time_to_first_token_sum = 0.0
+        self.total_latency_sum = 0.0
+        self.last: Dict[str, Optional[float]] = {}
+
+    def record(self, stream: ChatStream) -> None:
+        self.count += 1
+        self.time_to_first_token_sum += stream.time_to_first_token or 0.0
+        self.total_latency_sum += stream.total_latency or 0.0
+        self.last = {
+            "time_to_first_token": stream.time_to_first_token,
+            "total_latency": stream.total_latency,
+        }
+
+        if stream.time_to_first_token is not None:
+            metrics.observe("mistral_time_to_first_token_seconds", stream.time_to_first_token)
+
+        logging.info(
+            f"Mistral stream: first token after {stream.time_to_first_token or 0:.3f}s, "
+            f"done after {stream.total_latency:.3f}s"
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg_time_to_first_token": self.time_to_first_token_sum / self.count if self.count else None,
+            "avg_total_latency": self.total_latency_sum / self.count if self.count else None,
+            "last": self.last,
+        }
+
+
+stream_metrics = StreamMetrics()
+
+
+class MemoryBackend(object):
+    """ In-process LRU, lost on restart """
+    def __init__(self, max_entries: int = 1000):
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            self._entries.move_to_end(key)
+
+        return entry
+
+    def set(self, key: str, entry: Dict[str, Any]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def with_prefix(self, prefix: str) -> List[Tuple[str, Dict[str, Any]]]:
+        return [(key, entry) for key, entry in self._entries.items() if entry["prefix"] == prefix]
+
+
+class SqliteBackend(object):
+    """ On-disk LRU that survives restarts """
+    def __init__(self, path: str, max_entries: int = 5000):
+        self._path = path
+        self._max_entries = max_entries
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+
+            self._conn = sqlite3.connect(self._path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, prefix TEXT NOT NULL, response TEXT NOT NULL, "
+                "embedding BLOB, latency REAL NOT NULL, "
+                "created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_prefix ON responses (prefix)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self._conn.commit()
+
+        return self._conn
+
+    @staticmethod
+    def _to_entry(row: Tuple) -> Dict[str, Any]:
+        prefix, response, embedding, latency, created = row
+        return {
+            "prefix": prefix,
+            "response": response,
+            "embedding": np.frombuffer(embedding, dtype=np.float32) if embedding else None,
+            "latency": latency,
+            "created": created,
+        }
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT prefix, response, embedding, latency, created FROM responses WHERE key = ?",
+            (key,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        conn.commit()
+
+        return self._to_entry(row)
+
+    def set(self, key: str, entry: Dict[str, Any]) -> None:
+        embedding = entry["embedding"]
+
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO responses "
+            "(key, prefix, response, embedding, latency, created, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                key, entry["prefix"], entry["response"],
+                embedding.astype(np.float32).tobytes() if embedding is not None else None,
+                entry["latency"], entry["created"], time.time()
+            )
+        )
+        conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self._max_entries,)
+        )
+        conn.commit()
+
+    def delete(self, key: str) -> None:
+        conn = self._connect()
+        conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        conn.commit()
+
+    def with_prefix(self, prefix: str) -> List[Tuple[str, Dict[str, Any]]]:
+        rows = self._connect().execute(
+            "SELECT key, prefix, response, embedding, latency, created FROM responses "
+            "WHERE prefix = ? AND embedding IS NOT NULL",
+            (prefix,)
+        ).fetchall()
+
+        return [(row[0], self._to_entry(row[1:])) for row in rows]
+
+
+class CacheLookup(object):
+    """ Result of ResponseCache.lookup(), handed back to ResponseCache.store() on a miss """
+    def __init__(self, key: str, prefix: str, response: Optional[str] = None,
+                 embedding: Optional[np.ndarray] = None, stale: Optional[str] = None):
+        self.key = key
+        self.prefix = prefix
+        self.response = response
+        self.embedding = embedding
+
+        # An expired reply to the same messages, for when Mistral can't answer in time
+        self.stale = stale
+
+
+class ResponseCache(object):
+    """
+    Reuses replies for small talk ("how are you?", "who are you?") that
+    comes up again and again with the same recent context.
+
+    The key is the model, the system prompt and the last `context_messages`
+    messages with case, punctuation and spacing normalized away. Entries
+    expire after `ttl` seconds.
+
+    With `semantic` on, an exact miss embeds the latest message and looks for
+    a previous reply to a paraphrase (cosine similarity >= `threshold`) with
+    the same earlier context. That costs one embedding call per miss, which
+    is much cheaper and faster than a chat completion.
+
+    `stats()` reports hit rates and the upstream time the hits saved.
+    """
+    def __init__(self, backend, ttl: float = 3600, context_messages: int = 3,
+                 semantic: bool = False, threshold: float = 0.95):
+        self._backend = backend
+        self._ttl = ttl
+        self._context_messages = context_messages
+        self._semantic = semantic
+        self._threshold = threshold
+
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(re.sub(r"[^\w\s]", " ", text.casefold()).split())
+
+    def _hash(self, model: str, system_prompt: str, messages: List[Dict[str, Any]]) -> str:
+        parts = [model, system_prompt] + [
+            f"{message['role']}:{self.normalize(message['content'])}" for message in messages
+        ]
+        return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+    def _is_fresh(self, entry: Dict[str, Any]) -> bool:
+        return time.time() - entry["created"] < self._ttl
+
+    def _hit(self, entry: Dict[str, Any]) -> str:
+        self.saved_seconds += entry["latency"]
+        return entry["response"]
+
+    async def lookup(self, system_prompt: str, messages: List[Dict[str, Any]],
+                     model: str = MODEL) -> CacheLookup:
+        recent = messages[-self._context_messages:]
+
+        key = self._hash(model, system_prompt, recent)
+        prefix = self._hash(model, system_prompt, recent[:-1])
+        lookup = CacheLookup(key, prefix)
+
+        entry = self._backend.get(key)
+
+        if entry is not None and self._is_fresh(entry):
+            self.hits += 1
+            lookup.response = self._hit(entry)
+            return lookup
+
+        if entry is not None:
+            # Kept until store() replaces it, it's better than no reply at all
+            lookup.stale = entry["response"]
+
+        if self._semantic and recent:
+            try:
+                lookup.embedding = await _embed(self.normalize(recent[-1]["content"]))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                logging.warning(f"Unable to embed message for the response cache: {error}")
+
+        if lookup.embedding is not None:
+            candidates = [
+                entry for _, entry in self._backend.with_prefix(prefix)
+                if entry["embedding"] is not None and self._is_fresh(entry)
+            ]
+
+            if candidates:
+                # Embeddings are stored normalized, so the dot product is the cosine similarity
+                similarity = np.stack([entry["embedding"] for entry in candidates]) @ lookup.embedding
+                best = int(np.argmax(similarity))
+
+                if similarity[best] >= self._threshold:
+                    self.semantic_hits += 1
+                    lookup.response = self._hit(candidates[best])
+                    return lookup
+
+        self.misses += 1
+        return lookup
+
+    def store(self, lookup: CacheLookup, response: str, latency: float) -> None:
+        self._backend.set(lookup.key, {
+            "prefix": lookup.prefix,
+            "response": response,
+            "embedding": lookup.embedding,
+            "latency": latency,
+            "created": time.time(),
+        })
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.semantic_hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.semantic_hits) / total if total else 0.0,
+            "saved_seconds": self.saved_seconds,
+        }
+
+
+async def _embed(text: str) -> Optional[np.ndarray]:
+    """ The normalized embedding of `text`, None if there's nothing to normalize """
+    api_key = os.environ["MISTRAL_API_KEY"]
+
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "Authorization": f"Bearer {api_key}",
     }
 
-    logging.debug(json.dumps(data, indent=2))
+    response = await mistral_limiter.call(lambda: request_json(
+        "POST", EMBEDDINGS_URL, upstream="mistral",
+        json={"model": EMBEDDING_MODEL, "input": [text]},
+        headers=headers
+    ))
+
+    embedding = np.asarray(response["data"][0]["embedding"], dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+
+    # Dividing by 0 would give NaNs that never match, skip the semantic lookup instead
+    if not embedding.size or not np.isfinite(norm) or norm == 0:
+        logging.warning("Got an empty or zero embedding, skipping the semantic cache")
+        return None
+
+    return embedding / norm
+
+
+def _make_response_cache() -> Optional[ResponseCache]:
+    backend = os.environ.get("MISTRAL_CACHE", "memory").lower()
+
+    if backend == "off":
+        return None
+
+    if backend == "sqlite":
+        backend = SqliteBackend(os.environ.get(
+            "MISTRAL_CACHE_PATH",
+            os.path.join(os.path.dirname(__file__), "cache", "mistral.sqlite3")
+        ))
+    else:
+        backend = MemoryBackend()
+
+    return ResponseCache(
+        backend,
+        ttl=float(os.environ.get("MISTRAL_CACHE_TTL", 3600)),
+        semantic=os.environ.get("MISTRAL_CACHE_SEMANTIC", "false").lower() == "true",
+    )
+
+
+response_cache = _make_response_cache()
+
+if response_cache is not None:
+    metrics.register_cache("mistral_response", response_cache.stats)
+
+
+async def conversate_with_user(
+        messages: List[Dict[str, Any]],
+        on_text: Optional[Callable[[str], Awaitable[None]]] = None,
+        summary: Optional[str] = None
+    ) -> str:
+    """
+    Docs: https://docs.mistral.ai/
+
+    Without `on_text` this waits for the whole reply. With it, the reply is
+    streamed and `on_text` is awaited with each piece as it arrives (e.g. to
+    push partial text to the user); the full reply is still returned.
+
+    `summary` describes earlier messages that were left out of `messages`.
+
+    Replies are served from `response_cache` when the same small talk was
+    answered recently, or answered at all if Mistral fails or runs out of time.
+    """
+    lookup = None
+
+    if response_cache is not None:
+        lookup = await response_cache.lookup(_system_prompt(summary), messages)
+
+        if lookup.response is not None:
+            if on_text is not None:
+                await on_text(lookup.response)
+            return lookup.response
+
+    start = time.perf_counter()
+
+    if on_text is not None:
+        reply, complete = await _stream_with_user(messages, on_text, summary)
+    else:
+        reply, complete = await _complete(messages, summary)
+
+    if lookup is not None and complete:
+        response_cache.store(lookup, reply, time.perf_counter() - start)
+
+    elif lookup is not None and lookup.stale is not None and reply == ERROR_MESSAGE:
+        # Mistral didn't get a word out in time, an older answer beats an error
+        metrics.inc("cache_stale_fallbacks_total", cache="mistral_response")
+
+        if on_text is not None:
+            await on_text(lookup.stale)
+        return lookup.stale
+
+    return reply
+
+
+async def _complete(messages: List[Dict[str, Any]], summary: Optional[str] = None) -> Tuple[str, bool]:
+    headers, data = _build_request(messages, summary=summary)
+
+    # Checked first, dumping the whole conversation isn't free
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    if debug:
+        logging.debug(json.dumps(data, indent=2))
+
+    async def post():
+        with metrics.measure("upstream", "mistral"):
+            async with get_session().post(MISTRAL_URL, json=data, headers=headers, timeout=_timeout()) as response:
+                mistral_limiter.observe(response.headers)
+                response.raise_for_status()
+                return await response.json()
+
+    try:
+        chat_response = await mistral_limiter.call(post)
+
+        if debug:
+            logging.debug(json.dumps(chat_response, indent=2))
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        logging.error(error)
+        return ERROR_MESSAGE, False
+
+    return chat_response['choices'][0]['message']['content'], True
+
+
+async def _stream_with_user(
+        messages: List[Dict[str, Any]],
+        on_text: Callable[[str], Awaitable[None]],
+        summary: Optional[str] = None
+    ) -> Tuple[str, bool]:
+    pieces = []
 
-    # See https://docs.mistral.ai/api/#operation/createChatCompletion
-    mistral_url = "https://api.mistral.ai/v1/chat/completions"
-    
     try:
-        response = requests.post(mistral_url, json=data, headers=headers)
-        response.raise_for_status()
-        chat_response = response.json()
+        async for text in ChatStream(messages, summary):
+            pieces.append(text)
+            await on_text(text)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        logging.error(error)
 
-        logging.debug(f"Time elapsed: {response.elapsed}")
-        logging.debug(json.dumps(chat_response, indent=2))
+        # Keep whatever made it through before the stream broke
+        if not pieces:
+            return ERROR_MESSAGE, False
 
-    except requests.exceptions.HTTPError as error:
-        logging.error(error.strerror)
-        return "Someone tell Vedal there is a problem with my AI"
+        return "".join(pieces), False
 
-    return chat_response['choices'][0]['message']['content']
+    return "".join(pieces), True
@@ -1,6 +1,269 @@
-from typing import Tuple, Any
-import requests
+from typing import List, Dict, Any, Optional, Tuple, Callable, Awaitable
+import os
+import asyncio
+import json
+import time
+import sqlite3
 import logging
+import threading
+import aiohttp
+
+from actions.api.budget import share, unbounded
+from actions.api.http import request_json
+from actions.api.gazetteer import gazetteer
+from actions.api.metrics import metrics
+
+# Overridable to point at a local stand-in, see benchmarks/stubs.py
+OPENWEATHER_URL = os.environ.get("OPENWEATHER_URL", "https://api.openweathermap.org")
+
+class GeocodingCache(object):
+    """
+    Persistent place name -> geocoding result cache backed by SQLite.
+
+    Place names almost never move, so results are kept until they're evicted
+    by the LRU bound. Empty results (places that don't exist) are cached too,
+    but only for `negative_ttl` seconds in case it was a new/renamed place.
+
+    Hits only note when the place was last used in memory, the rows are
+    updated with the next write (a new place, which may evict the least
+    recently used ones) so a hit never waits on a commit.
+
+    SQLite blocks, so get() and set() run it in a worker thread, one at a time.
+    """
+    def __init__(self, path: str, max_entries: int = 2000, negative_ttl: int = 24 * 60 * 60):
+        self._path = path
+        self._max_entries = max_entries
+        self._negative_ttl = negative_ttl
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+        # query -> last_used not written yet
+        self._touched: Dict[str, float] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(location: str) -> str:
+        """ "  New   York " and "new york" should be the same entry """
+        return " ".join(location.casefold().split())
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+
+            self._conn = sqlite3.connect(self._path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS geocoding ("
+                "query TEXT PRIMARY KEY, "
+                "coords TEXT NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS geocoding_last_used ON geocoding (last_used)"
+            )
+            self._conn.commit()
+
+        return self._conn
+
+    async def get(self, location: str) -> Optional[List[Dict[str, Any]]]:
+        """ Returns None on a cache miss, [] for a cached nonexistent place """
+        return await asyncio.to_thread(self._get, location)
+
+    async def set(self, location: str, coords: List[Dict[str, Any]]) -> None:
+        await asyncio.to_thread(self._set, location, coords)
+
+    def _get(self, location: str) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            conn = self._connect()
+            query = self.normalize(location)
+            now = time.time()
+
+            row = conn.execute(
+                "SELECT coords, created_at FROM geocoding WHERE query = ?", (query,)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            coords = json.loads(row[0])
+
+            if not coords and now - row[1] > self._negative_ttl:
+                conn.execute("DELETE FROM geocoding WHERE query = ?", (query,))
+                conn.commit()
+                self.misses += 1
+                return None
+
+            self._touched[query] = now
+
+            self.hits += 1
+            return coords
+
+    def _set(self, location: str, coords: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+
+            # Before evicting, so places in use aren't mistaken for unused ones
+            if self._touched:
+                conn.executemany(
+                    "UPDATE geocoding SET last_used = ? WHERE query = ?",
+                    [(last_used, query) for query, last_used in self._touched.items()]
+                )
+                self._touched.clear()
+
+            conn.execute(
+                "INSERT OR REPLACE INTO geocoding (query, coords, created_at, last_used) "
+                "VALUES (?, ?, ?, ?)",
+                (self.normalize(location), json.dumps(coords, separators=(",", ":")), now, now)
+            )
+
+            # Evict least recently used rows past the size bound
+            conn.execute(
+                "DELETE FROM geocoding WHERE query IN ("
+                "SELECT query FROM geocoding ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self._max_entries,)
+            )
+            conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+geocoding_cache = GeocodingCache(
+    os.environ.get(
+        "GEOCODING_CACHE_PATH",
+        os.path.join(os.path.dirname(__file__), "cache", "geocoding.sqlite3")
+    )
+)
+
+metrics.register_cache("geocoding", geocoding_cache.stats)
+
+class WeatherCache(object):
+    """
+    Current weather keyed by rounded lat/lon.
+
+    OpenWeather only updates current conditions about every 10 minutes, so a
+    fresh entry (younger than `ttl`) is returned as is. Within the `grace`
+    window after that, the stale entry is returned immediately and a
+    background task refreshes it for the next ask. Concurrent misses for the
+    same place share one request. If that request fails or runs out of time,
+    an entry past its grace window is still returned rather than nothing, and
+    get() says so (the payload's "dt" says how old it is).
+
+    https://openweathermap.org/faq#:~:text=How%20often%20do%20you%20update
+    """
+    def __init__(self, ttl: float = 600, grace: float = 600,
+                 precision: int = 2, max_entries: int = 256):
+        self.ttl = ttl
+        self.grace = grace
+        self._precision = precision
+        self._max_entries = max_entries
+
+        # key -> (monotonic time fetched, payload)
+        self._entries: Dict[Tuple[float, float], Tuple[float, Any]] = {}
+        self._pending: Dict[Tuple[float, float], asyncio.Task] = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def key(self, latitude: float, longitude: float) -> Tuple[float, float]:
+        # 2 decimal places is ~1km, well within a weather station's coverage
+        return (round(latitude, self._precision), round(longitude, self._precision))
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.stale_hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.stale_hits) / total if total else 0.0,
+            "entries": len(self._entries),
+        }
+
+    def _refresh(self, key: Tuple[float, float],
+                 fetch: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        task = self._pending.get(key)
+
+        if task is None:
+            task = asyncio.create_task(self._store(key, fetch))
+            self._pending[key] = task
+            task.add_done_callback(lambda done: self._finish_refresh(key, done))
+
+        return task
+
+    async def _store(self, key: Tuple[float, float],
+                     fetch: Callable[[], Awaitable[Any]]) -> Any:
+        payload = await fetch()
+        self._entries[key] = (time.monotonic(), payload)
+
+        if len(self._entries) > self._max_entries:
+            oldest = min(self._entries, key=lambda k: self._entries[k][0])
+            del self._entries[oldest]
+
+        return payload
+
+    def _finish_refresh(self, key: Tuple[float, float], task: asyncio.Task) -> None:
+        self._pending.pop(key, None)
+
+        # Mark background failures as retrieved, the stale value was already served
+        if not task.cancelled() and task.exception():
+            logging.warning(f"Weather refresh for {key} failed: {task.exception()!r}")
+
+    async def get(self, latitude: float, longitude: float,
+                  fetch: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        (payload, stale), `stale` is True only when the payload is an expired
+        entry served because fetching a new one failed
+        """
+        key = self.key(latitude, longitude)
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+
+            if age < self.ttl:
+                self.hits += 1
+                return entry[1], False
+
+            if age < self.ttl + self.grace:
+                self.stale_hits += 1
+
+                # The answer's already there, the refresh shouldn't be held to this action's budget
+                with unbounded():
+                    self._refresh(key, fetch)
+
+                return entry[1], False
+
+        self.misses += 1
+
+        try:
+            # Shield so one cancelled caller doesn't cancel the fetch for everyone waiting
+            return await asyncio.shield(self._refresh(key, fetch)), False
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if entry is None:
+                raise
+
+            metrics.inc("cache_stale_fallbacks_total", cache="weather")
+            return entry[1], True
+
+
+weather_cache = WeatherCache(
+    ttl=float(os.environ.get("WEATHER_CACHE_TTL", 600)),
+    grace=float(os.environ.get("WEATHER_CACHE_GRACE", 600)),
+)
+
+metrics.register_cache("weather", weather_cache.stats)
 
 class OpenWeatherMap(object):
     """
@@ -10,8 +273,21 @@ class OpenWeatherMap(object):
     def __init__(self, api_key: str):
         self._api_key = api_key
 
-    def get_coordinates(self, location: str) -> Tuple[float, float]:
-        geocoding_base_url = "https://api.openweathermap.org/geo/1.0/direct"
+    async def get_coordinates(self, location: str) -> List[Dict[str, Any]]:
+        # Offline GeoNames index first, see actions/api/gazetteer.py
+        offline = gazetteer.lookup(location)
+
+        if offline:
+            logging.debug(f"Gazetteer hit for '{location}'")
+            return offline
+
+        cached = await geocoding_cache.get(location)
+
+        if cached is not None:
+            logging.debug(f"Geocoding cache hit for '{location}'")
+            return cached
+
+        geocoding_base_url = f"{OPENWEATHER_URL}/geo/1.0/direct"
         query = "%20".join(location.split())
 
         coordinates = (
@@ -22,47 +298,54 @@ class OpenWeatherMap(object):
         )
 
         try:
-            response = requests.get(coordinates)
-            response.raise_for_status()
+            coords = await request_json("GET", coordinates, upstream="openweather", hedge=True)
+        except aiohttp.ClientError as error:
+            raise error from None
 
-            logging.debug(f"Time elapsed: {response.elapsed}")
+        if not coords:
+            # Only now, a real place that isn't in the gazetteer shouldn't turn
+            # into a similarly named one. Probably misspelled ("Barcelonna")
+            coords = gazetteer.fuzzy(location, limit=1)
 
-            coords = response.json()
-        except requests.exceptions.HTTPError as http_error:
-            raise http_error from None
-        except requests.RequestException as error:
-            raise error from None
+            if coords:
+                logging.debug(f"Gazetteer close match for '{location}': {coords[0]['name']}")
+
+        await geocoding_cache.set(location, coords)
 
         return coords
-    
-    def get_current_weather(self, location: str) -> Any:
+
+    async def get_current_weather(self, location: str) -> Tuple[Any, bool]:
+        """
+        (current weather, stale), `stale` when OpenWeather couldn't be reached
+        and it's an older answer from the cache, see WeatherCache.get()
+        """
         try:
-            coords = self.get_coordinates(location)
-        except requests.RequestException as error:
+            # Leave half of the budget for the weather itself
+            with share(0.5):
+                coords = await self.get_coordinates(location)
+        except aiohttp.ClientError as error:
             raise error from None
 
         latitude, longitude = (coords[0]["lat"], coords[0]["lon"])
 
-        base_url = "https://api.openweathermap.org/data/2.5/weather"
+        return await weather_cache.get(
+            latitude, longitude,
+            lambda: self.get_current_weather_at(latitude, longitude)
+        )
+
+    async def get_current_weather_at(self, latitude: float, longitude: float) -> Any:
+        """ Uncached current weather, see get_current_weather() """
+        base_url = f"{OPENWEATHER_URL}/data/2.5/weather"
         current_weather = (
             f"{base_url}"
             f"?lat={latitude}&lon={longitude}"
-            "&units=imperial"   
+            "&units=imperial"
             f"&appid={self._api_key}"
         )
 
         try:
-            response = requests.get(current_weather)
-            response.raise_for_status()
-            
-            logging.debug(f"Time elapsed: {response.elapsed}")
-
-            current_weather = response.json()
-        except requests.exceptions.HTTPError as http_error:
-            raise http_error from None
-        except requests.RequestException as error:
+            current_weather = await request_json("GET", current_weather, upstream="openweather", hedge=True)
+        except aiohttp.ClientError as error:
             raise error from None
 
         return current_weather
-
-    
\ No newline at end of file
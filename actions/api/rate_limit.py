@@ -0,0 +1,255 @@
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional, TypeVar
+import contextlib
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+
+from actions.api.budget import time_left
+
+"""
+Admission control for rate limited upstreams (Mistral, see mistral.py).
+
+Requests first wait for one of `max_in_flight` slots, then for a token from a
+bucket refilled at `rate` requests per second. Rate limit headers on the
+responses (Retry-After, x-ratelimit-*) pause the bucket until the upstream
+says it's fine again, so a burst of conversations queues up and gets slightly
+slower replies instead of a wall of 429s.
+
+Throttled (429), overloaded (5xx) and failed connections are retried with
+jittered exponential backoff as long as the retry can finish before the
+request's deadline. Waiting in the queue counts against the same deadline,
+which never goes past the action's budget (see budget.py).
+
+See:
+https://docs.mistral.ai/deployment/laplateforme/tier/
+https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+"""
+
+T = TypeVar("T")
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRY_STATUSES
+
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+def _seconds(value: Optional[str]) -> Optional[float]:
+    """ "1.5" or "1.5s" -> 1.5, anything else -> None """
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value.strip().rstrip("s")))
+    except ValueError:
+        return None
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+        # Waiters take turns, so requests are admitted in arrival order
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float) -> None:
+        """ Hands out nothing for `seconds`, and starts from an empty bucket after that """
+        until = time.monotonic() + seconds
+
+        if until > self._paused_until:
+            self._paused_until = until
+            self._tokens = 0.0
+            self._updated = until
+
+    async def acquire(self, deadline: float) -> None:
+        """ Raises asyncio.TimeoutError if no token is available before `deadline` (time.monotonic()) """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._refill(now)
+
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+
+                    wait = (1 - self._tokens) / self.rate
+
+                if now + wait > deadline:
+                    raise asyncio.TimeoutError("Rate limited past the request deadline")
+
+                await asyncio.sleep(wait)
+
+
+class AdmissionController(object):
+
+    def __init__(self, name: str, max_in_flight: int = 4, rate: float = 1.0, burst: float = 1.0,
+                 deadline: float = 20.0, backoff_base: float = 0.5, backoff_cap: float = 8.0):
+        self.name = name
+        self.deadline = deadline
+        self._backoff_base = backoff_base
+        self._backoff_cap = backoff_cap
+
+        self._max_in_flight = max_in_flight
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._bucket: Optional[TokenBucket] = None
+        self._rate = rate
+        self._burst = burst
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self.queued = 0
+        self.in_flight = 0
+        self.max_queued = 0
+        self.admitted = 0
+        self.timed_out = 0
+        self.retries = 0
+        self.throttled = 0
+        self.queue_wait_sum = 0.0
+
+    def _primitives(self):
+        # asyncio primitives belong to the loop they're first used in
+        loop = asyncio.get_running_loop()
+
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self._max_in_flight)
+            self._bucket = TokenBucket(self._rate, self._burst)
+            self._loop = loop
+
+        return self._semaphore, self._bucket
+
+    def new_deadline(self) -> float:
+        return time.monotonic() + time_left(self.deadline)
+
+    @contextlib.asynccontextmanager
+    async def admit(self, deadline: float):
+        """ Holds an in-flight slot for the duration of the block """
+        semaphore, bucket = self._primitives()
+        start = time.monotonic()
+
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+
+        try:
+            await asyncio.wait_for(semaphore.acquire(), max(0.0, deadline - start))
+
+            try:
+                await bucket.acquire(deadline)
+            except BaseException:
+                semaphore.release()
+                raise
+
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            logging.warning(f"{self.name}: gave up after waiting {time.monotonic() - start:.2f}s in the queue")
+            raise
+
+        finally:
+            self.queued -= 1
+
+        waited = time.monotonic() - start
+        self.queue_wait_sum += waited
+        self.admitted += 1
+        self.in_flight += 1
+
+        if waited > 0.1:
+            logging.info(f"{self.name}: waited {waited:.2f}s in the queue ({self.queued} still waiting)")
+
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            semaphore.release()
+
+    def observe(self, headers: Optional[Mapping[str, str]]) -> None:
+        """ Pauses the bucket when the upstream reports the rate limit was hit """
+        if not headers:
+            return
+
+        _, bucket = self._primitives()
+
+        retry_after = _seconds(headers.get("Retry-After"))
+        if retry_after is not None:
+            bucket.pause(retry_after)
+            return
+
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        if remaining is not None and remaining.strip() == "0":
+            reset = _seconds(headers.get("x-ratelimit-reset-requests"))
+            bucket.pause(reset if reset is not None else 1 / bucket.rate)
+            return
+
+        # Mistral's per-minute token budget, which doesn't say when it resets
+        remaining = headers.get("x-ratelimitbysize-remaining-minute")
+        if remaining is not None and remaining.strip().lstrip("-").isdigit() and int(remaining) <= 0:
+            bucket.pause(60 - time.time() % 60)
+
+    async def backoff(self, attempt: int, deadline: float, error: BaseException) -> bool:
+        """
+        Sleeps before retry number `attempt` (1, 2, ...) and returns True, or
+        returns False right away if `error` isn't worth retrying or the retry
+        couldn't finish before the deadline.
+        """
+        if not is_retryable(error):
+            return False
+
+        if isinstance(error, aiohttp.ClientResponseError):
+            if error.status == 429:
+                self.throttled += 1
+            self.observe(error.headers)
+
+        # "Full jitter": anywhere between 0 and the exponential backoff
+        delay = random.uniform(0, min(self._backoff_cap, self._backoff_base * 2 ** attempt))
+
+        if time.monotonic() + delay >= deadline:
+            return False
+
+        self.retries += 1
+        logging.info(f"{self.name}: retrying in {delay:.2f}s after {error}")
+
+        await asyncio.sleep(delay)
+        return True
+
+    async def call(self, request: Callable[[], Awaitable[T]]) -> T:
+        """ Runs `request()` once admitted, retrying it within the deadline """
+        deadline = self.new_deadline()
+        attempt = 0
+
+        while True:
+            try:
+                async with self.admit(deadline):
+                    return await request()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                attempt += 1
+
+                if not await self.backoff(attempt, deadline, error):
+                    raise
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "max_queued": self.max_queued,
+            "admitted": self.admitted,
+            "timed_out": self.timed_out,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "average_queue_wait": self.queue_wait_sum / self.admitted if self.admitted else 0.0,
+        }
@@ -0,0 +1,191 @@
+from typing import List, Dict, Any, Optional, Tuple
+import threading
+import logging
+import glob
+import os
+
+import numpy as np
+
+"""
+Every H&T reading, kept as fixed-width records in flat binary files so months
+of history can be queried with NumPy without a database server.
+
+The MQTT subscriber appends (see readings.py), the action server reads
+through memory maps. A record is only counted once all of its bytes are in
+the file, so a reader never sees half a record.
+
+history-000000.bin   RECORD_DTYPE records, oldest first
+history-000001.bin   next segment once the previous one holds SEGMENT_RECORDS
+...
+
+Each message from the H&T only carries one kind of reading, the other fields
+of its record are NaN and skipped by the aggregations.
+"""
+
+DEFAULT_HISTORY_PATH = os.path.join(os.path.dirname(__file__), "history")
+
+RECORD_DTYPE = np.dtype([
+    ("ts", "<f8"),       # Unix time
+    ("tC", "<f4"),
+    ("rh", "<f4"),
+    ("battery", "<f4"),
+])
+
+# 64k records (1.25 MB) per file. Every 15 minute wake-up adds 3 records (one per
+# reading), so that's about 7 months per file and 2.5 years in total
+SEGMENT_RECORDS = 65536
+MAX_SEGMENTS = 4
+
+FIELDS = ("tC", "rh", "battery")
+
+
+def make_record(ts: float, **values: float) -> np.ndarray:
+    record = np.full(1, np.nan, dtype=RECORD_DTYPE)
+    record["ts"] = ts
+
+    for field, value in values.items():
+        record[field] = value
+
+    return record
+
+
+class History(object):
+
+    def __init__(self, path: str = DEFAULT_HISTORY_PATH, segment_records: int = SEGMENT_RECORDS,
+                 max_segments: int = MAX_SEGMENTS):
+        self._path = path
+        self._segment_records = segment_records
+        self._max_segments = max_segments
+        self._lock = threading.Lock()
+
+        # Segment file -> (size it was mapped at, memmap), since old segments don't change
+        self._maps: Dict[str, Tuple[int, np.ndarray]] = {}
+
+    def _segments(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self._path, "history-*.bin")))
+
+    @staticmethod
+    def _count(segment: str) -> int:
+        try:
+            return os.path.getsize(segment) // RECORD_DTYPE.itemsize
+        except FileNotFoundError:
+            return 0
+
+    def append(self, records: np.ndarray) -> None:
+        """ Appends records (RECORD_DTYPE, in time order) from the subscriber """
+        with self._lock:
+            os.makedirs(self._path, exist_ok=True)
+
+            segments = self._segments()
+            segment = segments[-1] if segments else None
+
+            while len(records):
+                count = self._count(segment) if segment else self._segment_records
+
+                if count >= self._segment_records:
+                    number = int(os.path.basename(segment)[8:14]) + 1 if segment else 0
+                    segment = os.path.join(self._path, f"history-{number:06d}.bin")
+                    segments.append(segment)
+                    count = 0
+
+                fits = records[:self._segment_records - count]
+                records = records[len(fits):]
+
+                with open(segment, "ab") as file:
+                    # A write cut short (crash, full disk) leaves part of a record
+                    # at the end, drop it so what comes after stays aligned
+                    if file.tell() != count * RECORD_DTYPE.itemsize:
+                        logging.warning(f"Dropping a partial record at the end of {segment}")
+                        file.truncate(count * RECORD_DTYPE.itemsize)
+
+                    file.write(fits.tobytes())
+
+            # Rollover: the oldest segments go once there are too many
+            for old in segments[:-self._max_segments]:
+                os.remove(old)
+                logging.info(f"Removed old sensor history {old}")
+
+    def _map(self, segment: str) -> np.ndarray:
+        count = self._count(segment)
+        size, mapped = self._maps.get(segment, (-1, None))
+
+        if size != count:
+            mapped = np.memmap(segment, dtype=RECORD_DTYPE, mode="r", shape=(count,)) if count else \
+                np.empty(0, dtype=RECORD_DTYPE)
+            self._maps[segment] = (count, mapped)
+
+        return mapped
+
+    def window(self, start: float, end: float) -> np.ndarray:
+        """ Records with start <= ts < end """
+        segments = self._segments()
+
+        for stale in set(self._maps) - set(segments):
+            del self._maps[stale]
+
+        parts = []
+        for segment in segments:
+            records = self._map(segment)
+            if not len(records) or records["ts"][-1] < start or records["ts"][0] >= end:
+                continue
+
+            # Records are appended in time order, so binary search the range
+            lo, hi = np.searchsorted(records["ts"], [start, end])
+            parts.append(records[lo:hi])
+
+        return np.concatenate(parts) if parts else np.empty(0, dtype=RECORD_DTYPE)
+
+    @staticmethod
+    def _series(records: np.ndarray, field: str) -> Tuple[np.ndarray, np.ndarray]:
+        values = records[field]
+        present = ~np.isnan(values)
+        return records["ts"][present], values[present].astype(np.float64)
+
+    def stats(self, field: str, start: float, end: float) -> Optional[Dict[str, Any]]:
+        """ min/max/mean of `field` over [start, end), None if there are no readings """
+        ts, values = self._series(self.window(start, end), field)
+
+        if not len(values):
+            return None
+
+        return {
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "mean": float(values.mean()),
+            "count": int(len(values)),
+            "first": float(ts[0]),
+            "last": float(ts[-1]),
+        }
+
+    def trend(self, field: str, start: float, end: float) -> Optional[float]:
+        """ Least squares slope of `field` over [start, end), per hour """
+        ts, values = self._series(self.window(start, end), field)
+
+        if len(values) < 2 or ts[-1] == ts[0]:
+            return None
+
+        hours = (ts - ts[0]) / 3600
+        slope, _ = np.polyfit(hours, values, 1)
+
+        return float(slope)
+
+    def buckets(self, field: str, start: float, end: float, size: float) -> np.ndarray:
+        """
+        Mean of `field` per `size` seconds from `start`, as (bucket start, mean)
+        rows. Buckets without readings are NaN.
+        """
+        ts, values = self._series(self.window(start, end), field)
+
+        count = int(np.ceil((end - start) / size))
+        index = ((ts - start) // size).astype(np.int64)
+
+        sums = np.bincount(index, weights=values, minlength=count)
+        counts = np.bincount(index, minlength=count)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+
+        return np.column_stack((start + np.arange(count) * size, means))
+
+
+history = History(os.environ.get("SHELLY_HT_HISTORY_PATH", DEFAULT_HISTORY_PATH))
@@ -1,63 +1,48 @@
 import paho.mqtt.client as mqtt
 from dotenv import load_dotenv
-from datetime import datetime, timezone
+from collections import OrderedDict, defaultdict
+from typing import Dict, Any, List, Optional, Callable
 
+import hashlib
+import asyncio
 import logging
+import time
 import os
 import json
 
+# Before the imports below, they read os.environ
 load_dotenv()
 
-logging.basicConfig(level=logging.DEBUG)
+from actions.api.shelly.readings import ReadingsStore, ReadingsServer, DEFAULT_READINGS_PATH, DEFAULT_SOCKET_PATH
+from actions.api.shelly.history import history
 
-def on_connect(client, user_data, flags, reason_code, properties):
-    print("reason_code: " + str(reason_code))
-
-
-def on_message(client, user_data, msg):
-    print(msg.topic + " " + str(msg.qos) + " " + str(msg.payload))
-
-    # Temperature, Humidity, and Battery % reading from Shelly H&T device
-    device_reading = json.loads(msg.payload.decode("utf-8"))
-    json_file = os.path.join(os.path.dirname(__file__), 'gen3_ht_data.json')
-
-    # Get previous readings from json file
-    with open(json_file) as file:
-        json_data = json.load(file)
-
-    logging.debug(f"Data on file: {json.dumps(json_data, indent=2)}")
-    logging.debug(f"Reading from H&T: {json.dumps(device_reading, indent=2)}")
-
-    # Get current datetime in UTC
-    dt = datetime.now(timezone.utc)
-
-    # Add local timezone information to datetime
-    tz_dt = dt.astimezone()
-
-    # Get current iso 8601 format datetime string including the default timezone
-    iso_date = tz_dt.isoformat()
-    json_data["updatedAt"] = iso_date
-
-    if "devicepower" in msg.topic:
-        json_data["battery"] = device_reading["battery"]["percent"]
-        json_data["isCharging"] = device_reading["external"]["present"]
-
-    elif "temperature" in msg.topic:
-        json_data["tC"] = device_reading["tC"]
-        json_data["tF"] = device_reading["tF"]
-
-    elif "humidity" in msg.topic:
-        json_data["rh"] = device_reading["rh"]
+"""
+Run from the project root with `python -m actions.api.shelly.mqtt`
 
-    # Update previous readings with new reading data
-    with open(json_file, 'w', encoding='utf-8') as file:
-        json.dump(json_data, file, indent=4)
+Subscribes to every Shelly device on the broker (wildcard topics) from a
+single asyncio process:
 
-    logging.debug("Finished writing data to JSON file.")
+- paho's socket is driven by the event loop (add_reader/add_writer) instead
+  of a blocking loop_forever() thread
+- on_message only queues the message, a worker decodes and dispatches them
+  in batches
+- the queue is bounded: when it fills up, reading from the broker pauses
+  until the worker catches up (TCP flow control does the rest)
+- QoS 1 means "at least once", so redeliveries (DUP flag set, same topic and
+  payload seen recently) are dropped
+- messages are acknowledged once the worker handled them, not when paho
+  receives them, and the session is persistent: whatever was still queued
+  when the process died is delivered again on the next connect
+- H&T readings go to the ReadingsStore (debounced file, history and the
+  readings socket), every other device's status is kept in memory
+- ingest lag and throughput are logged every STATS_INTERVAL seconds
 
+See:
+https://github.com/eclipse/paho.mqtt.python/blob/master/examples/loop_asyncio.py
+https://shelly-api-docs.shelly.cloud/gen2/General/RPCChannels#mqtt
+"""
 
-def on_subscribe(client, user_data, mid, reason_code_list, properties):
-    print("Subscribed: " + str(mid) + " " + str(reason_code_list))
+logging.basicConfig(level=logging.INFO)
 
 """
                             +----------------+
@@ -71,14 +56,6 @@ def on_subscribe(client, user_data, mid, reason_code_list, properties):
                             +----------------+
 """
 
-mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-mqttc.on_message = on_message
-mqttc.on_connect = on_connect
-mqttc.on_subscribe = on_subscribe
-
-device_id = os.environ['SHELLY_HT_DEVICE_ID']
-broker = os.environ['MQTT_BROKER']
-
 """
 Check if broker is getting published data by using MQTT Explorer.
 Link: https://mqtt-explorer.com/
@@ -91,12 +68,12 @@ Link: https://mqtt-explorer.com/
 Should show broker host + shelly topic. Status updates occasionally appear after >1 hour.
 """
 
-mqttc.connect(host=broker, port=1883)
-
 """
-The tuple means (Topic, QoS level).
-
 Topics are message routes for communicating and receiving information.
+"+" matches one level, so "+/status/+" is every component's status of every
+device (<device id>/status/temperature:0, <device id>/status/switch:0, ...)
+and "+/events/rpc" carries the NotifyStatus/NotifyEvent frames.
+
 QoS (Quality of Service) determines the level of delivery guarantee.
 
 QoS level 1 is used because I want to guarantee I get the message at least
@@ -106,11 +83,367 @@ See links:
 https://cedalo.com/blog/mqtt-topics-and-mqtt-wildcards-explained/#What_are_MQTT_Topics
 https://www.hivemq.com/blog/mqtt-essentials-part-6-mqtt-quality-of-service-levels/
 """
-mqttc.subscribe(topic=[
-        (f'{device_id}/status/temperature:0', 1), 
-        (f'{device_id}/status/humidity:0', 1),
-        (f'{device_id}/status/devicepower:0', 1) 
-    ]
-)
-
-mqttc.loop_forever()
+DEFAULT_TOPICS = "+/status/+,+/events/rpc"
+QOS = 1
+
+# Fixed so the broker keeps the session (and unacknowledged messages) between runs
+DEFAULT_CLIENT_ID = "touko-shelly-ingest"
+
+# Messages waiting to be processed before reading from the broker pauses, and
+# how many the worker handles at once
+QUEUE_SIZE = 1000
+BATCH_SIZE = 100
+
+# Seconds to remember a message to drop its redeliveries
+DEDUPE_WINDOW = 30
+
+STATS_INTERVAL = 60
+
+# Seconds between reconnect attempts
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+
+# Components the H&T publishes readings on
+READING_COMPONENTS = ("temperature:0", "humidity:0", "devicepower:0")
+
+
+class Deduplicator(object):
+
+    def __init__(self, window: float = DEDUPE_WINDOW):
+        self._window = window
+        self._seen: "OrderedDict[bytes, float]" = OrderedDict()
+
+    def is_duplicate(self, topic: str, payload: bytes, dup: bool, now: float) -> bool:
+        """
+        Remembers every message, but only redeliveries are checked against
+        them: a device publishing the same status twice isn't a duplicate.
+        """
+        # Forget messages older than the window, oldest first
+        while self._seen:
+            oldest = next(iter(self._seen.values()))
+            if now - oldest < self._window:
+                break
+            self._seen.popitem(last=False)
+
+        key = hashlib.blake2b(topic.encode("utf-8") + b"\0" + payload, digest_size=16).digest()
+
+        if dup and key in self._seen:
+            return True
+
+        self._seen[key] = now
+        return False
+
+
+class IngestStats(object):
+
+    def __init__(self):
+        self.received = 0
+        self.processed = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.paused = 0
+        self.per_device: Dict[str, int] = defaultdict(int)
+
+        self._lag_sum = 0.0
+        self._lag_max = 0.0
+        self._window_start = time.monotonic()
+        self._window_processed = 0
+
+    def record(self, device: str, lag: float) -> None:
+        self.processed += 1
+        self.per_device[device] += 1
+        self._window_processed += 1
+        self._lag_sum += lag
+        self._lag_max = max(self._lag_max, lag)
+
+    def report(self, queued: int) -> Dict[str, Any]:
+        """ Numbers since the last report, plus the running totals """
+        elapsed = time.monotonic() - self._window_start
+
+        report = {
+            "received": self.received,
+            "processed": self.processed,
+            "duplicates": self.duplicates,
+            "errors": self.errors,
+            "paused": self.paused,
+            "queued": queued,
+            "throughput": self._window_processed / elapsed if elapsed else 0.0,
+            "average_lag": self._lag_sum / self._window_processed if self._window_processed else 0.0,
+            "max_lag": self._lag_max,
+            "devices": dict(self.per_device),
+        }
+
+        self._lag_sum = 0.0
+        self._lag_max = 0.0
+        self._window_start = time.monotonic()
+        self._window_processed = 0
+
+        return report
+
+
+class IngestService(object):
+
+    def __init__(self, broker: str, port: int = 1883, topics: Optional[List[str]] = None,
+                 readings: Optional[ReadingsStore] = None, ht_device_id: Optional[str] = None,
+                 queue_size: int = QUEUE_SIZE, batch_size: int = BATCH_SIZE,
+                 client_id: str = DEFAULT_CLIENT_ID):
+        self._broker = broker
+        self._port = port
+        self._topics = topics or DEFAULT_TOPICS.split(",")
+        self._readings = readings
+        self._ht_device_id = ht_device_id
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._misc_task: Optional[asyncio.Task] = None
+        self._disconnected: Optional[asyncio.Event] = None
+        self._reading_paused = False
+
+        # Bumped on every connect, message ids of an earlier connection can't be acked
+        self._connection = 0
+
+        self.dedupe = Deduplicator()
+        self.stats = IngestStats()
+
+        # Latest status of every component of every device, e.g.
+        # {"shellyplugus-abc": {"switch:0": {"output": true, ...}}}
+        self.device_status: Dict[str, Dict[str, Any]] = defaultdict(dict)
+
+        self._client = mqtt.Client(
+            mqtt.CallbackAPIVersion.VERSION2, client_id=client_id, clean_session=False, manual_ack=True
+        )
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_message = self._on_message
+        self._client.on_socket_open = self._on_socket_open
+        self._client.on_socket_close = self._on_socket_close
+        self._client.on_socket_register_write = self._on_socket_register_write
+        self._client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    # paho <-> asyncio, everything below runs on the event loop. Except for
+    # connecting, see run(), which is why the socket callbacks go through _on_loop()
+
+    def _on_loop(self, callback: Callable[..., None], *args: Any) -> None:
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+
+        if on_loop:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _on_socket_open(self, client, user_data, sock) -> None:
+        self._on_loop(self._socket_opened, client, sock)
+
+    def _socket_opened(self, client, sock) -> None:
+        self._loop.add_reader(sock, client.loop_read)
+        self._misc_task = self._loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, user_data, sock) -> None:
+        self._on_loop(self._socket_closed, sock)
+
+    def _socket_closed(self, sock) -> None:
+        self._loop.remove_reader(sock)
+        self._reading_paused = False
+
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+
+    def _on_socket_register_write(self, client, user_data, sock) -> None:
+        self._on_loop(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, user_data, sock) -> None:
+        self._on_loop(self._loop.remove_writer, sock)
+
+    async def _misc_loop(self) -> None:
+        # Keepalive pings and retries of unacknowledged messages
+        while self._client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def _on_connect(self, client, user_data, flags, reason_code, properties) -> None:
+        if reason_code.is_failure:
+            logging.error(f"MQTT broker refused the connection: {reason_code}")
+            return
+
+        self._connection += 1
+
+        logging.info(f"Connected to MQTT broker {self._broker}, subscribing to {', '.join(self._topics)}")
+
+        # Subscribing in on_connect renews the subscriptions after a reconnect
+        client.subscribe([(topic, QOS) for topic in self._topics])
+
+    def _on_disconnect(self, client, user_data, flags, reason_code, properties) -> None:
+        logging.warning(f"Disconnected from MQTT broker: {reason_code}")
+        self._disconnected.set()
+
+    def _on_message(self, client, user_data, msg) -> None:
+        self.stats.received += 1
+
+        try:
+            self._queue.put_nowait(
+                (time.time(), msg.topic, msg.payload, bool(msg.dup), msg.mid, msg.qos, self._connection)
+            )
+        except asyncio.QueueFull:
+            # Reads pause before this, but not acking means the broker sends it again
+            logging.warning(f"Ingest queue full, leaving a message on {msg.topic} unacknowledged")
+            return
+
+        # Backpressure: stop reading until the worker catches up
+        if self._queue.qsize() >= self._queue_size and not self._reading_paused:
+            self._loop.remove_reader(client.socket())
+            self._reading_paused = True
+            self.stats.paused += 1
+
+            logging.warning(f"Ingest queue full ({self._queue.qsize()} messages), pausing reads")
+
+    def _resume_reading(self) -> None:
+        if self._reading_paused and self._queue.qsize() < self._queue_size // 2:
+            sock = self._client.socket()
+
+            if sock is not None:
+                self._loop.add_reader(sock, self._client.loop_read)
+
+            self._reading_paused = False
+
+    # Processing
+
+    def _dispatch(self, topic: str, payload: bytes) -> str:
+        """ Returns the device the message came from """
+        device, _, rest = topic.partition("/")
+        kind, _, component = rest.partition("/")
+
+        message = json.loads(payload.decode("utf-8"))
+
+        if kind == "status":
+            self.device_status[device][component] = message
+
+            if (
+                self._readings is not None and component in READING_COMPONENTS and
+                (self._ht_device_id is None or device == self._ht_device_id)
+            ):
+                # Kept in memory, the file is written once the burst of messages is over
+                self._readings.update(topic, message)
+
+        elif kind == "events" and message.get("method") in ("NotifyStatus", "NotifyFullStatus"):
+            for key, status in message.get("params", {}).items():
+                if isinstance(status, dict):
+                    self.device_status[device].setdefault(key, {}).update(status)
+
+        return device
+
+    def _handle(self, topic: str, payload: bytes, dup: bool, received_at: float, now: float) -> None:
+        if self.dedupe.is_duplicate(topic, payload, dup, received_at):
+            self.stats.duplicates += 1
+            return
+
+        try:
+            device = self._dispatch(topic, payload)
+        except (ValueError, KeyError, TypeError) as error:
+            self.stats.errors += 1
+            logging.warning(f"Skipping message on {topic}: {error!r}")
+            return
+
+        self.stats.record(device, now - received_at)
+
+    async def _worker(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+
+            while len(batch) < self._batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            now = time.time()
+
+            for received_at, topic, payload, dup, mid, qos, connection in batch:
+                self._handle(topic, payload, dup, received_at, now)
+
+                # Done with it, the broker can forget it. After a reconnect the
+                # broker sends it again instead
+                if connection == self._connection:
+                    self._client.ack(mid, qos)
+
+            self._resume_reading()
+
+            # Let paho read more before the next batch
+            await asyncio.sleep(0)
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+
+            report = self.stats.report(self._queue.qsize())
+            logging.info(
+                f"MQTT ingest: {report['throughput']:.1f} msg/s, "
+                f"lag {report['average_lag'] * 1000:.1f} ms avg / {report['max_lag'] * 1000:.1f} ms max, "
+                f"{report['queued']} queued, {report['duplicates']} duplicates, "
+                f"{report['errors']} errors, {len(report['devices'])} devices"
+            )
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        self._disconnected = asyncio.Event()
+
+        tasks = [self._loop.create_task(self._worker()), self._loop.create_task(self._report())]
+        delay = RECONNECT_DELAY
+
+        # Only stores where to connect to, reconnect() does the connecting
+        self._client.connect_async(host=self._broker, port=self._port)
+
+        try:
+            while True:
+                self._disconnected.clear()
+
+                try:
+                    # The DNS lookup and TCP handshake block, so they happen off the
+                    # loop while the worker keeps draining the queue
+                    await self._loop.run_in_executor(None, self._client.reconnect)
+                    delay = RECONNECT_DELAY
+
+                    await self._disconnected.wait()
+
+                except OSError as error:
+                    logging.error(f"Can't reach MQTT broker {self._broker}: {error}")
+
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            self._client.disconnect()
+
+
+def topics_from_env() -> List[str]:
+    topics = os.environ.get("MQTT_TOPICS")
+
+    if topics:
+        return [topic.strip() for topic in topics.split(",") if topic.strip()]
+
+    return DEFAULT_TOPICS.split(",")
+
+
+if __name__ == "__main__":
+    readings = ReadingsStore(os.environ.get("SHELLY_HT_DATA_PATH", DEFAULT_READINGS_PATH), history=history)
+
+    # Lets the action server get the latest readings without reading the file
+    ReadingsServer(readings, os.environ.get("SHELLY_HT_SOCKET", DEFAULT_SOCKET_PATH)).start()
+
+    service = IngestService(
+        broker=os.environ['MQTT_BROKER'],
+        port=int(os.environ.get("MQTT_PORT", 1883)),
+        topics=topics_from_env(),
+        readings=readings,
+        ht_device_id=os.environ.get("SHELLY_HT_DEVICE_ID"),
+        client_id=os.environ.get("MQTT_CLIENT_ID", DEFAULT_CLIENT_ID),
+    )
+
+    try:
+        asyncio.run(service.run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,285 @@
+from typing import Dict, Any, Optional
+from datetime import datetime, timezone
+import socketserver
+import threading
+import logging
+import asyncio
+import atexit
+import time
+import json
+import os
+
+import numpy as np
+
+from actions.api.shelly.history import History, make_record
+
+
+"""
+Latest Shelly H&T readings, kept in memory by the MQTT subscriber (mqtt.py)
+and written to gen3_ht_data.json for the actions to read.
+
+The file is replaced atomically (write a temp file next to it, then rename
+over it) so a reader only ever sees the old or the new version, never half a
+file. Writes are debounced: the H&T wakes up and publishes temperature,
+humidity and device power within a second, which ends up as a single write.
+
+While it runs, the subscriber also serves the readings on a Unix socket,
+along with when the H&T was last awake (see DeviceAvailability), so the
+action server doesn't have to touch the file at all. read_last_known() tries
+the socket first and falls back to the file.
+
+See:
+https://shelly-api-docs.shelly.cloud/gen2/General/SleepManagementForBatteryDevices
+"""
+
+DEFAULT_READINGS_PATH = os.path.join(os.path.dirname(__file__), "gen3_ht_data.json")
+DEFAULT_SOCKET_PATH = os.path.join(os.path.dirname(__file__), "gen3_ht.sock")
+
+# Seconds to wait for more messages before writing
+DEBOUNCE = 1.0
+
+# Messages closer together than this belong to the same wake-up
+BURST_GAP = 10.0
+
+# How long the H&T is assumed to stay awake after its last message until
+# there's a wake-up to learn from, and the slack added to what was learned
+DEFAULT_AWAKE_WINDOW = 3.0
+AWAKE_MARGIN = 1.0
+
+
+def write_atomic(path: str, data: Dict[str, Any]) -> None:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file, separators=(",", ":"))
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(tmp_path, path)
+
+
+def load_readings(path: str = DEFAULT_READINGS_PATH) -> Dict[str, Any]:
+    try:
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def history_values(topic: str, reading: Dict[str, Any]) -> Dict[str, float]:
+    """ The fields of a history record (see history.py) a message carries """
+    if "devicepower" in topic:
+        return {"battery": reading["battery"]["percent"]}
+    elif "temperature" in topic:
+        return {"tC": reading["tC"]}
+    elif "humidity" in topic:
+        return {"rh": reading["rh"]}
+
+    return {}
+
+
+def apply_reading(readings: Dict[str, Any], topic: str, reading: Dict[str, Any]) -> None:
+    """ Updates `readings` with a status message from one of the H&T's topics """
+    if "devicepower" in topic:
+        readings["battery"] = reading["battery"]["percent"]
+        readings["isCharging"] = reading["external"]["present"]
+
+    elif "temperature" in topic:
+        readings["tC"] = reading["tC"]
+        readings["tF"] = reading["tF"]
+
+    elif "humidity" in topic:
+        readings["rh"] = reading["rh"]
+
+    else:
+        return
+
+    # Current time as an ISO 8601 string in the local timezone
+    readings["updatedAt"] = datetime.now(timezone.utc).astimezone().isoformat()
+
+
+class DeviceAvailability(object):
+    """
+    Learns when a sleepy device can be reached from the MQTT messages it sends.
+
+    A battery powered H&T wakes up on a timer or when a reading changes
+    enough, publishes everything within a second or two, then goes back to
+    sleep. How long that burst of messages lasts (plus AWAKE_MARGIN) is how
+    long REST calls stand a chance after the last message. With USB power it
+    never sleeps.
+    """
+    def __init__(self, default_window: float = DEFAULT_AWAKE_WINDOW):
+        self.last_seen: Optional[float] = None
+        self.always_on = False
+
+        self._burst_start: Optional[float] = None
+        self._awake_window = default_window
+        self._wake_interval: Optional[float] = None
+
+    def seen(self, now: float, topic: str = "", reading: Optional[Dict[str, Any]] = None) -> None:
+        if self.last_seen is None or now - self.last_seen > BURST_GAP:
+            # New wake-up
+            if self._burst_start is not None:
+                interval = now - self._burst_start
+                self._wake_interval = interval if self._wake_interval is None else \
+                    0.8 * self._wake_interval + 0.2 * interval
+
+            self._burst_start = now
+        else:
+            # Exponential moving average of how long a wake-up lasts
+            self._awake_window = 0.8 * self._awake_window + 0.2 * (now - self._burst_start + AWAKE_MARGIN)
+
+        self.last_seen = now
+
+        if "devicepower" in topic and reading:
+            self.always_on = bool(reading.get("external", {}).get("present"))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "last_seen": self.last_seen,
+            "awake_until": self.last_seen + self._awake_window if self.last_seen is not None else None,
+            "wake_interval": self._wake_interval,
+            "always_on": self.always_on,
+        }
+
+
+def is_awake(availability: Optional[Dict[str, Any]], now: Optional[float] = None) -> Optional[bool]:
+    """ None if there's nothing to go by (e.g. the subscriber isn't running) """
+    if not availability or availability.get("awake_until") is None:
+        return None
+
+    if availability.get("always_on"):
+        return True
+
+    return (now or time.time()) < availability["awake_until"]
+
+
+class ReadingsStore(object):
+    """
+    update() is called from the ingest worker on the event loop (see mqtt.py),
+    so the file and history writes happen on a timer thread instead, once the
+    burst of messages is over. The lock is for that thread, the readings
+    socket's threads reading snapshot() and the flush at exit.
+    """
+    def __init__(self, path: str = DEFAULT_READINGS_PATH, debounce: float = DEBOUNCE,
+                 history: Optional[History] = None):
+        self._path = path
+        self._debounce = debounce
+        self._history = history
+        self._pending_records = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._dirty = False
+
+        self.readings = load_readings(path)
+        self.availability = DeviceAvailability()
+
+        atexit.register(self.flush)
+
+    def update(self, topic: str, reading: Dict[str, Any]) -> None:
+        with self._lock:
+            now = time.time()
+
+            apply_reading(self.readings, topic, reading)
+            self.availability.seen(now, topic, reading)
+            self._dirty = True
+
+            values = history_values(topic, reading)
+            if self._history is not None and values:
+                self._pending_records.append(make_record(now, **values))
+
+            # The first message of a burst starts the timer, the rest ride along
+            if self._timer is None:
+                self._timer = threading.Timer(self._debounce, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"readings": dict(self.readings), "availability": self.availability.to_dict()}
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            if not self._dirty:
+                return
+
+            data = dict(self.readings)
+            records = self._pending_records
+            self._dirty = False
+            self._pending_records = []
+
+        with self._write_lock:
+            write_atomic(self._path, data)
+
+            if records:
+                self._history.append(np.concatenate(records))
+
+        logging.debug(f"Saved H&T readings to {self._path}")
+
+
+class ReadingsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Answers every connection with the store's snapshot as one line of JSON """
+    daemon_threads = True
+
+    def __init__(self, store: ReadingsStore, path: str = DEFAULT_SOCKET_PATH):
+        # Left over from a previous run that didn't shut down cleanly
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.store = store
+        super().__init__(path, _SnapshotHandler)
+
+        atexit.register(self.close)
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self.serve_forever, name="readings-server", daemon=True)
+        thread.start()
+
+        logging.info(f"Serving H&T readings on {self.server_address}")
+
+    def close(self) -> None:
+        self.server_close()
+
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class _SnapshotHandler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        snapshot = self.server.store.snapshot()
+        self.wfile.write(json.dumps(snapshot, separators=(",", ":")).encode("utf-8") + b"\n")
+
+
+async def read_last_known(socket_path: str = DEFAULT_SOCKET_PATH, file_path: str = DEFAULT_READINGS_PATH,
+                          timeout: float = 0.2) -> Dict[str, Any]:
+    """
+    {"readings": {...}, "availability": {...} or None} from the subscriber,
+    or from the file (without availability) if it isn't running.
+    """
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(socket_path), timeout)
+
+        try:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+        finally:
+            writer.close()
+
+        return json.loads(line)
+
+    except (OSError, asyncio.TimeoutError, ValueError) as error:
+        logging.debug(f"H&T readings socket unavailable ({error}), reading {file_path}")
+
+    try:
+        readings = load_readings(file_path)
+    except (OSError, ValueError) as error:
+        # Unreadable, or not JSON (e.g. cut short by a crash while it was written)
+        logging.warning(f"Can't read the last H&T readings from {file_path}: {error!r}")
+        readings = {}
+
+    return {"readings": readings, "availability": None}
@@ -0,0 +1,298 @@
+from typing import List, Dict, Any, Optional, Callable, Tuple
+import itertools
+import asyncio
+import logging
+import json
+import os
+
+import aiohttp
+
+from actions.api.budget import time_left
+from actions.api.http import get_session
+from actions.api.metrics import metrics
+
+
+"""
+Talks to Shelly Gen2+ devices over a WebSocket that stays open, instead of a
+new HTTP request per command. Every RPC method available at
+http://<ip>/rpc/<Method> is also available as a JSON frame on ws://<ip>/rpc:
+
+    -> {"id": 1, "src": "touko", "method": "Switch.Set", "params": {"id": 0, "on": true}}
+    <- {"id": 1, "src": "shellyplugus-...", "dst": "touko", "result": {"was_on": false}}
+
+The device also pushes NotifyStatus/NotifyFullStatus/NotifyEvent frames on
+the same socket whenever something changes.
+
+Devices are configured as name=ip pairs, e.g.
+
+SHELLY_PLUGS="living room=192.168.1.20,desk=192.168.1.21"
+
+(SHELLY_PLUG_IP alone still works, as a single device called "lights").
+
+See:
+https://shelly-api-docs.shelly.cloud/gen2/General/RPCProtocol
+https://shelly-api-docs.shelly.cloud/gen2/General/RPCChannels#websocket
+https://shelly-api-docs.shelly.cloud/gen2/General/Notifications
+"""
+
+# Identifies us to the device, which addresses replies and notifications to it
+CLIENT_ID = "touko"
+
+# Seconds to wait for a reply, and between reconnect attempts
+CALL_TIMEOUT = 5
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 30
+
+# Ping frames keep NAT/Wi-Fi power saving from silently dropping the socket
+HEARTBEAT = 30
+
+
+class ShellyError(Exception):
+    """ The device answered with an RPC error """
+    def __init__(self, device: str, code: int, message: str):
+        super().__init__(f"{device}: {message} ({code})")
+        self.code = code
+
+
+class ShellyDevice(object):
+
+    def __init__(self, name: str, host: str, call_timeout: float = CALL_TIMEOUT):
+        self.name = name
+        self.host = host
+        self._call_timeout = call_timeout
+
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._status_request: Optional[int] = None
+        self._listeners: List[Callable[["ShellyDevice", Dict[str, Any]], None]] = []
+
+        self._ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self._connected: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}/rpc"
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None and not self._ws.closed
+
+    def add_listener(self, listener: Callable[["ShellyDevice", Dict[str, Any]], None]) -> None:
+        """ Calls `listener(device, frame)` for every notification the device sends """
+        self._listeners.append(listener)
+
+    def start(self) -> None:
+        """ Connects in the background and keeps reconnecting until stop() """
+        loop = asyncio.get_running_loop()
+
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+
+        self._loop = loop
+        self._connected = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+        self._task = None
+
+    async def _run(self) -> None:
+        delay = RECONNECT_DELAY
+
+        while True:
+            try:
+                # The session has no connect timeout of its own, don't hang on a device that's off
+                ws = await asyncio.wait_for(
+                    get_session().ws_connect(self.url, heartbeat=HEARTBEAT),
+                    self._call_timeout
+                )
+
+                try:
+                    self._ws = ws
+                    self._connected.set()
+                    delay = RECONNECT_DELAY
+
+                    logging.info(f"Connected to Shelly device {self.name} at {self.url}")
+
+                    # Ask for everything once so listeners start from the current state.
+                    # The device only sends notifications after a request with "src" anyway
+                    self._status_request = next(self._ids)
+                    await ws.send_str(self._frame(self._status_request, "Shelly.GetStatus", None))
+
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            self._dispatch(json.loads(message.data))
+                        elif message.type in (aiohttp.WSMsgType.ERROR, aiohttp.WSMsgType.CLOSED):
+                            break
+
+                finally:
+                    await ws.close()
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                logging.warning(f"Shelly device {self.name} unreachable: {error}")
+
+            finally:
+                self._ws = None
+                self._connected.clear()
+                self._fail_pending(aiohttp.ClientConnectionError(f"Lost connection to {self.name}"))
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _dispatch(self, frame: Dict[str, Any]) -> None:
+        if "id" in frame and frame["id"] == self._status_request:
+            frame = {"method": "NotifyFullStatus", "params": frame.get("result", {})}
+
+        elif "id" in frame:
+            future = self._pending.pop(frame["id"], None)
+
+            if future is None or future.done():
+                return
+
+            if "error" in frame:
+                error = frame["error"]
+                future.set_exception(ShellyError(self.name, error.get("code", 0), error.get("message", "")))
+            else:
+                future.set_result(frame.get("result"))
+
+            return
+
+        if frame.get("method", "").startswith("Notify"):
+            for listener in self._listeners:
+                try:
+                    listener(self, frame)
+                except Exception:
+                    logging.exception(f"Shelly listener failed on {frame.get('method')}")
+
+    def _fail_pending(self, error: Exception) -> None:
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+        self._pending.clear()
+
+    @staticmethod
+    def _frame(request_id: int, method: str, params: Optional[Dict[str, Any]]) -> str:
+        frame: Dict[str, Any] = {"id": request_id, "src": CLIENT_ID, "method": method}
+
+        if params is not None:
+            frame["params"] = params
+
+        return json.dumps(frame, separators=(",", ":"))
+
+    async def call(self, method: str, params: Optional[Dict[str, Any]] = None,
+                   timeout: Optional[float] = None) -> Any:
+        """
+        Sends one RPC call and returns its result. Raises ShellyError if the
+        device rejects it, and aiohttp.ClientError/asyncio.TimeoutError if it
+        can't be reached (within the action's budget, see budget.py).
+        """
+        self.start()
+
+        # Connecting and the answer share one timeout
+        deadline = self._loop.time() + time_left(timeout or self._call_timeout)
+        unreachable = f"Can't connect to Shelly device {self.name} at {self.url}"
+
+        with metrics.measure("upstream", "shelly"):
+            if not self.connected:
+                try:
+                    await asyncio.wait_for(self._connected.wait(), deadline - self._loop.time())
+                except asyncio.TimeoutError:
+                    raise aiohttp.ClientConnectionError(unreachable)
+
+            # The socket can drop again between the connect notice and here
+            ws = self._ws
+            if ws is None or ws.closed:
+                raise aiohttp.ClientConnectionError(unreachable)
+
+            request_id = next(self._ids)
+            future = self._loop.create_future()
+            self._pending[request_id] = future
+
+            try:
+                await ws.send_str(self._frame(request_id, method, params))
+                return await asyncio.wait_for(future, max(deadline - self._loop.time(), 0.0))
+            finally:
+                self._pending.pop(request_id, None)
+
+    async def set_switch(self, on: bool, switch_id: int = 0) -> Dict[str, Any]:
+        """ Returns {"was_on": bool} """
+        return await self.call("Switch.Set", {"id": switch_id, "on": on})
+
+
+class ShellyRegistry(object):
+
+    def __init__(self, devices: List[ShellyDevice]):
+        self._devices = {device.name: device for device in devices}
+
+    @classmethod
+    def from_env(cls) -> "ShellyRegistry":
+        devices = []
+
+        for entry in os.environ.get("SHELLY_PLUGS", "").split(","):
+            name, _, host = entry.partition("=")
+
+            if name.strip() and host.strip():
+                devices.append(ShellyDevice(name.strip().lower(), host.strip()))
+
+        if not devices and os.environ.get("SHELLY_PLUG_IP"):
+            devices.append(ShellyDevice("lights", os.environ["SHELLY_PLUG_IP"]))
+
+        return cls(devices)
+
+    @property
+    def devices(self) -> List[ShellyDevice]:
+        return list(self._devices.values())
+
+    def get(self, name: str) -> Optional[ShellyDevice]:
+        return self._devices.get(name.strip().lower())
+
+    def resolve(self, names: Optional[List[str]] = None) -> Tuple[List[ShellyDevice], List[str]]:
+        """
+        Devices matching `names` (all of them if no name is given), and the
+        names that don't match any device
+        """
+        if not names:
+            return self.devices, []
+
+        matched = []
+        unknown = []
+
+        for name in names:
+            device = self.get(name)
+
+            if device is None:
+                unknown.append(name)
+            elif device not in matched:
+                matched.append(device)
+
+        return matched, unknown
+
+    def start(self) -> None:
+        """ Opens every device's socket ahead of the first command """
+        for device in self._devices.values():
+            device.start()
+
+    async def set_switch(self, devices: List[ShellyDevice], on: bool) -> Dict[str, Any]:
+        """
+        Switches all `devices` at once. Returns each device's result, or the
+        exception it raised, by name.
+        """
+        results = await asyncio.gather(
+            *[device.set_switch(on) for device in devices],
+            return_exceptions=True
+        )
+
+        return {device.name: result for device, result in zip(devices, results)}
+
+
+shelly_devices = ShellyRegistry.from_env()
@@ -0,0 +1,121 @@
+from typing import List, Dict, Any, Optional, Tuple
+import asyncio
+import time
+
+import aiohttp
+
+from actions.api.budget import time_left
+from actions.api.shelly.rpc import ShellyDevice, ShellyRegistry, ShellyError, shelly_devices
+
+"""
+In-memory copy of every plug's switch state, kept current by the status
+notifications the plugs push over their RPC socket (see rpc.py), e.g.
+
+{"method": "NotifyStatus", "params": {"ts": 1700000000.1, "switch:0": {"id": 0, "output": true}}}
+
+so the bot can tell whether the lights are on without asking the plugs, skip
+commands that wouldn't change anything, and confirm a change once the plug
+reports it actually happened.
+
+Gen2 plugs publish the same frames to MQTT (<device id>/events/rpc), so
+feed() works for those too.
+
+See:
+https://shelly-api-docs.shelly.cloud/gen2/General/Notifications
+https://shelly-api-docs.shelly.cloud/gen2/ComponentsAndServices/Switch#status
+"""
+
+# Seconds to wait for a plug to report a change before giving up on confirming it
+CONFIRM_TIMEOUT = 2
+
+
+class SwitchMirror(object):
+
+    def __init__(self, registry: ShellyRegistry):
+        self._registry = registry
+
+        # (device name, switch id) -> (output, time.time() of the notification)
+        self._state: Dict[Tuple[str, int], Tuple[bool, float]] = {}
+        self._waiters: Dict[Tuple[str, int], List[Tuple[bool, asyncio.Future]]] = {}
+
+        for device in registry.devices:
+            device.add_listener(self._on_notification)
+
+    def _on_notification(self, device: ShellyDevice, frame: Dict[str, Any]) -> None:
+        self.feed(device.name, frame)
+
+    def feed(self, name: str, frame: Dict[str, Any]) -> None:
+        if frame.get("method") not in ("NotifyStatus", "NotifyFullStatus"):
+            return
+
+        params = frame.get("params", {})
+        updated = params.get("ts", time.time())
+
+        for component, status in params.items():
+            if not component.startswith("switch:") or "output" not in status:
+                continue
+
+            key = (name, int(component.partition(":")[2]))
+            output = bool(status["output"])
+
+            self._state[key] = (output, updated)
+
+            waiting = self._waiters.get(key, [])
+            for wanted, future in waiting:
+                if wanted == output and not future.done():
+                    future.set_result(True)
+
+            self._waiters[key] = [(wanted, future) for wanted, future in waiting if not future.done()]
+
+    def get(self, device: ShellyDevice, switch_id: int = 0) -> Optional[bool]:
+        """ Last reported output, or None if unknown (or the plug's socket is down, so it may be stale) """
+        if not device.connected:
+            return None
+
+        state = self._state.get((device.name, switch_id))
+        return state[0] if state else None
+
+    async def wait_for(self, device: ShellyDevice, output: bool, switch_id: int = 0,
+                       timeout: float = CONFIRM_TIMEOUT) -> bool:
+        """ True once the plug reports `output`, False if it doesn't within `timeout` (or the budget) """
+        if self.get(device, switch_id) == output:
+            return True
+
+        timeout = time_left(timeout)
+
+        key = (device.name, switch_id)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, []).append((output, future))
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiters[key] = [waiter for waiter in self._waiters.get(key, []) if waiter[1] is not future]
+
+    async def read(self, devices: List[ShellyDevice], timeout: float = 1.0) -> Dict[str, Optional[bool]]:
+        """
+        Current output of each device by name. Mirrored states come straight
+        from memory, the rest are asked for (e.g. right after startup, before
+        a plug's first notification). None means the plug couldn't be reached.
+        """
+        states = {device.name: self.get(device) for device in devices}
+        unknown = [device for device in devices if states[device.name] is None]
+
+        async def ask(device: ShellyDevice) -> Optional[bool]:
+            try:
+                status = await device.call("Switch.GetStatus", {"id": 0}, timeout=timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ShellyError):
+                return None
+
+            self.feed(device.name, {"method": "NotifyStatus", "params": {"switch:0": status}})
+            return bool(status["output"])
+
+        for device, state in zip(unknown, await asyncio.gather(*[ask(device) for device in unknown])):
+            states[device.name] = state
+
+        return states
+
+
+switch_mirror = SwitchMirror(shelly_devices)
@@ -0,0 +1,141 @@
+from typing import Tuple
+import numpy as np
+
+"""
+Sun position, sunrise/sunset and twilight computed locally with NOAA's solar
+equations. Accurate to about a minute for dates between 1901 and 2099, which is
+plenty for "is it daytime?" and "when is sunset?".
+
+Every function is vectorized: latitude, longitude and time can be scalars or
+NumPy arrays that broadcast together, so many places or days are evaluated
+in one batch.
+
+See:
+https://gml.noaa.gov/grad/solcalc/solareqns.PDF
+https://gml.noaa.gov/grad/solcalc/calcdetails.html
+"""
+
+# Zenith angle (degrees) the sun's center has at each event. Sunrise/sunset
+# include atmospheric refraction and the sun's radius.
+SUNRISE = 90.833
+CIVIL_TWILIGHT = 96.0
+NAUTICAL_TWILIGHT = 102.0
+ASTRONOMICAL_TWILIGHT = 108.0
+
+SECONDS_PER_DAY = 86400
+
+
+def _sun(unix_time: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns (declination in radians, equation of time in minutes).
+    """
+    julian_day = unix_time / SECONDS_PER_DAY + 2440587.5
+    t = (julian_day - 2451545.0) / 36525.0
+
+    mean_long = np.radians((280.46646 + t * (36000.76983 + t * 0.0003032)) % 360)
+    mean_anomaly = np.radians(357.52911 + t * (35999.05029 - 0.0001537 * t))
+    eccentricity = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+
+    center = (
+        np.sin(mean_anomaly) * (1.914602 - t * (0.004817 + 0.000014 * t)) +
+        np.sin(2 * mean_anomaly) * (0.019993 - 0.000101 * t) +
+        np.sin(3 * mean_anomaly) * 0.000289
+    )
+
+    omega = np.radians(125.04 - 1934.136 * t)
+    apparent_long = np.radians(np.degrees(mean_long) + center - 0.00569 - 0.00478 * np.sin(omega))
+
+    mean_obliquity = 23 + (26 + (21.448 - t * (46.815 + t * (0.00059 - t * 0.001813))) / 60) / 60
+    obliquity = np.radians(mean_obliquity + 0.00256 * np.cos(omega))
+
+    declination = np.arcsin(np.sin(obliquity) * np.sin(apparent_long))
+
+    y = np.tan(obliquity / 2) ** 2
+    equation_of_time = 4 * np.degrees(
+        y * np.sin(2 * mean_long) -
+        2 * eccentricity * np.sin(mean_anomaly) +
+        4 * eccentricity * y * np.sin(mean_anomaly) * np.cos(2 * mean_long) -
+        0.5 * y * y * np.sin(4 * mean_long) -
+        1.25 * eccentricity * eccentricity * np.sin(2 * mean_anomaly)
+    )
+
+    return declination, equation_of_time
+
+
+def solar_elevation(latitude, longitude, unix_time) -> np.ndarray:
+    """
+    Sun's elevation above the horizon in degrees (negative when it's below).
+    """
+    latitude, longitude, unix_time = np.broadcast_arrays(
+        np.asarray(latitude, dtype=float),
+        np.asarray(longitude, dtype=float),
+        np.asarray(unix_time, dtype=float),
+    )
+
+    declination, equation_of_time = _sun(unix_time)
+
+    utc_minutes = (unix_time % SECONDS_PER_DAY) / 60
+    true_solar_time = (utc_minutes + equation_of_time + 4 * longitude) % 1440
+    hour_angle = np.radians(true_solar_time / 4 - 180)
+
+    phi = np.radians(latitude)
+    cos_zenith = (
+        np.sin(phi) * np.sin(declination) +
+        np.cos(phi) * np.cos(declination) * np.cos(hour_angle)
+    )
+
+    return 90 - np.degrees(np.arccos(np.clip(cos_zenith, -1, 1)))
+
+
+def sun_times(latitude, longitude, unix_date, zenith: float = SUNRISE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Unix times the sun crosses `zenith` on the way up and down, for the day
+    whose solar noon is closest to noon UTC of `unix_date` shifted by the
+    longitude (i.e. the local calendar day).
+
+    Pass CIVIL_TWILIGHT etc. as `zenith` for dawn/dusk. Entries are NaN when
+    the sun never crosses that zenith that day (polar day or night); check
+    solar_elevation() to tell which.
+    """
+    latitude, longitude, unix_date = np.broadcast_arrays(
+        np.asarray(latitude, dtype=float),
+        np.asarray(longitude, dtype=float),
+        np.asarray(unix_date, dtype=float),
+    )
+
+    midnight = unix_date - unix_date % SECONDS_PER_DAY
+
+    # Evaluate the sun at (approximately) local solar noon
+    approx_noon = midnight + (720 - 4 * longitude) * 60
+    declination, equation_of_time = _sun(approx_noon)
+
+    solar_noon = midnight + (720 - 4 * longitude - equation_of_time) * 60
+
+    phi = np.radians(latitude)
+    cos_hour_angle = (
+        np.cos(np.radians(zenith)) / (np.cos(phi) * np.cos(declination)) -
+        np.tan(phi) * np.tan(declination)
+    )
+
+    with np.errstate(invalid="ignore"):
+        hour_angle = np.degrees(np.arccos(cos_hour_angle))
+
+    # Minutes of arc -> seconds of time: 1 degree = 4 minutes
+    offset = hour_angle * 4 * 60
+
+    return solar_noon - offset, solar_noon + offset
+
+
+def day_phase(latitude, longitude, unix_time) -> np.ndarray:
+    """
+    "day", "civil twilight", "nautical twilight", "astronomical twilight" or
+    "night" for every input.
+    """
+    elevation = solar_elevation(latitude, longitude, unix_time)
+
+    phases = np.array([
+        "night", "astronomical twilight", "nautical twilight", "civil twilight", "day"
+    ])
+    thresholds = 90 - np.array([ASTRONOMICAL_TWILIGHT, NAUTICAL_TWILIGHT, CIVIL_TWILIGHT, SUNRISE])
+
+    return phases[np.searchsorted(thresholds, elevation, side="right")]
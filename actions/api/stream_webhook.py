@@ -0,0 +1,86 @@
+from typing import Optional
+import re
+import asyncio
+import aiohttp
+import logging
+
+from actions.api.budget import time_left
+from actions.api.http import get_session
+from actions.api.metrics import metrics
+
+"""
+Actions can only return messages when they finish, so long replies (e.g. a
+streamed LLM reply) are previewed to the user early through a webhook the
+frontend or a custom output channel listens on (MISTRAL_STREAM_WEBHOOK):
+
+    POST <webhook> {"recipient_id": "<sender id>", "text": "One sentence.", "partial": true}
+
+Partial messages are only a preview. The whole reply is still returned
+through the dispatcher when the action finishes, so it ends up in the
+tracker and the frontend can replace the preview with it.
+
+Pushing through the Rasa server's tracker events API doesn't work here: the
+message that's running the action holds the conversation's lock until the
+action is done, so the pushes would only go out after it.
+"""
+
+# Split after sentence punctuation or at line breaks
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+
+# Seconds a single push may take, the reply itself matters more
+PUSH_TIMEOUT = 1.0
+
+
+class MessagePusher(object):
+    """
+    Buffers streamed text and pushes it a sentence at a time, so the user
+    sees the reply as it's written without getting one message per word.
+
+    If pushing fails, it stops trying; the whole reply still goes out the
+    normal way (dispatcher.utter_message).
+    """
+    def __init__(self, webhook_url: str, sender_id: str, token: Optional[str] = None):
+        self._url = webhook_url
+        self._sender_id = sender_id
+        self._headers = {"Authorization": f"Bearer {token}"} if token else {}
+
+        self._buffer = ""
+        self.failed = False
+
+    async def feed(self, text: str) -> None:
+        if self.failed:
+            return
+
+        self._buffer += text
+
+        *sentences, self._buffer = SENTENCE_END.split(self._buffer)
+        complete = " ".join(sentence for sentence in sentences if sentence)
+
+        if complete:
+            await self._push(complete)
+
+    async def flush(self) -> None:
+        remaining, self._buffer = self._buffer.strip(), ""
+
+        if remaining:
+            await self._push(remaining)
+
+    async def _push(self, text: str) -> None:
+        if self.failed:
+            return
+
+        message = {"recipient_id": self._sender_id, "text": text, "partial": True}
+
+        timeout = aiohttp.ClientTimeout(total=time_left(PUSH_TIMEOUT))
+
+        try:
+            # Whatever the webhook answers with doesn't matter, only that it took it
+            with metrics.measure("upstream", "stream_webhook"):
+                async with get_session().post(self._url, json=message, headers=self._headers,
+                                              timeout=timeout) as response:
+                    response.raise_for_status()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            logging.warning(f"Unable to push a partial reply to the stream webhook: {error}")
+
+            self.failed = True
+            self._buffer = ""
@@ -0,0 +1,395 @@
+from typing import List, Dict, Tuple, Optional, Sequence
+from collections import OrderedDict
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo, TZPATH
+import importlib.resources
+import urllib.request
+import threading
+import tempfile
+import zipfile
+import asyncio
+import logging
+import shutil
+import json
+import sys
+import os
+
+import numpy as np
+
+from actions.api.http import request_json
+
+"""
+Coordinates -> IANA timezone lookup, so the current time anywhere can be
+computed with zoneinfo instead of asking timeapi.io for it every time.
+
+Three sources are used, best first:
+
+1) A compiled timezone-boundary index built from timezone-boundary-builder's
+   GeoJSON release (the same polygons timeapi.io and most tz libraries use).
+   Download and compile the latest release once when setting up with
+
+   `python -m actions.api.timezones download`
+
+   or compile an already downloaded one with
+
+   `python -m actions.api.timezones build combined-with-oceans-now.json`
+
+   It's a directory of .npy files that are memory-mapped, loaded on a thread
+   the first time it's needed (or by the warm-up, see lazy.py), so only the
+   polygons lookups touch are ever read.
+
+2) The zone1970.tab table that ships with tzdata, for countries that only
+   have one timezone (most of them).
+
+3) timeapi.io, for places in countries with several timezones (US, Canada,
+   Russia, Brazil, Australia, ...) when there's no boundary index. zone1970.tab
+   only has one reference point per zone, and the nearest one is often in the
+   wrong zone (Seattle is closer to Boise than to Los Angeles). Answers are
+   remembered, so each place is only asked about once.
+
+See:
+https://docs.python.org/3/library/zoneinfo.html
+https://data.iana.org/time-zones/tz-link.html
+"""
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(__file__), "data", "timezones")
+
+RELEASE_URL = ("https://github.com/evansiroky/timezone-boundary-builder/releases/latest/download/"
+               "timezones-with-oceans-now.geojson.zip")
+
+INDEX_ARRAYS = ("names", "polygon_zone", "bbox", "polygon_rings", "ring_offsets", "vertices")
+
+# Overridable to point at a local stand-in, see benchmarks/stubs.py
+TIMEAPI_URL = os.environ.get("TIMEAPI_URL", "https://timeapi.io/api")
+
+# timeapi.io answers remembered, by coordinates rounded to ~1km
+MAX_RESOLVED = 1024
+
+
+class TimezoneFinder(object):
+    """
+    Finds the timezone for a (latitude, longitude) pair.
+
+    Nothing is loaded until the first lookup (or load()) so it doesn't slow
+    down the action server's startup.
+    """
+    def __init__(self, index_path: str = DEFAULT_INDEX_PATH):
+        self._index_path = index_path
+        self._index: Optional[Dict[str, np.ndarray]] = None
+        self._reference: Optional[Dict[str, np.ndarray]] = None
+        self._resolved: "OrderedDict[Tuple[float, float], str]" = OrderedDict()
+        self._load_lock = threading.Lock()
+        self._loaded = False
+
+    def load(self) -> None:
+        """ Maps the boundary index and reads zone1970.tab, blocking """
+        with self._load_lock:
+            if self._loaded:
+                return
+
+            self._index = self._load_index()
+            self._reference = _read_zone1970()
+            self._loaded = True
+
+    def _load_index(self) -> Optional[Dict[str, np.ndarray]]:
+        if not os.path.exists(os.path.join(self._index_path, "names.npy")):
+            logging.info(
+                f"No timezone index at {self._index_path}, asking timeapi.io for countries with "
+                "several timezones (see `python -m actions.api.timezones download`)"
+            )
+            return None
+
+        # A half built index can't be mapped, timeapi.io answers instead
+        try:
+            index = {
+                name: np.load(os.path.join(self._index_path, f"{name}.npy"), mmap_mode="r")
+                for name in INDEX_ARRAYS
+            }
+        except (OSError, ValueError) as error:
+            logging.warning(f"Timezone index at {self._index_path} is unusable, rebuild it: {error}")
+            return None
+
+        logging.debug(f"Loaded {len(index['names'])} timezones from {self._index_path}")
+
+        return index
+
+    def offline_timezone(self, latitude: float, longitude: float,
+                         country: Optional[str] = None) -> Optional[str]:
+        """
+        The timezone if it can be told without asking timeapi.io, else None.
+        `country` is the ISO 3166 code OpenWeather's geocoding returns.
+        """
+        self.load()
+
+        if self._index is not None:
+            name = _polygon_lookup(self._index, latitude, longitude)
+
+            if name:
+                return name
+
+        return _only_zone(self._reference, country)
+
+    async def timezone_at(self, latitude: float, longitude: float,
+                          country: Optional[str] = None) -> str:
+        """
+        Raises aiohttp.ClientError/asyncio.TimeoutError if timeapi.io has to be
+        asked and can't be reached.
+        """
+        if not self._loaded:
+            await asyncio.to_thread(self.load)
+
+        name = self.offline_timezone(latitude, longitude, country)
+
+        if name:
+            return name
+
+        key = (round(latitude, 2), round(longitude, 2))
+        name = self._resolved.get(key)
+
+        if name is None:
+            response = await request_json(
+                "GET", f"{TIMEAPI_URL}/TimeZone/coordinate", upstream="timeapi", hedge=True,
+                params={"latitude": latitude, "longitude": longitude}
+            )
+            name = response["timeZone"]
+
+            self._resolved[key] = name
+            if len(self._resolved) > MAX_RESOLVED:
+                self._resolved.popitem(last=False)
+        else:
+            self._resolved.move_to_end(key)
+
+        return name
+
+
+def _in_ring(x: float, y: float, ring: np.ndarray) -> bool:
+    """
+    Even-odd ray casting over all edges of a ring at once.
+    https://wrfranklin.org/Research/Short_Notes/pnpoly.html
+    """
+    xs, ys = ring[:, 0], ring[:, 1]
+    xj, yj = np.roll(xs, 1), np.roll(ys, 1)
+
+    straddles = (ys > y) != (yj > y)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_cross = (xj - xs) * (y - ys) / (yj - ys) + xs
+
+    return bool(np.count_nonzero(straddles & (x < x_cross)) % 2)
+
+
+def _polygon_lookup(index: Dict[str, np.ndarray], latitude: float, longitude: float) -> Optional[str]:
+    bbox = index["bbox"]
+
+    candidates = np.flatnonzero(
+        (bbox[:, 0] <= longitude) & (longitude <= bbox[:, 2]) &
+        (bbox[:, 1] <= latitude) & (latitude <= bbox[:, 3])
+    )
+
+    rings = index["polygon_rings"]
+    offsets = index["ring_offsets"]
+    vertices = index["vertices"]
+
+    for polygon in candidates:
+        first, last = rings[polygon], rings[polygon + 1]
+
+        # First ring is the outline, the rest are holes
+        outline = vertices[offsets[first]:offsets[first + 1]]
+        if not _in_ring(longitude, latitude, outline):
+            continue
+
+        in_hole = any(
+            _in_ring(longitude, latitude, vertices[offsets[hole]:offsets[hole + 1]])
+            for hole in range(first + 1, last)
+        )
+
+        if not in_hole:
+            return str(index["names"][index["polygon_zone"][polygon]])
+
+    return None
+
+
+def _parse_iso6709(coordinates: str) -> Tuple[float, float]:
+    """
+    zone1970.tab uses ±DDMM±DDDMM or ±DDMMSS±DDDMMSS.
+    """
+    split = max(coordinates.rfind("+"), coordinates.rfind("-"))
+    latitude, longitude = coordinates[:split], coordinates[split:]
+
+    def to_degrees(value: str, degree_digits: int) -> float:
+        sign = -1 if value[0] == "-" else 1
+        digits = value[1:]
+        degrees = int(digits[:degree_digits])
+        minutes = int(digits[degree_digits:degree_digits + 2])
+        seconds = int(digits[degree_digits + 2:] or 0)
+        return sign * (degrees + minutes / 60 + seconds / 3600)
+
+    return to_degrees(latitude, 2), to_degrees(longitude, 3)
+
+
+def _zone1970_lines() -> List[str]:
+    for directory in TZPATH:
+        path = os.path.join(directory, "zone1970.tab")
+
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                return file.read().splitlines()
+
+    # No system tz database (e.g. Windows), use the tzdata package instead
+    table = importlib.resources.files("tzdata").joinpath("zoneinfo", "zone1970.tab")
+    return table.read_text(encoding="utf-8").splitlines()
+
+
+def _read_zone1970() -> Dict[str, np.ndarray]:
+    names, countries, latitudes, longitudes = [], [], [], []
+
+    for line in _zone1970_lines():
+        if not line or line.startswith("#"):
+            continue
+
+        codes, coordinates, name = line.split("\t")[:3]
+        latitude, longitude = _parse_iso6709(coordinates)
+
+        names.append(name)
+        countries.append(f",{codes},")
+        latitudes.append(latitude)
+        longitudes.append(longitude)
+
+    return {
+        "names": np.array(names),
+        "countries": np.array(countries),
+        "lat": np.radians(np.array(latitudes)),
+        "lon": np.radians(np.array(longitudes)),
+    }
+
+
+def _only_zone(reference: Dict[str, np.ndarray], country: Optional[str] = None) -> Optional[str]:
+    """ The country's timezone if it only has one, None if it has several (or isn't known) """
+    if not country:
+        return None
+
+    zones = np.flatnonzero(np.char.find(reference["countries"], f",{country.upper()},") >= 0)
+
+    return str(reference["names"][zones[0]]) if len(zones) == 1 else None
+
+
+timezone_finder = TimezoneFinder(os.environ.get("TIMEZONE_INDEX_PATH", DEFAULT_INDEX_PATH))
+
+
+def preload() -> None:
+    """ Called by the warm-up, see actions/api/lazy.py """
+    timezone_finder.load()
+
+
+async def local_time(latitude: float, longitude: float, country: Optional[str] = None,
+                     now: Optional[datetime] = None) -> datetime:
+    """ Current (or `now`) time at the coordinates, as an aware datetime """
+    now = now or datetime.now(timezone.utc)
+    tz = ZoneInfo(await timezone_finder.timezone_at(latitude, longitude, country))
+
+    return now.astimezone(tz)
+
+
+async def world_clock(places: Sequence[Tuple[float, float, Optional[str]]],
+                      now: Optional[datetime] = None) -> List[datetime]:
+    """
+    Local times for several (latitude, longitude, country) places, all taken
+    at the same instant. Places that need timeapi.io are asked about at once.
+    """
+    now = now or datetime.now(timezone.utc)
+
+    return list(await asyncio.gather(
+        *[local_time(latitude, longitude, country, now) for latitude, longitude, country in places]
+    ))
+
+
+def build_index(geojson_path: str, index_path: str = DEFAULT_INDEX_PATH) -> None:
+    """
+    Compiles timezone-boundary-builder's GeoJSON into a directory of flat
+    NumPy arrays, one .npy file each:
+
+    names          timezone names
+    polygon_zone   index into names for every polygon
+    bbox           (min lon, min lat, max lon, max lat) for every polygon
+    polygon_rings  polygon i owns rings polygon_rings[i]:polygon_rings[i + 1]
+    ring_offsets   ring j owns vertices ring_offsets[j]:ring_offsets[j + 1]
+    vertices       (lon, lat) float32 pairs
+    """
+    with open(geojson_path, encoding="utf-8") as file:
+        features = json.load(file)["features"]
+
+    names: List[str] = []
+    polygon_zone: List[int] = []
+    bbox: List[Tuple[float, float, float, float]] = []
+    polygon_rings = [0]
+    ring_offsets = [0]
+    vertices: List[np.ndarray] = []
+
+    for feature in features:
+        geometry = feature["geometry"]
+        polygons = geometry["coordinates"]
+
+        if geometry["type"] == "Polygon":
+            polygons = [polygons]
+
+        names.append(feature["properties"]["tzid"])
+
+        for polygon in polygons:
+            outline = np.asarray(polygon[0], dtype=np.float32)
+
+            polygon_zone.append(len(names) - 1)
+            bbox.append((*outline.min(axis=0), *outline.max(axis=0)))
+
+            for ring in polygon:
+                ring = np.asarray(ring, dtype=np.float32)
+                vertices.append(ring)
+                ring_offsets.append(ring_offsets[-1] + len(ring))
+
+            polygon_rings.append(polygon_rings[-1] + len(polygon))
+
+    arrays = {
+        "names": np.array(names),
+        "polygon_zone": np.array(polygon_zone, dtype=np.int32),
+        "bbox": np.array(bbox, dtype=np.float32),
+        "polygon_rings": np.array(polygon_rings, dtype=np.int64),
+        "ring_offsets": np.array(ring_offsets, dtype=np.int64),
+        "vertices": np.concatenate(vertices),
+    }
+
+    # Written next to it and swapped in, so a running server never maps half an index
+    partial = f"{index_path.rstrip(os.sep)}.partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(partial, f"{name}.npy"), array)
+
+    shutil.rmtree(index_path, ignore_errors=True)
+    os.replace(partial, index_path)
+
+
+def download_index(index_path: str = DEFAULT_INDEX_PATH, url: str = RELEASE_URL) -> None:
+    """ Downloads timezone-boundary-builder's latest release and compiles it """
+    with tempfile.TemporaryDirectory() as directory:
+        archive = os.path.join(directory, "timezones.geojson.zip")
+
+        print(f"Downloading {url}")
+        urllib.request.urlretrieve(url, archive)
+
+        with zipfile.ZipFile(archive) as zipped:
+            geojson = next(name for name in zipped.namelist() if name.endswith(".json"))
+            zipped.extract(geojson, directory)
+
+        print(f"Compiling {geojson} into {index_path}")
+        build_index(os.path.join(directory, geojson), index_path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "download":
+        download_index(*sys.argv[2:3])
+    elif len(sys.argv) >= 3 and sys.argv[1] == "build":
+        build_index(*sys.argv[2:4])
+    else:
+        print("Usage: python -m actions.api.timezones download [index dir]")
+        print("       python -m actions.api.timezones build <geojson> [index dir]")
+        sys.exit(1)
@@ -0,0 +1,344 @@
+"""
+Offline latency/throughput benchmark for the custom actions.
+
+Starts the stub upstreams from benchmarks/stubs.py, points every wrapper in
+actions/api at them (and its caches/stores at a temporary directory), then
+calls each action's run() directly with synthetic Trackers at increasing
+concurrency. Reports throughput and p50/p95/p99 per action, plus how many
+upstream requests each run made, so changes to the wrappers can be measured
+without network access.
+
+Usage (from the project root):
+
+    python benchmarks/action_latency.py
+    python benchmarks/action_latency.py --actions say_weather,tell_joke --concurrency 1,16,64
+    python benchmarks/action_latency.py --fault mistral=1.5:0.5:0.05 --error-rate 0.01
+    python benchmarks/action_latency.py --save-baseline laptop
+    python benchmarks/action_latency.py --baseline laptop   # exits 1 on a regression
+
+Baselines are kept in benchmarks/baselines/ (not committed, the numbers only
+mean something on the machine that made them).
+"""
+from typing import List, Dict, Any, Callable, Tuple, Optional
+import itertools
+import argparse
+import tempfile
+import asyncio
+import shutil
+import json
+import math
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stubs import StubUpstreams, Fault, HT_DATA, parse_faults, add_fault_arguments
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines")
+
+PLACES = [
+    "Seattle", "Tokyo", "London", "Helsinki", "Sao Paulo", "Nairobi", "Sydney", "Reykjavik",
+    "Toronto", "Mumbai", "Cairo", "Lima", "Berlin", "Anchorage", "Honolulu", "Singapore",
+]
+
+TOPICS = ["your day", "the weather", "anime", "cooking", "music", "space", "cats", "coffee"]
+
+
+def tracker(i: int, intent: str, entities: Optional[List[Tuple[str, Any]]] = None,
+            slots: Optional[Dict[str, Any]] = None, events: Optional[List[Dict[str, Any]]] = None,
+            text: str = "", sender_id: Optional[str] = None) -> Any:
+    from rasa_sdk import Tracker
+
+    latest_message = {
+        "intent": {"name": intent, "confidence": 1.0},
+        "entities": [{"entity": entity, "value": value} for entity, value in entities or []],
+        "text": text,
+    }
+    events = events if events is not None else [{"event": "user", "text": text, "parse_data": latest_message}]
+
+    # A few dozen regular users rather than a new one every time
+    return Tracker(sender_id or f"bench-{i % 40}", slots or {}, latest_message, events, False, None, {}, "action_listen")
+
+
+def _conversation(i: int) -> Any:
+    text = f"Hey Touko, what do you think about {TOPICS[i % len(TOPICS)]}? ({i})"
+    events = [
+        {"event": "user", "text": "hi"},
+        {"event": "bot", "text": "Hello! How can I help?"},
+        {"event": "user", "text": text},
+    ]
+    # A new conversation every time, a known one would only hit the response cache
+    return tracker(i, "chitchat", events=events, text=text, sender_id=f"bench-chat-{i}")
+
+
+def _manga_history(i: int) -> Any:
+    history = [{"chapter_id": f"chapter-{n:05d}", "manga_id": f"manga-{n % 8}"} for n in range(5)]
+    return tracker(i, "ask_manga_details", [("number", i % 5 + 1)], slots={"manga_history": history})
+
+
+# Action class in actions/actions.py, and a Tracker for the i-th run
+SCENARIOS: Dict[str, Tuple[str, Callable[[int], Any]]] = {
+    "tell_joke": ("ActionTellJoke", lambda i: tracker(
+        i, "tell_joke", [("joke_category", ("Programming", "Pun", "Any")[i % 3])])),
+    "say_weather": ("ActionSayWeather", lambda i: tracker(
+        i, "ask_weather", [("GPE", PLACES[i % len(PLACES)])])),
+    "get_time": ("ActionGetTime", lambda i: tracker(
+        i, "ask_time", [("GPE", PLACES[i % len(PLACES)]), ("GPE", PLACES[(i + 5) % len(PLACES)])])),
+    "tell_day_state": ("ActionTellDayState", lambda i: tracker(
+        i, "ask_is_daytime", [("GPE", PLACES[i % len(PLACES)]), ("is_daytime", "day")])),
+    "tell_sun_times": ("ActionTellSunTimes", lambda i: tracker(
+        i, "ask_sun_times", [("GPE", PLACES[i % len(PLACES)])])),
+    "make_conversation": ("ActionMakeConversation", _conversation),
+    "check_manga_updates": ("ActionCheckMangaUpdates", lambda i: tracker(
+        i, "check_manga_updates", [("number", 5)])),
+    "tell_manga_details": ("ActionTellMangaDetails", _manga_history),
+    "set_light_state": ("ActionSetLightState", lambda i: tracker(
+        i, "set_light_state", [("is_on", "true" if i % 2 else "false")])),
+    "tell_light_state": ("ActionTellLightState", lambda i: tracker(i, "ask_light_state")),
+    "check_temp_and_stuff": ("ActionCheckTempAndStuff", lambda i: tracker(i, "check_temp_and_stuff")),
+    "tell_sensor_history": ("ActionTellSensorHistory", lambda i: tracker(
+        i, "ask_sensor_history", [("sensor_metric", ("temperature", "humidity")[i % 2]),
+                                  ("period", ("overnight", "today", "this week")[i % 3])])),
+    "tell_temp_trend": ("ActionTellTempTrend", lambda i: tracker(i, "ask_temp_trend")),
+}
+
+
+def configure_environment(stubs: StubUpstreams, workdir: str, cold: bool) -> None:
+    """ Has to happen before actions.actions is imported, the wrappers read it then """
+    os.environ.update(stubs.env())
+
+    data_path = os.path.join(workdir, "gen3_ht_data.json")
+    shutil.copy(HT_DATA, data_path)
+
+    os.environ.update({
+        "DEFAULT_LOCATION": "Seattle",
+        "METRICS_PORT": "0",
+        "GEOCODING_CACHE_PATH": os.path.join(workdir, "geocoding.sqlite3"),
+        "MANGADEX_STORE_PATH": os.path.join(workdir, "mangadex.sqlite3"),
+        "MANGADEX_TOKEN_PATH": os.path.join(workdir, "mangadex_tokens.json"),
+        "MISTRAL_CACHE_PATH": os.path.join(workdir, "mistral.sqlite3"),
+        "SHELLY_HT_DATA_PATH": data_path,
+        "SHELLY_HT_SOCKET": os.path.join(workdir, "readings.sock"),
+        "SHELLY_HT_HISTORY_PATH": os.path.join(workdir, "history"),
+    })
+
+    # Mistral's client side rate limit is for the real API, it'd only measure itself here
+    os.environ.setdefault("MISTRAL_RATE_LIMIT", "1000")
+    os.environ.setdefault("MISTRAL_RATE_BURST", "1000")
+
+    if cold:
+        os.environ.update({
+            "WEATHER_CACHE_TTL": "0", "WEATHER_CACHE_GRACE": "0", "MISTRAL_CACHE": "off",
+            "MANGADEX_FEED_TTL": "0", "MANGADEX_FEED_GRACE": "0",
+        })
+
+
+def fill_history(days: int = 8, interval: float = 300) -> None:
+    """ A week and a bit of H&T readings for the history actions to aggregate """
+    import numpy as np
+    from actions.api.shelly import history
+
+    ts = np.arange(time.time() - days * 86400, time.time(), interval)
+    records = np.full(len(ts), np.nan, dtype=history.RECORD_DTYPE)
+
+    records["ts"] = ts
+    records["tC"] = 20 + 2 * np.sin(ts / 86400 * 2 * np.pi)
+    records["rh"] = 50 + 5 * np.cos(ts / 86400 * 2 * np.pi)
+    records["battery"] = np.linspace(100, 90, len(ts))
+
+    history.history.append(records)
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """ Nearest-rank percentile """
+    if not sorted_values:
+        return float("nan")
+
+    return sorted_values[max(math.ceil(q / 100 * len(sorted_values)) - 1, 0)]
+
+
+async def drive(run: Callable, make_tracker: Callable[[int], Any], requests: int,
+                concurrency: int, offset: int = 0) -> Dict[str, Any]:
+    from rasa_sdk.executor import CollectingDispatcher
+
+    latencies: List[float] = []
+    errors = 0
+    indices = itertools.count(offset)
+
+    async def worker() -> None:
+        nonlocal errors
+
+        for i in indices:
+            if i >= offset + requests:
+                return
+
+            tracker = make_tracker(i)
+            start = time.perf_counter()
+
+            try:
+                await run(CollectingDispatcher(), tracker, {})
+            except Exception:
+                errors += 1
+
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput": requests / elapsed,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+async def benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    stubs = StubUpstreams(parse_faults(args.fault), Fault(args.latency, args.jitter, args.error_rate))
+    await stubs.start()
+
+    workdir = tempfile.mkdtemp(prefix="touko-bench-")
+    configure_environment(stubs, workdir, args.cold)
+
+    import actions.actions as actions
+    from actions.api import http
+
+    fill_history()
+
+    results: Dict[str, Any] = {}
+
+    try:
+        for name in args.actions:
+            class_name, make_tracker = SCENARIOS[name]
+            run = getattr(actions, class_name)().run
+
+            # Imports, connections, tokens and caches, as after a while of normal use
+            if args.warmup:
+                await drive(run, make_tracker, args.warmup, 1)
+
+            results[name] = {}
+            offset = args.warmup
+
+            for concurrency in args.concurrency:
+                before = stubs.requests.copy()
+
+                numbers = await drive(run, make_tracker, args.requests, concurrency, offset)
+                offset += args.requests
+
+                calls = stubs.requests - before
+                numbers["upstream_calls_per_run"] = {
+                    upstream: count / args.requests for upstream, count in sorted(calls.items())
+                }
+
+                results[name][str(concurrency)] = numbers
+                report_line(name, concurrency, numbers)
+
+    finally:
+        await http.close_session()
+        await stubs.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "python": sys.version.split()[0],
+        "settings": {
+            "requests": args.requests,
+            "cold": args.cold,
+            "default_fault": Fault(args.latency, args.jitter, args.error_rate).to_dict(),
+            "faults": {upstream: fault.to_dict() for upstream, fault in parse_faults(args.fault).items()},
+        },
+        "results": results,
+    }
+
+
+def report_header() -> None:
+    print(f"{'action':<22} {'conc':>4} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}  upstream calls/run")
+
+
+def report_line(name: str, concurrency: int, numbers: Dict[str, Any]) -> None:
+    calls = ", ".join(f"{upstream} {count:.2g}" for upstream, count in numbers["upstream_calls_per_run"].items())
+
+    print(f"{name:<22} {concurrency:>4} {numbers['throughput']:>8.1f} {numbers['p50_ms']:>8.1f} "
+          f"{numbers['p95_ms']:>8.1f} {numbers['p99_ms']:>8.1f} {numbers['errors']:>6}  {calls or '-'}")
+
+
+def baseline_path(name: str) -> str:
+    return name if name.endswith(".json") else os.path.join(BASELINES, f"{name}.json")
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """ Runs whose p95 got slower, or throughput lower, than `tolerance` allows """
+    regressions = []
+
+    for name, runs in results["results"].items():
+        for concurrency, numbers in runs.items():
+            before = baseline["results"].get(name, {}).get(concurrency)
+
+            if before is None:
+                continue
+
+            if numbers["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{name} x{concurrency}: p95 {before['p95_ms']:.1f} -> {numbers['p95_ms']:.1f} ms")
+
+            if numbers["throughput"] < before["throughput"] / (1 + tolerance):
+                regressions.append(
+                    f"{name} x{concurrency}: {before['throughput']:.1f} -> {numbers['throughput']:.1f} req/s"
+                )
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--actions", type=lambda value: value.split(","), default=list(SCENARIOS),
+                        help=f"comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=lambda value: [int(c) for c in value.split(",")], default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="runs per action and concurrency level")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured runs per action first")
+    parser.add_argument("--cold", action="store_true", help="turn off the weather and Mistral response caches, and sync the MangaDex feed every time")
+    add_fault_arguments(parser)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--save-baseline", metavar="NAME", help="store the results in benchmarks/baselines/NAME.json")
+    parser.add_argument("--baseline", metavar="NAME", help="compare against benchmarks/baselines/NAME.json (or a path)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    args = parser.parse_args()
+
+    unknown = set(args.actions) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown actions: {', '.join(sorted(unknown))}")
+
+    report_header()
+    results = asyncio.run(benchmark(args))
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(BASELINES, exist_ok=True)
+
+        with open(baseline_path(args.save_baseline), "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(baseline_path(args.baseline)) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+
+        for regression in regressions:
+            print(f"Regression: {regression}")
+
+        if regressions:
+            sys.exit(1)
+
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Startup benchmark for the action server.
+
+Measures how long `import actions.actions` takes (what `rasa run actions`
+does before it can serve anything) in fresh interpreters:
+
+cold   no cached bytecode, every module is compiled (first start after an
+       install or a change)
+warm   bytecode already cached (a normal restart)
+
+and breaks it down per module with `python -X importtime`. With --dispatch
+it also times the first use of every lazily imported module (see
+actions/api/lazy.py), which is what the first run of each action pays.
+
+Usage (from the project root):
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 10 --dispatch --json startup.json
+    python benchmarks/startup.py --baseline startup.json   # exits 1 on a regression
+"""
+from typing import List, Dict, Any, Tuple
+import statistics
+import subprocess
+import argparse
+import tempfile
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_ACTIONS = "import actions.actions"
+
+FIRST_DISPATCH = """
+import json, time
+import actions.actions
+from actions.api.lazy import _lazy_modules
+
+timings = {}
+for module in _lazy_modules:
+    start = time.perf_counter()
+    module.load()
+    timings[module._name] = time.perf_counter() - start
+
+print(json.dumps(timings))
+"""
+
+
+def run_python(code: str, pycache: str, importtime: bool = False) -> Tuple[float, str, str]:
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=pycache)
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+
+    if result.returncode != 0:
+        sys.exit(f"Benchmark subprocess failed:\n{result.stderr}")
+
+    return elapsed, result.stdout, result.stderr
+
+
+def parse_importtime(stderr: str) -> List[Dict[str, Any]]:
+    """ `import time: self [us] | cumulative | imported package` lines """
+    modules = []
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append({
+            "module": name.strip(),
+            "depth": (len(name) - len(name.lstrip())) // 2,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+        })
+
+    return modules
+
+
+def summarize(timings: List[float]) -> Dict[str, float]:
+    return {
+        "median_ms": statistics.median(timings) * 1000,
+        "min_ms": min(timings) * 1000,
+        "max_ms": max(timings) * 1000,
+    }
+
+
+def benchmark(runs: int, dispatch: bool) -> Dict[str, Any]:
+    cold, warm = [], []
+
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as pycache:
+            cold.append(run_python(IMPORT_ACTIONS, pycache)[0])
+
+    with tempfile.TemporaryDirectory() as pycache:
+        # Fills the bytecode cache
+        run_python(IMPORT_ACTIONS, pycache)
+
+        for _ in range(runs):
+            warm.append(run_python(IMPORT_ACTIONS, pycache)[0])
+
+        _, _, stderr = run_python(IMPORT_ACTIONS, pycache, importtime=True)
+        modules = parse_importtime(stderr)
+
+        first_dispatch = json.loads(run_python(FIRST_DISPATCH, pycache)[1]) if dispatch else {}
+
+    return {
+        "python": sys.version.split()[0],
+        "runs": runs,
+        "cold": summarize(cold),
+        "warm": summarize(warm),
+        "modules": modules,
+        "first_dispatch_ms": {name: seconds * 1000 for name, seconds in first_dispatch.items()},
+    }
+
+
+def report(results: Dict[str, Any], top: int) -> None:
+    print(f"Python {results['python']}, {results['runs']} runs each")
+
+    for phase in ("cold", "warm"):
+        numbers = results[phase]
+        print(f"{phase:>5}: {numbers['median_ms']:8.1f} ms median "
+              f"({numbers['min_ms']:.1f} - {numbers['max_ms']:.1f})")
+
+    top_level = [module for module in results["modules"] if module["depth"] == 1]
+    print("\nSlowest direct imports of actions.actions (cumulative, warm):")
+    for module in sorted(top_level, key=lambda m: -m["cumulative_ms"])[:top]:
+        print(f"  {module['cumulative_ms']:8.1f} ms  {module['module']}")
+
+    own = [module for module in results["modules"] if module["module"].startswith("actions")]
+    print("\nThis project's modules imported at startup (self time):")
+    for module in sorted(own, key=lambda m: -m["self_ms"])[:top]:
+        print(f"  {module['self_ms']:8.1f} ms  {module['module']}")
+
+    if results["first_dispatch_ms"]:
+        print("\nFirst use of lazily imported modules:")
+        for name, ms in sorted(results["first_dispatch_ms"].items(), key=lambda item: -item[1]):
+            print(f"  {ms:8.1f} ms  {name}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="modules to list per breakdown")
+    parser.add_argument("--dispatch", action="store_true", help="also time the first use of lazy modules")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file (from --json) to compare the warm median against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown over the baseline, 0.25 = 25%%")
+    args = parser.parse_args()
+
+    results = benchmark(args.runs, args.dispatch)
+    report(results, args.top)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+        limit = baseline["warm"]["median_ms"] * (1 + args.tolerance)
+        print(f"\nBaseline warm median {baseline['warm']['median_ms']:.1f} ms, limit {limit:.1f} ms")
+
+        if results["warm"]["median_ms"] > limit:
+            print("Startup regressed")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
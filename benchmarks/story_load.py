@@ -0,0 +1,534 @@
+"""
+Conversational load test: replays stories as many concurrent simulated users
+against the action server's /webhook, the way Rasa would call it, with every
+upstream stubbed by benchmarks/stubs.py.
+
+Stories come from tests/test_stories.yml, data/stories.yml, data/rules.yml
+and benchmarks/load_stories.yml (the multi-turn weather, manga, lights and
+sensor flows). Each simulated user starts a new conversation
+(action_session_start), then for every user turn sends the tracker so far
+to the webhook for each custom action in the turn, applies the returned
+events and waits a bit like a person would. Turns that only have utter_*
+responses never reach the action server and are skipped.
+
+The number of users is ramped up in stages. For every stage this reports
+sustained turns per second, turn and per-step (action) p50/p95/p99, errors,
+and how long the server's event loop was blocked (from its /metrics, see
+actions/api/metrics.py). The first stage that misses --slo, errors too much
+or stops scaling is where the server degrades.
+
+Usage (from the project root):
+
+    python benchmarks/story_load.py                        # starts stubs and an action server
+    python benchmarks/story_load.py --ramp 4,16,64,128 --stage-seconds 30 --think-time 2
+    python benchmarks/story_load.py --fault mistral=1:0.5 --json load.json
+    python benchmarks/story_load.py --url http://localhost:5055/webhook \\
+        --metrics-url http://127.0.0.1:5056/metrics        # a server you started yourself
+"""
+from typing import List, Dict, Any, Optional, Tuple
+from collections import defaultdict
+import subprocess
+import threading
+import argparse
+import tempfile
+import asyncio
+import random
+import shutil
+import socket
+import json
+import time
+import sys
+import re
+import os
+
+import aiohttp
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from stubs import StubUpstreams, Fault, parse_faults, add_fault_arguments
+from action_latency import configure_environment, fill_history, percentile
+
+STORY_FILES = [
+    os.path.join(ROOT, "tests", "test_stories.yml"),
+    os.path.join(ROOT, "data", "stories.yml"),
+    os.path.join(ROOT, "data", "rules.yml"),
+    os.path.join(ROOT, "benchmarks", "load_stories.yml"),
+]
+
+# [Tokyo](GPE) or [2]{"entity": "number", "value": 2}
+ANNOTATION = re.compile(r"\[(?P<text>[^\]]+)\](?:\((?P<entity>[^)]+)\)|(?P<json>\{[^}]*\}))")
+
+
+class Turn(object):
+
+    def __init__(self, intent: str, text: str = ""):
+        self.intent = intent
+        self.text, self.entities = parse_annotations(text.strip()) if text else (intent, [])
+        self.actions: List[str] = []
+
+
+class Story(object):
+
+    def __init__(self, name: str, turns: List[Turn]):
+        self.name = name
+        self.turns = turns
+
+
+def parse_annotations(text: str) -> Tuple[str, List[Dict[str, Any]]]:
+    """ "time in [Tokyo](GPE)" -> ("time in Tokyo", [{"entity": "GPE", "value": "Tokyo", ...}]) """
+    entities = []
+    plain = ""
+    last = 0
+
+    for match in ANNOTATION.finditer(text):
+        plain += text[last:match.start()]
+        start = len(plain)
+        plain += match["text"]
+        last = match.end()
+
+        if match["entity"]:
+            entity = {"entity": match["entity"], "value": match["text"]}
+        else:
+            entity = dict(json.loads(match["json"]))
+            entity.setdefault("value", match["text"])
+
+        entities.append(dict(entity, start=start, end=len(plain)))
+
+    return plain + text[last:], entities
+
+
+def load_stories(paths: List[str]) -> List[Story]:
+    stories = []
+
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            data = yaml.safe_load(file) or {}
+
+        for story in data.get("stories", []) + data.get("rules", []):
+            turns: List[Turn] = []
+
+            for step in story.get("steps", []):
+                if "intent" in step:
+                    turns.append(Turn(step["intent"], step.get("user", "")))
+                elif "action" in step and turns:
+                    turns[-1].actions.append(step["action"])
+
+            if turns:
+                stories.append(Story(story.get("story") or story.get("rule"), turns))
+
+    return stories
+
+
+class StageStats(object):
+
+    def __init__(self):
+        self.turns: List[float] = []
+        self.steps: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.conversations = 0
+
+
+class SimulatedUser(object):
+    """ One conversation's tracker, as Rasa would keep it """
+
+    def __init__(self, sender_id: str):
+        self.sender_id = sender_id
+        self.events: List[Dict[str, Any]] = []
+        self.slots: Dict[str, Any] = {}
+        self.latest_message: Dict[str, Any] = {}
+        self.latest_action_name = "action_listen"
+
+    def say(self, turn: Turn) -> None:
+        self.latest_message = {
+            "intent": {"name": turn.intent, "confidence": 1.0},
+            "entities": turn.entities,
+            "text": turn.text,
+        }
+        self.events.append({
+            "event": "user", "timestamp": time.time(), "text": turn.text, "parse_data": self.latest_message,
+        })
+
+    def acted(self, action: str, events: List[Dict[str, Any]], responses: List[Dict[str, Any]]) -> None:
+        self.events.append({"event": "action", "timestamp": time.time(), "name": action})
+        self.latest_action_name = action
+
+        for event in events:
+            if event.get("event") == "slot":
+                self.slots[event["name"]] = event.get("value")
+
+        self.events.extend(events)
+        self.events.extend({"event": "bot", "timestamp": time.time(), "text": response.get("text")}
+                           for response in responses)
+
+    def listen(self) -> None:
+        self.events.append({"event": "action", "timestamp": time.time(), "name": "action_listen"})
+        self.latest_action_name = "action_listen"
+
+    def payload(self, action: str, domain: Dict[str, Any], version: str) -> Dict[str, Any]:
+        return {
+            "next_action": action,
+            "sender_id": self.sender_id,
+            "tracker": {
+                "sender_id": self.sender_id,
+                "slots": self.slots,
+                "latest_message": self.latest_message,
+                "events": self.events,
+                "paused": False,
+                "followup_action": None,
+                "active_loop": {},
+                "latest_action_name": self.latest_action_name,
+            },
+            "domain": domain,
+            "version": version,
+        }
+
+
+class LoadTest(object):
+
+    def __init__(self, url: str, domain: Dict[str, Any], stories: List[Story], think_time: float,
+                 version: str):
+        self.url = url
+        self.domain = domain
+        self.custom_actions = set(domain.get("actions", []))
+        self.version = version
+        self.think_time = think_time
+
+        # Turns that only have utter_* responses never reach the action server
+        self.stories = [story for story in stories if any(
+            action in self.custom_actions for turn in story.turns for action in turn.actions
+        )]
+
+        self._conversations = 0
+
+    async def _call(self, session: aiohttp.ClientSession, user: SimulatedUser, action: str,
+                    stats: StageStats) -> None:
+        start = time.perf_counter()
+
+        try:
+            async with session.post(self.url, json=user.payload(action, self.domain, self.version)) as response:
+                body = await response.json(content_type=None)
+
+                if response.status != 200:
+                    raise aiohttp.ClientResponseError(
+                        response.request_info, (), status=response.status, message=str(body)
+                    )
+
+            user.acted(action, body.get("events", []), body.get("responses", []))
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            stats.errors[action] += 1
+            user.acted(action, [], [])
+
+        stats.steps[action].append(time.perf_counter() - start)
+
+    async def _converse(self, session: aiohttp.ClientSession, story: Story, stats: StageStats,
+                        stop_at: float) -> None:
+        self._conversations += 1
+        user = SimulatedUser(f"load-{self._conversations}")
+
+        await self._call(session, user, "action_session_start", stats)
+
+        for turn in story.turns:
+            actions = [action for action in turn.actions if action in self.custom_actions]
+
+            if not actions:
+                continue
+
+            if time.monotonic() >= stop_at:
+                return
+
+            await asyncio.sleep(random.expovariate(1 / self.think_time) if self.think_time else 0)
+
+            user.say(turn)
+            start = time.perf_counter()
+
+            for action in turn.actions:
+                if action in self.custom_actions:
+                    await self._call(session, user, action, stats)
+                else:
+                    user.acted(action, [], [])
+
+            user.listen()
+            stats.turns.append(time.perf_counter() - start)
+
+        stats.conversations += 1
+
+    async def stage(self, users: int, seconds: float) -> Tuple[StageStats, float]:
+        stats = StageStats()
+        stop_at = time.monotonic() + seconds
+
+        async def simulated_user(session: aiohttp.ClientSession) -> None:
+            while time.monotonic() < stop_at:
+                await self._converse(session, random.choice(self.stories), stats, stop_at)
+
+        connector = aiohttp.TCPConnector(limit=users)
+        timeout = aiohttp.ClientTimeout(total=60)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            start = time.perf_counter()
+            await asyncio.gather(*[simulated_user(session) for _ in range(users)])
+            elapsed = time.perf_counter() - start
+
+        return stats, elapsed
+
+
+def parse_metrics(text: str) -> Dict[str, float]:
+    """ Prometheus text -> {"name{labels}": value}, enough for diffing two scrapes """
+    samples = {}
+
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            samples[name] = float(value)
+
+    return samples
+
+
+async def scrape(url: Optional[str]) -> Dict[str, float]:
+    if not url:
+        return {}
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                return parse_metrics(await response.text())
+    except aiohttp.ClientError:
+        return {}
+
+
+def loop_blocking(before: Dict[str, float], after: Dict[str, float]) -> Dict[str, Optional[float]]:
+    """ Blocked seconds and the p99 wake-up lag bucket between two scrapes """
+    if not after:
+        return {"blocked_s": None, "lag_p99_ms": None}
+
+    blocked = "touko_event_loop_blocked_seconds_total"
+    buckets = []
+
+    for name, value in after.items():
+        match = re.match(r'touko_event_loop_lag_seconds_bucket\{le="([^"]+)"\}', name)
+
+        if match:
+            buckets.append((float(match[1]), value - before.get(name, 0)))
+
+    buckets.sort()
+    total = buckets[-1][1] if buckets else 0
+    lag_p99 = next((bound for bound, count in buckets if count >= 0.99 * total), None) if total else None
+
+    return {
+        "blocked_s": after.get(blocked, 0) - before.get(blocked, 0),
+        "lag_p99_ms": lag_p99 * 1000 if lag_p99 is not None else None,
+    }
+
+
+def summarize(users: int, stats: StageStats, elapsed: float, loop: Dict[str, Optional[float]]) -> Dict[str, Any]:
+    turns = sorted(stats.turns)
+    calls = sum(len(latencies) for latencies in stats.steps.values())
+    errors = sum(stats.errors.values())
+
+    steps = {}
+    for action, latencies in sorted(stats.steps.items()):
+        latencies = sorted(latencies)
+        steps[action] = {
+            "calls": len(latencies),
+            "errors": stats.errors.get(action, 0),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+        }
+
+    return {
+        "users": users,
+        "seconds": elapsed,
+        "conversations": stats.conversations,
+        "turns": len(turns),
+        "turns_per_second": len(turns) / elapsed,
+        "turn_p50_ms": percentile(turns, 50) * 1000,
+        "turn_p95_ms": percentile(turns, 95) * 1000,
+        "turn_p99_ms": percentile(turns, 99) * 1000,
+        "calls": calls,
+        "error_rate": errors / calls if calls else 0.0,
+        "loop_blocked_s": loop["blocked_s"],
+        "loop_lag_p99_ms": loop["lag_p99_ms"],
+        "steps": steps,
+    }
+
+
+def degradation(stage: Dict[str, Any], first: Dict[str, Any], args: argparse.Namespace) -> Optional[str]:
+    """ Why this stage counts as degraded, None if it doesn't """
+    if stage["turn_p95_ms"] > args.slo * 1000:
+        return f"turn p95 {stage['turn_p95_ms']:.0f} ms over the {args.slo:g}s SLO"
+
+    if stage["error_rate"] > args.max_error_rate:
+        return f"{stage['error_rate']:.1%} of calls failed"
+
+    # Every user adds about the same load, so throughput should grow with them
+    expected = first["turns_per_second"] / first["users"] * stage["users"]
+    if stage["turns_per_second"] < expected * args.min_scaling:
+        return f"{stage['turns_per_second']:.1f} turns/s, {expected:.1f} expected from the first stage"
+
+    return None
+
+
+def print_stage(stage: Dict[str, Any]) -> None:
+    blocked = f"{stage['loop_blocked_s']:.2f}" if stage["loop_blocked_s"] is not None else "-"
+    lag = f"{stage['loop_lag_p99_ms']:g}" if stage["loop_lag_p99_ms"] is not None else "-"
+
+    print(f"{stage['users']:>5} {stage['turns_per_second']:>8.1f} {stage['turn_p50_ms']:>8.1f} "
+          f"{stage['turn_p95_ms']:>8.1f} {stage['turn_p99_ms']:>8.1f} {stage['error_rate']:>7.1%} "
+          f"{blocked:>10} {lag:>11}")
+
+
+def print_steps(stage: Dict[str, Any]) -> None:
+    print(f"\nPer step at {stage['users']} users:")
+    print(f"  {'action':<30} {'calls':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}")
+
+    for action, step in stage["steps"].items():
+        print(f"  {action:<30} {step['calls']:>6} {step['p50_ms']:>8.1f} {step['p95_ms']:>8.1f} "
+              f"{step['p99_ms']:>8.1f} {step['errors']:>6}")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stubs(stubs: StubUpstreams) -> asyncio.AbstractEventLoop:
+    """ On their own thread and loop, so the load generator doesn't slow them down """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="stubs", daemon=True).start()
+
+    asyncio.run_coroutine_threadsafe(stubs.start(), loop).result()
+
+    return loop
+
+
+def start_action_server(port: int, metrics_port: int, log_path: str) -> subprocess.Popen:
+    env = dict(os.environ, METRICS_PORT=str(metrics_port))
+    command = [sys.executable, "-m", "rasa_sdk", "--actions", "actions", "--port", str(port)]
+
+    with open(log_path, "w") as log:
+        server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 120
+
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"The action server exited, see {log_path}")
+
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.terminate()
+    sys.exit(f"The action server didn't start within 120s, see {log_path}")
+
+
+async def ramp(test: LoadTest, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    print(f"{'users':>5} {'turns/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} "
+          f"{'blocked s':>10} {'lag p99 ms':>11}")
+
+    stages = []
+    degraded_at = None
+
+    for users in args.ramp:
+        before = await scrape(args.metrics_url)
+        stats, elapsed = await test.stage(users, args.stage_seconds)
+        after = await scrape(args.metrics_url)
+
+        stage = summarize(users, stats, elapsed, loop_blocking(before, after))
+        stage["degraded"] = degradation(stage, stages[0] if stages else stage, args)
+        stages.append(stage)
+
+        print_stage(stage)
+
+        if stage["degraded"]:
+            degraded_at = stage
+
+            if not args.full_ramp:
+                break
+
+    for stage in ([stages[-2]] if degraded_at and len(stages) > 1 else []) + [degraded_at or stages[-1]]:
+        print_steps(stage)
+
+    if degraded_at:
+        print(f"\nDegrades at {degraded_at['users']} users: {degraded_at['degraded']}")
+    else:
+        print(f"\nNo degradation up to {stages[-1]['users']} users")
+
+    return stages
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ramp", type=lambda value: [int(u) for u in value.split(",")], default=[1, 4, 16, 32, 64],
+                        help="simulated users per stage")
+    parser.add_argument("--stage-seconds", type=float, default=20)
+    parser.add_argument("--think-time", type=float, default=1.0, help="mean seconds a user takes between turns")
+    parser.add_argument("--stories", nargs="+", default=STORY_FILES)
+    parser.add_argument("--slo", type=float, default=2.0, help="seconds a turn's p95 may take")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--min-scaling", type=float, default=0.8,
+                        help="share of the linearly expected turns/s a stage has to reach")
+    parser.add_argument("--full-ramp", action="store_true", help="keep going after the first degraded stage")
+    parser.add_argument("--url", help="webhook of an action server that's already running")
+    parser.add_argument("--metrics-url", help="its metrics endpoint, for event loop blocking")
+    parser.add_argument("--cold", action="store_true", help="turn off the weather and Mistral response caches")
+    add_fault_arguments(parser)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    with open(os.path.join(ROOT, "domain.yml"), encoding="utf-8") as file:
+        domain = yaml.safe_load(file)
+
+    try:
+        from rasa_sdk import __version__ as version
+    except ImportError:
+        version = "3.6.2"
+
+    server = stubs = stubs_loop = workdir = None
+
+    if not args.url:
+        stubs = StubUpstreams(parse_faults(args.fault), Fault(args.latency, args.jitter, args.error_rate))
+        stubs_loop = start_stubs(stubs)
+
+        workdir = tempfile.mkdtemp(prefix="touko-load-")
+        configure_environment(stubs, workdir, args.cold)
+        fill_history()
+
+        port, metrics_port = free_port(), free_port()
+        log_path = os.path.join(workdir, "action_server.log")
+        server = start_action_server(port, metrics_port, log_path)
+
+        args.url = f"http://127.0.0.1:{port}/webhook"
+        args.metrics_url = f"http://127.0.0.1:{metrics_port}/metrics"
+
+    test = LoadTest(args.url, domain, load_stories(args.stories), args.think_time, version)
+    print(f"Replaying {len(test.stories)} stories against {args.url}\n")
+
+    try:
+        stages = asyncio.run(ramp(test, args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+        if stubs is not None:
+            asyncio.run_coroutine_threadsafe(stubs.stop(), stubs_loop).result()
+            stubs_loop.call_soon_threadsafe(stubs_loop.stop)
+
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"settings": {key: value for key, value in vars(args).items() if key != "stories"},
+                       "stages": stages}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
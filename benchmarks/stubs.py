@@ -0,0 +1,495 @@
+"""
+Local stand-ins for every upstream the actions talk to, so they can be
+benchmarked on a laptop without network access, API keys or a Shelly:
+
+/openweather/...        OpenWeather geocoding and current weather
+/timeapi/TimeZone/...   timeapi.io coordinates -> timezone
+/jokeapi/joke/<cat>     JokeAPI
+/mangadex/api/...       MangaDex followed feed and manga, plus /mangadex/auth (OAuth tokens)
+/mistral/...            Mistral chat completions (plain and streamed) and embeddings
+/stream_webhook         Takes the partial replies previewed with MISTRAL_STREAM=true
+/rpc/<Method>           Shelly H&T REST API, from actions/api/shelly/gen3_ht_data.json
+/rpc (WebSocket)        Shelly Plug JSON-RPC, including the NotifyStatus after Switch.Set
+
+Responses are built from the recorded payloads in benchmarks/payloads/, with
+place names, ids and timestamps varied so caches behave like they would
+with real traffic. Every upstream gets its own latency (a fixed part plus an
+exponential tail) and error rate, see Fault.
+
+Used by benchmarks/action_latency.py, or on its own to point a real action
+server at it:
+
+    python benchmarks/stubs.py --port 8099 --fault mistral=0.8:0.4:0.02
+"""
+from typing import List, Dict, Any, Optional
+from datetime import datetime, timedelta, timezone
+from collections import Counter
+import argparse
+import asyncio
+import random
+import json
+import time
+import zlib
+import os
+
+import aiohttp
+from aiohttp import web
+
+PAYLOADS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payloads")
+HT_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       "actions", "api", "shelly", "gen3_ht_data.json")
+
+UPSTREAMS = ("openweather", "timeapi", "jokeapi", "mangadex", "mistral", "stream_webhook", "shelly")
+
+# Chapters in the stub's followed feed, and how many series they belong to
+FEED_CHAPTERS = 60
+FEED_SERIES = 8
+
+# Words per streamed Mistral chunk, and seconds between chunks
+STREAM_WORDS = 4
+STREAM_INTERVAL = 0.02
+
+
+def load_payload(name: str) -> Any:
+    with open(os.path.join(PAYLOADS, name), encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _hash(text: str) -> int:
+    return zlib.crc32(text.casefold().encode("utf-8"))
+
+
+class Fault(object):
+    """
+    What one upstream does to each response: wait `latency` seconds plus an
+    exponentially distributed extra with mean `jitter` (a long-ish tail like
+    real APIs), then fail with a 503 `error_rate` of the time.
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    @classmethod
+    def parse(cls, spec: str) -> "Fault":
+        """ "latency[:jitter[:error_rate]]" in seconds, e.g. "0.08:0.02:0.01" """
+        return cls(*(float(part) for part in spec.split(":")))
+
+    def delay(self) -> float:
+        return self.latency + (random.expovariate(1 / self.jitter) if self.jitter else 0.0)
+
+    def fails(self) -> bool:
+        return random.random() < self.error_rate
+
+    def to_dict(self) -> Dict[str, float]:
+        return {"latency": self.latency, "jitter": self.jitter, "error_rate": self.error_rate}
+
+
+class StubUpstreams(object):
+
+    def __init__(self, faults: Optional[Dict[str, Fault]] = None, default: Optional[Fault] = None,
+                 host: str = "127.0.0.1", port: int = 0):
+        self.faults = faults or {}
+        self.default = default or Fault()
+        self.host = host
+        self.port = port
+
+        # Per upstream, to see how many calls each action makes
+        self.requests: Counter = Counter()
+        self.errors: Counter = Counter()
+
+        self._geocoding = load_payload("openweather_geocoding.json")[0]
+        self._weather = load_payload("openweather_weather.json")
+        self._jokes = load_payload("jokeapi_jokes.json")["jokes"]
+        self._chapter = load_payload("mangadex_chapter.json")
+        self._manga = load_payload("mangadex_manga.json")
+        self._chat = load_payload("mistral_chat.json")
+        self._plug_status = load_payload("shelly_plug_status.json")
+
+        with open(HT_DATA, encoding="utf-8") as file:
+            self._ht = json.load(file)
+
+        self._joke_ids = 0
+        self._feed_epoch = datetime.now(timezone.utc).replace(microsecond=0)
+        self._plug_sockets: List[web.WebSocketResponse] = []
+
+        self._runner: Optional[web.AppRunner] = None
+
+    def fault(self, upstream: str) -> Fault:
+        return self.faults.get(upstream, self.default)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def env(self) -> Dict[str, str]:
+        """ Environment variables that point the wrappers in actions/api here """
+        return {
+            "OPENWEATHER_URL": f"{self.url}/openweather",
+            "OPENWEATHER_API_KEY": "stub",
+            "TIMEAPI_URL": f"{self.url}/timeapi",
+            "JOKEAPI_URL": f"{self.url}/jokeapi",
+            "MANGADEX_API_URL": f"{self.url}/mangadex/api",
+            "MANGADEX_AUTH_URL": f"{self.url}/mangadex/auth",
+            "MANGADEX_USERNAME": "stub",
+            "MANGADEX_PASSWORD": "stub",
+            "MANGADEX_CLIENT_ID": "stub",
+            "MANGADEX_CLIENT_SECRET": "stub",
+            "MISTRAL_API_URL": f"{self.url}/mistral",
+            "MISTRAL_API_KEY": "stub",
+            "MISTRAL_STREAM_WEBHOOK": f"{self.url}/stream_webhook",
+            "SHELLY_PLUGS": f"lights={self.host}:{self.port}",
+            "SHELLY_HT_IP": f"{self.host}:{self.port}",
+        }
+
+    def _app(self) -> web.Application:
+        app = web.Application(middlewares=[self._inject])
+        app.router.add_get("/openweather/geo/1.0/direct", self._geocode)
+        app.router.add_get("/openweather/data/2.5/weather", self._current_weather)
+        app.router.add_get("/timeapi/TimeZone/coordinate", self._timezone)
+        app.router.add_get("/jokeapi/joke/{category}", self._joke)
+        app.router.add_post("/mangadex/auth", self._tokens)
+        app.router.add_get("/mangadex/api/user/follows/manga/feed", self._feed)
+        app.router.add_get("/mangadex/api/user/follows/manga", self._follows)
+        app.router.add_get("/mangadex/api/manga", self._manga_list)
+        app.router.add_get("/mangadex/api/manga/{manga_id}", self._manga_details)
+        app.router.add_post("/mistral/chat/completions", self._chat_completion)
+        app.router.add_post("/mistral/embeddings", self._embeddings)
+        app.router.add_post("/stream_webhook", self._partial_reply)
+        app.router.add_get("/rpc", self._plug_rpc)
+        app.router.add_get("/rpc/{method}", self._ht_rpc)
+        return app
+
+    async def start(self) -> str:
+        self._runner = web.AppRunner(self._app(), access_log=None)
+        await self._runner.setup()
+
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+
+        # Port 0 picks a free one
+        self.port = self._runner.addresses[0][1]
+
+        return self.url
+
+    async def stop(self) -> None:
+        for ws in list(self._plug_sockets):
+            await ws.close()
+
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @staticmethod
+    def _upstream(path: str) -> str:
+        name = path.strip("/").split("/")[0]
+        return "shelly" if name == "rpc" else name
+
+    @web.middleware
+    async def _inject(self, request: web.Request, handler) -> web.StreamResponse:
+        # The plug's RPC frames are counted, delayed and failed one by one instead
+        if request.path == "/rpc":
+            return await handler(request)
+
+        upstream = self._upstream(request.path)
+        self.requests[upstream] += 1
+
+        fault = self.fault(upstream)
+        await asyncio.sleep(fault.delay())
+
+        if fault.fails():
+            self.errors[upstream] += 1
+            return web.json_response({"error": "injected by benchmarks/stubs.py"}, status=503)
+
+        return await handler(request)
+
+    # OpenWeather
+
+    async def _geocode(self, request: web.Request) -> web.Response:
+        query = request.query.get("q", "")
+
+        # So the "doesn't exist" path can be benchmarked too
+        if query.casefold().startswith("nowhere"):
+            return web.json_response([])
+
+        # A stable spot for every name so the caches key on something real
+        seed = _hash(query)
+        place = dict(self._geocoding, name=query.title(), local_names={"en": query.title()})
+        place["lat"] = (seed % 12000) / 100 - 60
+        place["lon"] = (seed // 12000 % 36000) / 100 - 180
+
+        return web.json_response([place])
+
+    async def _current_weather(self, request: web.Request) -> web.Response:
+        latitude, longitude = float(request.query["lat"]), float(request.query["lon"])
+
+        weather = dict(self._weather, coord={"lat": latitude, "lon": longitude}, dt=int(time.time()))
+        weather["main"] = dict(weather["main"], temp=weather["main"]["temp"] + latitude % 10)
+
+        return web.json_response(weather)
+
+    # timeapi.io
+
+    async def _timezone(self, request: web.Request) -> web.Response:
+        longitude = float(request.query["longitude"])
+
+        # Nautical time from the longitude, the Etc/ zones have their signs flipped
+        hours = round(longitude / 15)
+
+        return web.json_response({
+            "timeZone": f"Etc/GMT{-hours:+d}",
+            "currentLocalTime": (datetime.now(timezone.utc) + timedelta(hours=hours)).isoformat(),
+            "currentUtcOffset": {"seconds": hours * 3600},
+            "hasDayLightSaving": False,
+            "isDayLightSavingActive": False,
+        })
+
+    # JokeAPI
+
+    async def _joke(self, request: web.Request) -> web.Response:
+        amount = int(request.query.get("amount", 1))
+        jokes = []
+
+        # Fresh ids every time, as if JokeAPI picked other jokes
+        for _ in range(amount):
+            joke = dict(self._jokes[self._joke_ids % len(self._jokes)], id=self._joke_ids)
+            joke["category"] = request.match_info["category"]
+            jokes.append(joke)
+            self._joke_ids += 1
+
+        if amount == 1:
+            return web.json_response(dict(jokes[0], error=False))
+
+        return web.json_response({"error": False, "amount": amount, "jokes": jokes})
+
+    # MangaDex
+
+    async def _tokens(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "access_token": f"stub-access-{random.getrandbits(32):08x}",
+            "refresh_token": "stub-refresh",
+            "expires_in": 900,
+            "refresh_expires_in": 7776000,
+            "token_type": "Bearer",
+        })
+
+    def _chapter_at(self, index: int) -> Dict[str, Any]:
+        readable_at = (self._feed_epoch - timedelta(hours=index)).isoformat()
+
+        chapter = json.loads(json.dumps(self._chapter))
+        chapter["id"] = f"chapter-{index:05d}"
+        chapter["attributes"].update(
+            chapter=str(FEED_CHAPTERS - index), pages=8 + index % 20,
+            publishAt=readable_at, readableAt=readable_at
+        )
+
+        for relation in chapter["relationships"]:
+            if relation["type"] == "manga":
+                relation["id"] = f"manga-{index % FEED_SERIES}"
+
+        return chapter
+
+    def _manga_by_id(self, manga_id: str) -> Dict[str, Any]:
+        manga = json.loads(json.dumps(self._manga))
+        manga["id"] = manga_id
+        manga["attributes"]["title"] = {"en": f"{manga['attributes']['title']['en']} ({manga_id})"}
+        return manga
+
+    async def _feed(self, request: web.Request) -> web.Response:
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", 10))
+
+        return web.json_response({
+            "result": "ok",
+            "response": "collection",
+            "data": [self._chapter_at(i) for i in range(offset, min(offset + limit, FEED_CHAPTERS))],
+            "limit": limit,
+            "offset": offset,
+            "total": FEED_CHAPTERS,
+        })
+
+    async def _follows(self, request: web.Request) -> web.Response:
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", 10))
+
+        return web.json_response({
+            "result": "ok",
+            "response": "collection",
+            "data": [self._manga_by_id(f"manga-{i}") for i in range(offset, min(offset + limit, FEED_SERIES))],
+            "limit": limit,
+            "offset": offset,
+            "total": FEED_SERIES,
+        })
+
+    async def _manga_list(self, request: web.Request) -> web.Response:
+        ids = request.query.getall("ids[]", [])
+        return web.json_response({"result": "ok", "data": [self._manga_by_id(manga_id) for manga_id in ids]})
+
+    async def _manga_details(self, request: web.Request) -> web.Response:
+        return web.json_response({"result": "ok", "data": self._manga_by_id(request.match_info["manga_id"])})
+
+    # Mistral
+
+    async def _chat_completion(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        content = self._chat["choices"][0]["message"]["content"]
+
+        if not body.get("stream"):
+            return web.json_response(dict(self._chat, created=int(time.time())))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        words = content.split(" ")
+        for i in range(0, len(words), STREAM_WORDS):
+            piece = " ".join(words[i:i + STREAM_WORDS]) + (" " if i + STREAM_WORDS < len(words) else "")
+            chunk = {"id": self._chat["id"], "choices": [{"index": 0, "delta": {"content": piece}}]}
+
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            await asyncio.sleep(STREAM_INTERVAL)
+
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+
+        return response
+
+    async def _embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+
+        data = []
+        for i, text in enumerate(body.get("input", [])):
+            rng = random.Random(_hash(text))
+            data.append({"object": "embedding", "index": i, "embedding": [rng.gauss(0, 1) for _ in range(1024)]})
+
+        return web.json_response({"object": "list", "model": body.get("model"), "data": data})
+
+    async def _partial_reply(self, request: web.Request) -> web.Response:
+        await request.read()
+        return web.Response(text="ok")
+
+    # Shelly
+
+    async def _ht_rpc(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+
+        if method == "Temperature.GetStatus":
+            return web.json_response({"id": 0, "tC": self._ht["tC"], "tF": self._ht["tF"]})
+
+        if method == "Humidity.GetStatus":
+            return web.json_response({"id": 0, "rh": self._ht["rh"]})
+
+        if method == "DevicePower.GetStatus":
+            return web.json_response({
+                "id": 0,
+                "battery": {"V": 5.9, "percent": self._ht["battery"]},
+                "external": {"present": self._ht["isCharging"]},
+            })
+
+        return web.json_response({"code": 404, "message": f"No handler for {method}"}, status=404)
+
+    async def _plug_frame(self, ws: web.WebSocketResponse, frame: Dict[str, Any]) -> None:
+        self.requests["shelly"] += 1
+
+        fault = self.fault("shelly")
+        await asyncio.sleep(fault.delay())
+
+        reply: Dict[str, Any] = {"id": frame.get("id"), "src": "shellyplugus-stub", "dst": frame.get("src")}
+        method = frame.get("method")
+        switch = self._plug_status["switch:0"]
+
+        if fault.fails():
+            self.errors["shelly"] += 1
+            reply["error"] = {"code": -114, "message": "Injected by benchmarks/stubs.py"}
+        elif method == "Shelly.GetStatus":
+            reply["result"] = self._plug_status
+        elif method == "Switch.GetStatus":
+            reply["result"] = switch
+        elif method == "Switch.Set":
+            reply["result"] = {"was_on": switch["output"]}
+            switch["output"] = bool(frame.get("params", {}).get("on"))
+        else:
+            reply["error"] = {"code": 404, "message": f"No handler for {method}"}
+
+        if ws.closed:
+            return
+
+        await ws.send_str(json.dumps(reply))
+
+        if method == "Switch.Set" and "result" in reply:
+            notification = json.dumps({
+                "src": "shellyplugus-stub",
+                "method": "NotifyStatus",
+                "params": {"ts": time.time(), "switch:0": {"id": 0, "output": switch["output"]}},
+            })
+
+            for socket in list(self._plug_sockets):
+                if not socket.closed:
+                    await socket.send_str(notification)
+
+    async def _plug_rpc(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self._plug_sockets.append(ws)
+
+        tasks = set()
+
+        try:
+            async for message in ws:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    # Concurrently, so one slow reply doesn't hold up the rest
+                    task = asyncio.ensure_future(self._plug_frame(ws, json.loads(message.data)))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+        finally:
+            self._plug_sockets.remove(ws)
+
+        return ws
+
+
+def parse_faults(specs: List[str]) -> Dict[str, Fault]:
+    """ ["mistral=0.8:0.4:0.02", ...] -> {"mistral": Fault(0.8, 0.4, 0.02), ...} """
+    faults = {}
+
+    for spec in specs:
+        upstream, _, fault = spec.partition("=")
+
+        if upstream not in UPSTREAMS:
+            raise argparse.ArgumentTypeError(f"Unknown upstream '{upstream}', pick one of {', '.join(UPSTREAMS)}")
+
+        faults[upstream] = Fault.parse(fault)
+
+    return faults
+
+
+def add_fault_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds every upstream takes to answer")
+    parser.add_argument("--jitter", type=float, default=0.02, help="mean of the exponential extra latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 503")
+    parser.add_argument("--fault", action="append", default=[], metavar="UPSTREAM=LATENCY[:JITTER[:ERROR_RATE]]",
+                        help=f"override for one upstream ({', '.join(UPSTREAMS)}), can be repeated")
+
+
+async def serve(args: argparse.Namespace) -> None:
+    stubs = StubUpstreams(parse_faults(args.fault), Fault(args.latency, args.jitter, args.error_rate),
+                          args.host, args.port)
+    await stubs.start()
+
+    print(f"Stub upstreams on {stubs.url}, point the action server here with:\n")
+    for key, value in stubs.env().items():
+        print(f"export {key}={value}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stubs.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    add_fault_arguments(parser)
+
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass